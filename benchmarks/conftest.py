@@ -0,0 +1,38 @@
+import os
+import shutil
+
+import pytest
+
+from synthetic import make_experiment
+
+# plate size for crawling benchmarks, 96 or 384 wells
+PLATES = {'96': (12, 8), '384': (24, 16)}
+PLATE = PLATES[os.environ.get('MATRIXSCREENER_BENCH_PLATE', '96')]
+
+
+@pytest.fixture(scope='session')
+def plate(tmpdir_factory):
+    "Experiment with empty images, 4 fields and 2 channels per well."
+    from matrixscreener.experiment import Experiment
+    root = tmpdir_factory.mktemp('plate').strpath
+    return Experiment(make_experiment(root, wells=PLATE, pixels=False))
+
+
+@pytest.fixture(scope='session')
+def pixel_plate(tmpdir_factory):
+    "Experiment with 2x2 wells of 512x512 8 bit images."
+    from matrixscreener.experiment import Experiment
+    root = tmpdir_factory.mktemp('pixel_plate').strpath
+    return Experiment(make_experiment(root, wells=(2, 2)))
+
+
+@pytest.fixture
+def output(tmpdir):
+    "Empty output folder, emptied again by calling it."
+    folder = tmpdir.mkdir('output').strpath
+
+    def empty():
+        shutil.rmtree(folder)
+        os.mkdir(folder)
+    empty.folder = folder
+    return empty
@@ -0,0 +1,69 @@
+# encoding: utf-8
+"""
+Minimal LAS AF CAM server for protocol benchmarks. Sends a welcome message on
+connect and echoes every command, as LAS AF does.
+"""
+import socket
+import threading
+
+
+class CAMSimulator(threading.Thread):
+    """Echoing CAM server on localhost.
+
+    Parameters
+    ----------
+    latency : float
+        Seconds to wait before echoing, simulates microscope response time.
+
+    Example
+    -------
+    >>> with CAMSimulator() as sim:
+    ...     cam = CAM(sim.host, sim.port)
+    """
+
+    welcome = b'/inf:welcome /app:matrix\r\n'
+
+    def __init__(self, latency=0.0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.latency = latency
+        self.server = socket.socket()
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(5)
+        self.host, self.port = self.server.getsockname()
+        self._stop_event = threading.Event()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def run(self):
+        self.server.settimeout(0.1)
+        while not self._stop_event.is_set():
+            try:
+                conn, _ = self.server.accept()
+            except socket.timeout:
+                continue
+            worker = threading.Thread(target=self._serve, args=(conn,))
+            worker.daemon = True
+            worker.start()
+
+    def _serve(self, conn):
+        conn.sendall(self.welcome)
+        while not self._stop_event.is_set():
+            msg = conn.recv(1024)
+            if not msg:
+                break
+            if self.latency:
+                self._stop_event.wait(self.latency)
+            conn.sendall(msg + b'\r\n')
+        conn.close()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.server.close()
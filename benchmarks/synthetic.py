@@ -0,0 +1,64 @@
+# encoding: utf-8
+"""
+Generate synthetic matrix screener experiments for benchmarks.
+"""
+import os
+
+
+def make_experiment(root, wells=(12, 8), fields=(2, 2), z_stacks=1,
+                    channels=2, timepoints=1, size=(512, 512), pixels=True):
+    """Write an experiment folder with the same layout as LAS AF Data
+    Exporter.
+
+    Parameters
+    ----------
+    root : string
+        Folder to create ``experiment--bench`` in.
+    wells : tuple
+        Number of wells in U and V direction. (12, 8) is a 96 well plate.
+    fields : tuple
+        Number of fields in X and Y direction for every well.
+    z_stacks, channels, timepoints : int
+        Number of Z, C and T for every field.
+    size : tuple
+        Image width and height.
+    pixels : bool
+        Write 8 bit OME-TIFFs with random noise. If falsy, empty files are
+        written, which is enough for crawling and parsing benchmarks.
+
+    Returns
+    -------
+    string
+        Path to experiment.
+    """
+    if pixels:
+        import numpy as np
+        from PIL import Image
+        rnd = np.random.RandomState(0)
+
+    path = os.path.join(root, 'experiment--bench')
+    slide = os.path.join(path, 'slide--S00')
+    for u in range(wells[0]):
+        for v in range(wells[1]):
+            chamber = os.path.join(
+                slide, 'chamber--U{:02d}--V{:02d}'.format(u, v))
+            for x in range(fields[0]):
+                for y in range(fields[1]):
+                    field = os.path.join(
+                        chamber, 'field--X{:02d}--Y{:02d}'.format(x, y))
+                    os.makedirs(field)
+                    for t in range(timepoints):
+                        for z in range(z_stacks):
+                            for c in range(channels):
+                                filename = os.path.join(field, (
+                                    'image--L00--S00--U{:02d}--V{:02d}--J20'
+                                    '--E00--O00--X{:02d}--Y{:02d}--T{:02d}'
+                                    '--Z{:02d}--C{:02d}.ome.tif').format(
+                                        u, v, x, y, t, z, c))
+                                if pixels:
+                                    data = rnd.randint(0, 32, size[::-1])
+                                    Image.fromarray(data.astype('uint8'))\
+                                        .save(filename)
+                                else:
+                                    open(filename, 'w').close()
+    return path
@@ -0,0 +1,52 @@
+"""Benchmark CAM round trips against a local simulator."""
+import pytest
+
+from matrixscreener.cam import CAM, CAMPool
+from simulator import CAMSimulator
+
+
+@pytest.fixture
+def simulator():
+    with CAMSimulator() as sim:
+        yield sim
+
+
+@pytest.fixture
+def cam(simulator):
+    cam = CAM(simulator.host, simulator.port)
+    cam.delay = 0
+    yield cam
+    cam.close()
+
+
+def test_round_trip(benchmark, cam):
+    "Send command and receive echo."
+    response = benchmark(cam.send, [('cmd', 'enableall'), ('value', 'true')])
+    assert response[0]['cmd'] == 'enableall'
+
+
+def test_get_information(benchmark, cam):
+    "Uncached getinfo."
+    info = benchmark(cam.get_information, 'stage', max_age=0)
+    assert info['dev'] == 'stage'
+
+
+def test_get_information_cached(benchmark, cam):
+    "Cached getinfo."
+    info = benchmark(cam.get_information, 'stage')
+    assert info['dev'] == 'stage'
+
+
+def test_pool_broadcast(benchmark):
+    "Send command to four simulators in parallel."
+    sims = [CAMSimulator().__enter__() for _ in range(4)]
+    try:
+        with CAMPool([(s.host, s.port) for s in sims]) as pool:
+            for conn in pool.connections.values():
+                conn.submit([('cmd', 'getinfo')]).result()
+                conn.cam.delay = 0
+            responses = benchmark(pool.broadcast, [('cmd', 'startscan')])
+    finally:
+        for sim in sims:
+            sim.stop()
+    assert len(responses) == 4
@@ -0,0 +1,56 @@
+"""Benchmark crawling, attribute parsing, compression and multiprocessing."""
+import pytest
+
+from matrixscreener import experiment, utils
+
+
+def test_images(benchmark, plate):
+    "Glob all images of plate."
+    images = benchmark(lambda: plate.images)
+    assert len(images) > 0
+
+
+def test_wells_fields(benchmark, plate):
+    "Glob wells and fields of plate."
+    benchmark(lambda: (plate.wells, plate.fields))
+
+
+def test_attributes(benchmark, plate):
+    "Parse attributes of all images in plate."
+    images = plate.images
+    benchmark(lambda: [experiment.attributes(i) for i in images])
+
+
+@pytest.mark.parametrize('prefetch', [0, 2, 4])
+def test_compress(benchmark, pixel_plate, output, prefetch):
+    "Compress 16 images of 512x512 in one process."
+    tifs = pixel_plate.images
+    pngs = benchmark.pedantic(experiment.compress_blocking, args=(tifs,),
+                              kwargs={'folder': output.folder,
+                                      'prefetch': prefetch},
+                              setup=output, rounds=5)
+    assert len(pngs) == len(tifs)
+
+
+def test_decompress(benchmark, pixel_plate, tmpdir, output):
+    "Decompress 16 images of 512x512 in one process."
+    pngs = experiment.compress_blocking(pixel_plate.images,
+                                        folder=tmpdir.mkdir('pngs').strpath)
+    tifs = benchmark.pedantic(experiment.decompress, args=(pngs,),
+                              kwargs={'folder': output.folder},
+                              setup=output, rounds=5)
+    assert len(tifs) == len(pngs)
+
+
+def _square(numbers):
+    "Work load for apply_async benchmark."
+    return [sum(i * i for i in range(n)) for n in numbers]
+
+
+@pytest.mark.parametrize('pools', [1, 2, 4])
+def test_apply_async(benchmark, monkeypatch, pools):
+    "Scaling of apply_async with number of pools."
+    monkeypatch.setattr(utils, '_pools', pools)
+    work = [20000] * 64
+    result = benchmark(utils.apply_async, _square, numbers=(work, True))
+    assert len(result) == len(work)
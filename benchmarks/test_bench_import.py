@@ -0,0 +1,19 @@
+"""Benchmark import time of matrixscreener, as paid by short lived jobs."""
+import subprocess
+import sys
+
+import pytest
+
+
+@pytest.mark.parametrize('module', ['matrixscreener',
+                                    'matrixscreener.cam',
+                                    'matrixscreener.experiment'])
+def test_import(benchmark, module):
+    "Start python and import module."
+    benchmark(subprocess.check_call, [sys.executable, '-c',
+                                      'import ' + module])
+
+
+def test_import_baseline(benchmark):
+    "Start python without importing anything, for reference."
+    benchmark(subprocess.check_call, [sys.executable, '-c', 'pass'])
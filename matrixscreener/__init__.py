@@ -1,7 +1,20 @@
 """
 Interfacing with Leica LAS AF MatrixScreener.
 """
-__all__ = [ 'cam', 'experiment', 'utils']
-from matrixscreener import cam, experiment, utils
+import sys
+
+__all__ = [ 'cam', 'experiment', 'pipeline', 'utils']
 
 VERSION = '0.6.1'
+
+if sys.version_info < (3, 7):
+    from matrixscreener import cam, experiment, pipeline, utils
+else:
+    # import submodules on first access, such that
+    # `import matrixscreener.cam` does not load experiment and friends
+    def __getattr__(name):
+        if name in __all__:
+            import importlib
+            return importlib.import_module('matrixscreener.' + name)
+        raise AttributeError(
+            "module 'matrixscreener' has no attribute '{}'".format(name))
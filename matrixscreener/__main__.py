@@ -0,0 +1,6 @@
+"""Run command line interface with ``python -m matrixscreener``."""
+import sys
+
+from matrixscreener.cli import main
+
+sys.exit(main())
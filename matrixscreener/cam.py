@@ -1,9 +1,15 @@
 """Control microscope through LASAF Computer Assisted Microscopy."""
 import select
 import socket
+import threading
 from collections import OrderedDict
 from time import sleep, time
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 import pydebug
 
 # debug with `DEBUG=matrixscreener python script.py`
@@ -24,6 +30,12 @@ class CAM(object):
         self.buffer_size = 1024
         self.delay = 5e-2  # wait 50ms after sending commands
         self.timeout = 10.0
+        self.info_ttl = 0.5  # seconds getinfo responses are cached
+        self.timed_out = False  # last receive got nothing before timeout
+        self.delivered = False  # last command was written to socket
+        self.metrics = CAMMetrics()
+        self._info_cache = {}
+        self._scanning = False
         self.connect()
 
     def connect(self):
@@ -35,13 +47,25 @@ class CAM(object):
         self.welcome_msg = self.socket.recv(
             self.buffer_size)  # receive welcome message
 
+    def close(self):
+        """Close the CAM-socket."""
+        if self.socket:
+            self.socket.close()
+            self.socket = None
+
     def flush(self):
         """Flush incomming socket messages."""
         DEBUG('flushing incomming socket messages')
         try:
             while True:
                 msg = self.socket.recv(self.buffer_size)
+                if not msg:
+                    break
                 DEBUG(b'< ' + msg)
+                self.metrics.received(len(msg))
+                self.metrics.flushed(len(msg.splitlines()))
+                if b'scanfinished' in msg:
+                    self._scanning = False
         except socket.error:
             pass
 
@@ -72,34 +96,64 @@ class CAM(object):
         else:
             msg = tuples_as_bytes(self.prefix + commands)
         DEBUG(b'> ' + msg)
+        begin = time()
+        self.delivered = False
         self.socket.send(msg)
+        self.delivered = True
+        self.metrics.sent(len(msg))
         if delay:
             sleep(delay)
         else:
             sleep(self.delay)
-        return self.receive()
+        response = self.receive()
+        cmd = _command_name(msg)
+        self.metrics.command(cmd, time() - begin, self.timed_out)
+        if cmd != 'getinfo':
+            # command might change state, discard cached information
+            self._info_cache.clear()
+            if cmd in _SCAN_START:
+                self._scanning = True
+            elif cmd in _SCAN_STOP:
+                self._scanning = False
+        return response
 
     def receive(self):
-        """Receive message from socket interface as list of OrderedDict."""
+        """Receive message from socket interface as list of OrderedDict.
+
+        Returns an empty list if nothing was received before ``timeout``
+        seconds, and sets ``timed_out``. Returns None if the connection is
+        closed.
+        """
         begin = time()
         incomming = ''
-        while self.socket:
+        self.timed_out = False
+        while True:
+            if not self.socket:
+                return None
             if time() - begin > self.timeout:
+                self.timed_out = True
                 break
             try:
                 if not self._check_socket():
                     sleep(0.02)
                     continue
                 incomming = self.socket.recv(self.buffer_size)
+                if not incomming:
+                    # readable but empty, remote end closed connection
+                    return None
                 DEBUG(b'< ' + incomming)
+                self.metrics.received(len(incomming))
                 break
             except socket.error:
                 return None
 
         # split received messages
         # return as list of several messages received
-        msgs = incomming.splitlines()
-        return [bytes_as_dict(msg) for msg in msgs]
+        msgs = [bytes_as_dict(msg) for msg in incomming.splitlines()]
+        if any(msg.get('inf') == 'scanfinished' for msg in msgs):
+            # scan finished by itself, information can be cached again
+            self._scanning = False
+        return msgs
 
     # convinience functions for commands
     def start_scan(self):
@@ -155,6 +209,42 @@ class CAM(object):
         cmd = [('cmd', 'enableall'), ('value', 'false')]
         return self.send(cmd)
 
+    def send_many(self, commands, delay=None):
+        """Send several commands in one message, one command per line, such
+        that they cost one round trip instead of one each.
+
+        Parameters
+        -----------
+        commands : list of lists of tuples
+            Example: [[('cmd', 'deletelist')], cam_list_add(fieldx=2)]
+
+        Returns
+        -------
+        list of OrderedDict
+            Responses received, see :meth:`send`.
+        """
+        if not commands:
+            return []
+        msg = (b'\n' + self.prefix_bytes).join(
+            tuples_as_bytes(cmd) for cmd in commands)
+        return self.send(msg, delay)
+
+    def delete_list(self):
+        """Delete all jobs in the CAM list."""
+        cmd = [('cmd', 'deletelist')]
+        return self.send(cmd)
+
+    def start_cam_scan(self, runtime=36000, repeattime=36000):
+        """Start scan of jobs in the CAM list."""
+        cmd = [
+            ('cmd', 'startcamscan'),
+            ('runtime', str(runtime)),
+            ('repeattime', str(repeattime)),
+            ('afr', 'none'),
+            ('afw', 'none')
+        ]
+        return self.send(cmd)
+
     def save_template(self, filename="{ScanningTemplate}matrixscreener.xml"):
         """Save scanning template to filename."""
         cmd = [
@@ -176,23 +266,660 @@ class CAM(object):
         ]
         return self.send(cmd)
 
-    def get_information(self, about='stage'):
-        """Get information about given keyword. Defaults to stage."""
+    def get_information(self, about='stage', max_age=None):
+        """Get information about given keyword. Defaults to stage.
+
+        Responses are cached for ``CAM.info_ttl`` seconds. The cache is
+        cleared when any other command is sent, and is not used while a
+        scan started by this instance is running, as the microscope then
+        changes state by itself. The scan is considered done when a
+        ``scanfinished`` message is received, or ``scanstatus`` reports that
+        no scan is running. ``scanstatus`` is never cached.
+
+        Parameters
+        ----------
+        about : string
+            Device, see ``cam_commands.md``. Example: stage, zdrive,
+            scanstatus, joblist.
+        max_age : float
+            Accept cached response of at most max_age seconds. Defaults to
+            ``CAM.info_ttl``, 0 always asks LASAF.
+
+        Returns
+        -------
+        Information
+            First response as an OrderedDict of strings, subclass given by
+            ``INFORMATION_TYPES[about]`` with parsed values as attributes.
+            None if no response.
+        """
+        about = str(about)
+        if max_age is None:
+            max_age = self.info_ttl
+        cacheable = (max_age > 0 and not self._scanning and
+                     about not in _NOT_CACHED)
+        if cacheable and about in self._info_cache:
+            timestamp, info = self._info_cache[about]
+            if time() - timestamp <= max_age:
+                return info
+
         cmd = [
             ('cmd', 'getinfo'),
-            ('dev', str(about))
+            ('dev', about)
         ]
         response = self.send(cmd)
-        if len(response) == 0:
+        if not response:
             return None
+        # assume we want first response
+        info = INFORMATION_TYPES.get(about, Information)(response[0])
+        if isinstance(info, ScanStatusInformation) and info.status:
+            self._scanning = info.scanning
+        if about not in _NOT_CACHED and not self._scanning:
+            self._info_cache[about] = (time(), info)
+        return info
+
+    def stats(self, format=None):
+        """Latency and throughput of commands sent through this instance.
+
+        Parameters
+        ----------
+        format : string
+            None for an OrderedDict, ``'prometheus'`` for Prometheus text
+            exposition format or ``'json'`` for a JSON string.
+
+        Returns
+        -------
+        OrderedDict or string
+            See :meth:`CAMMetrics.as_dict` for keys.
+        """
+        if format == 'prometheus':
+            return self.metrics.prometheus(host=self.host, port=self.port)
+        elif format == 'json':
+            import json
+            return json.dumps(self.metrics.as_dict())
+        return self.metrics.as_dict()
+
+    def trace(self, filename):
+        """Append every command to filename as a JSON line with keys time,
+        host, port, cmd, latency, sent, received and timeout. Give None to
+        stop tracing."""
+        self.metrics.trace(filename, host=self.host, port=self.port)
+
+
+class Information(OrderedDict):
+    """Response to ``getinfo`` as an OrderedDict of strings.
+
+    Values are also available as attributes, parsed to int or float when
+    they are numeric. Example: ``info['xpos'] == '1000'`` and
+    ``info.xpos == 1000``.
+    """
+
+    device = None
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name not in self:
+            raise AttributeError(name)
+        return parse_value(self[name])
+
+    def parsed(self):
+        """Values parsed to int or float as an OrderedDict."""
+        return OrderedDict((k, parse_value(v)) for k, v in self.items())
+
+
+class StageInformation(Information):
+    """Response to ``getinfo`` for the stage."""
+
+    device = 'stage'
+
+    @property
+    def position(self):
+        "Tuple (xpos, ypos), None for missing values."
+        return (parse_value(self.get('xpos')), parse_value(self.get('ypos')))
+
+
+class ZDriveInformation(Information):
+    """Response to ``getinfo`` for the z-drive."""
+
+    device = 'zdrive'
+
+    @property
+    def position(self):
+        "Parsed zpos, None if missing."
+        return parse_value(self.get('zpos'))
+
+
+class ScanStatusInformation(Information):
+    """Response to ``getinfo`` for the scan status."""
+
+    device = 'scanstatus'
+
+    @property
+    def status(self):
+        "Status as a lower case string, None if missing."
+        status = self.get('status', self.get('scanstatus'))
+        return status.lower() if status is not None else None
+
+    @property
+    def scanning(self):
+        "True if status tells that a scan is running."
+        return self.status in ('running', 'started', 'scanning')
+
+
+class JobListInformation(Information):
+    """Response to ``getinfo`` for the job list."""
+
+    device = 'joblist'
+
+    @property
+    def jobs(self):
+        "Job names, values of keys starting with job."
+        return [v for k, v in self.items() if k.startswith('job')]
+
+
+# response type for getinfo devices, other devices use Information
+INFORMATION_TYPES = {
+    'stage': StageInformation,
+    'zdrive': ZDriveInformation,
+    'scanstatus': ScanStatusInformation,
+    'joblist': JobListInformation,
+}
+
+# getinfo devices which are never cached
+_NOT_CACHED = ('scanstatus',)
+
+# commands starting and stopping scans
+_SCAN_START = ('startscan', 'startcamscan', 'autofocusscan')
+_SCAN_STOP = ('stopscan', 'stopcamscan')
+
+
+class CAMMetrics(object):
+    """Counters and latency histograms for CAM commands.
+
+    Latency is measured from command is sent until response is received,
+    including the delay given to :meth:`CAM.send`.
+    """
+
+    # upper bounds of latency histogram in seconds
+    buckets = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+               float('inf'))
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._trace = None
+        self._trace_labels = {}
+        self._last = OrderedDict()
+        self.commands = OrderedDict()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.timeouts = 0
+        self.flushed_messages = 0
+        self.reconnects = 0
+
+    def sent(self, nbytes):
+        with self._lock:
+            self.bytes_sent += nbytes
+            self._last['sent'] = nbytes
+            self._last['received'] = 0
+
+    def received(self, nbytes):
+        with self._lock:
+            self.bytes_received += nbytes
+            self._last['received'] = self._last.get('received', 0) + nbytes
+
+    def flushed(self, messages):
+        with self._lock:
+            self.flushed_messages += messages
+
+    def reconnected(self):
+        with self._lock:
+            self.reconnects += 1
+
+    def command(self, cmd, latency, timeout=False):
+        """Record round trip of command cmd."""
+        with self._lock:
+            if cmd not in self.commands:
+                self.commands[cmd] = OrderedDict([
+                    ('count', 0), ('sum', 0.0),
+                    ('min', float('inf')), ('max', 0.0),
+                    ('buckets', [0] * len(self.buckets))])
+            hist = self.commands[cmd]
+            hist['count'] += 1
+            hist['sum'] += latency
+            hist['min'] = min(hist['min'], latency)
+            hist['max'] = max(hist['max'], latency)
+            for i, bound in enumerate(self.buckets):
+                if latency <= bound:
+                    hist['buckets'][i] += 1
+                    break
+            if timeout:
+                self.timeouts += 1
+            if self._trace:
+                import json
+                line = OrderedDict([('time', time())])
+                line.update(self._trace_labels)
+                line['cmd'] = cmd
+                line['latency'] = latency
+                line['sent'] = self._last.get('sent', 0)
+                line['received'] = self._last.get('received', 0)
+                line['timeout'] = bool(timeout)
+                self._trace.write(json.dumps(line) + '\n')
+                self._trace.flush()
+
+    def trace(self, filename, **labels):
+        """Write commands to filename as JSON lines, None stops tracing."""
+        with self._lock:
+            if self._trace:
+                self._trace.close()
+                self._trace = None
+            if filename:
+                self._trace = open(filename, 'a')
+                self._trace_labels = labels
+
+    def as_dict(self):
+        """Metrics as an OrderedDict with keys commands, bytes_sent,
+        bytes_received, timeouts, flushed_messages and reconnects.
+        Commands holds count, sum, min, max and histogram buckets (not
+        cumulative) of latency for every command."""
+        with self._lock:
+            commands = OrderedDict()
+            for cmd, hist in self.commands.items():
+                hist = OrderedDict(hist)
+                hist['buckets'] = list(zip(
+                    [str(b) for b in self.buckets], hist['buckets']))
+                commands[cmd] = hist
+            return OrderedDict([
+                ('commands', commands),
+                ('bytes_sent', self.bytes_sent),
+                ('bytes_received', self.bytes_received),
+                ('timeouts', self.timeouts),
+                ('flushed_messages', self.flushed_messages),
+                ('reconnects', self.reconnects)])
+
+    def prometheus(self, **labels):
+        """Metrics in Prometheus text exposition format."""
+        return _prometheus([(self.as_dict(), labels)])
+
+
+class CAMPool(object):
+    """Pool of CAM connections to several LASAF instances.
+
+    Every connection has its own command queue and worker thread, such that a
+    microscope which is slow or disconnected does not hold up the others.
+    Lost connections are reconnected with exponential backoff, and the welcome
+    handshake is received again on every reconnect.
+
+    Parameters
+    ----------
+    addresses : list of tuples
+        Host and port of every LASAF instance.
+        Example: [('10.0.0.1', 8895), ('10.0.0.2', 8895)]
+    retries : int
+        How many times a command is retried after reconnecting. Commands
+        are only retried if the connection failed before they were sent,
+        unless they are submitted with ``replay=True``.
+    backoff : float
+        Seconds to wait before first reconnect, doubled for every failed
+        attempt.
+    backoff_max : float
+        Maximum seconds to wait between reconnects.
+    health_interval : float
+        Seconds of idle time before the connection is checked with a
+        ``getinfo`` command. Set to ``None`` to disable health checks.
+
+    Example
+    -------
+    >>> pool = CAMPool([('10.0.0.1', 8895), ('10.0.0.2', 8895)])
+    >>> future = pool.submit(('10.0.0.1', 8895), [('cmd', 'startscan')])
+    >>> response = future.result()
+    >>> pool.close()
+    """
+
+    def __init__(self, addresses, retries=3, backoff=0.5, backoff_max=30.0,
+                 health_interval=10.0):
+        """Set up instance and start one worker per address."""
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.health_interval = health_interval
+        self.connections = OrderedDict()
+        for host, port in addresses:
+            conn = _PoolConnection(self, host, port)
+            self.connections[(host, port)] = conn
+            conn.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def submit(self, address, commands, delay=None, replay=False):
+        """Queue commands for the connection at address.
+
+        Parameters
+        ----------
+        address : tuple
+            Host and port of LASAF instance.
+        commands : list of tuples or bytes string
+            Same as for :meth:`CAM.send`.
+        delay : float
+            Same as for :meth:`CAM.send`.
+        replay : bool
+            Send commands again if the connection is lost after they were
+            sent, before a response is received. Only for commands which
+            can be run twice, such as ``getinfo``. Otherwise the future
+            fails with ``socket.error``, as the microscope might have run the
+            commands.
+
+        Returns
+        -------
+        concurrent.futures.Future
+            Resolves to the response of :meth:`CAM.send`.
+        """
+        return self.connections[tuple(address)].submit(commands, delay,
+                                                       replay)
+
+    def send(self, address, commands, delay=None, replay=False):
+        """Send commands to address and wait for the response, see
+        :meth:`submit`."""
+        return self.submit(address, commands, delay, replay).result()
+
+    def broadcast(self, commands, delay=None, replay=False):
+        """Send commands to all connections in parallel, see :meth:`submit`.
+
+        Returns
+        -------
+        OrderedDict
+            Response or exception for every address.
+        """
+        futures = OrderedDict(
+            (address, self.submit(address, commands, delay, replay))
+            for address in self.connections)
+        responses = OrderedDict()
+        for address, future in futures.items():
+            try:
+                responses[address] = future.result()
+            except Exception as e:
+                responses[address] = e
+        return responses
+
+    def status(self):
+        """Connection state for every address as an OrderedDict with keys
+        ``connected``, ``reconnects`` and ``queued``."""
+        return OrderedDict((address, conn.status())
+                           for address, conn in self.connections.items())
+
+    def stats(self, format=None):
+        """Metrics for every address, see :meth:`CAM.stats`.
+
+        Returns
+        -------
+        OrderedDict or string
+            OrderedDict with metrics of every address, or all addresses
+            concatenated if format is ``'prometheus'``.
+        """
+        if format == 'prometheus':
+            return _prometheus([(conn.metrics.as_dict(),
+                                 {'host': conn.host, 'port': conn.port})
+                                for conn in self.connections.values()])
+        stats = OrderedDict((address, conn.metrics.as_dict())
+                            for address, conn in self.connections.items())
+        if format == 'json':
+            import json
+            return json.dumps([{'host': a[0], 'port': a[1], 'stats': v}
+                               for a, v in stats.items()])
+        return stats
+
+    def close(self):
+        """Stop all workers and close their sockets."""
+        for conn in self.connections.values():
+            conn.stop()
+        for conn in self.connections.values():
+            conn.join()
+
+
+class _PoolConnection(threading.Thread):
+    """Worker thread owning one CAM connection of a :class:`CAMPool`."""
+
+    def __init__(self, pool, host, port):
+        threading.Thread.__init__(self, name='CAM {}:{}'.format(host, port))
+        self.daemon = True
+        self.pool = pool
+        self.host = host
+        self.port = port
+        self.cam = None
+        self.connects = 0
+        self.metrics = CAMMetrics()
+        self.queue = queue.Queue()
+        self._stop_event = threading.Event()
+
+    def submit(self, commands, delay=None, replay=False):
+        from concurrent.futures import Future
+        future = Future()
+        if self._stop_event.is_set():
+            future.set_exception(RuntimeError('CAMPool is closed'))
         else:
-            return response[0]  # assume we want first response
+            self.queue.put((future, commands, delay, replay))
+        return future
+
+    def status(self):
+        return OrderedDict([('connected', self.cam is not None),
+                            ('reconnects', max(0, self.connects - 1)),
+                            ('queued', self.queue.qsize())])
+
+    def stop(self):
+        self._stop_event.set()
+        self.queue.put(None)  # wake up worker
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                item = self.queue.get(timeout=self.pool.health_interval)
+            except queue.Empty:
+                self._health_check()
+                continue
+            if item is None:
+                break
+            future, commands, delay, replay = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(self._send(commands, delay, replay))
+            except Exception as e:
+                future.set_exception(e)
+        self._disconnect()
+        # fail commands left in queue
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None and item[0].set_running_or_notify_cancel():
+                item[0].set_exception(RuntimeError('CAMPool is closed'))
+
+    def _send(self, commands, delay, replay=False):
+        """Send commands, reconnect and retry on socket errors. Commands
+        which were sent are only sent again if replay is given."""
+        attempt = 0
+        while True:
+            delivered = False
+            try:
+                self._connect()
+                try:
+                    response = self.cam.send(commands, delay)
+                finally:
+                    delivered = self.cam.delivered
+                if response is None:
+                    raise socket.error('connection to {}:{} lost'
+                                       .format(self.host, self.port))
+                return response
+            except socket.error as e:
+                DEBUG('{}:{} {}'.format(self.host, self.port, e))
+                self._disconnect()
+                if delivered and not replay:
+                    raise socket.error(
+                        'connection to {}:{} lost after sending command, not '
+                        'sent again: {}'.format(self.host, self.port, e))
+                attempt += 1
+                if attempt > self.pool.retries or self._stop_event.is_set():
+                    raise
+
+    def _connect(self):
+        """Connect with exponential backoff, receiving welcome message."""
+        attempt = 0
+        while self.cam is None:
+            if self._stop_event.is_set():
+                raise socket.error('CAMPool is closed')
+            try:
+                self.cam = CAM(self.host, self.port)
+            except socket.error as e:
+                wait = min(self.pool.backoff_max,
+                           self.pool.backoff * 2 ** attempt)
+                DEBUG('{}:{} connect failed ({}), retry in {}s'
+                      .format(self.host, self.port, e, wait))
+                attempt += 1
+                self._stop_event.wait(wait)
+                continue
+            DEBUG('{}:{} welcome {!r}'.format(self.host, self.port,
+                                               self.cam.welcome_msg))
+            # keep metrics across reconnects
+            self.cam.metrics = self.metrics
+            if self.connects:
+                self.metrics.reconnected()
+            self.connects += 1
+
+    def _disconnect(self):
+        if self.cam is not None:
+            try:
+                self.cam.close()
+            except socket.error:
+                pass
+            self.cam = None
+
+    def _health_check(self):
+        """Check idle connection, reconnect if it is lost."""
+        if self.cam is None:
+            return
+        try:
+            response = self.cam.send([('cmd', 'getinfo'),
+                                      ('dev', 'scanstatus')])
+        except socket.error:
+            response = None
+        if response is None or self.cam.timed_out:
+            DEBUG('{}:{} failed health check'.format(self.host, self.port))
+            self._disconnect()
+            try:
+                self._connect()
+            except socket.error:
+                pass
 
 
 ##
 # Helper methods
 ##
 
+def _prometheus(metrics):
+    """Prometheus text exposition format of several CAMMetrics.as_dict()
+    given as list of tuples (stats, labels)."""
+    def label(labels, **extra):
+        pairs = ['{}="{}"'.format(k, v) for k, v in labels.items()]
+        pairs.extend('{}="{}"'.format(k, v) for k, v in extra.items())
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    lines = []
+    counters = [
+        ('bytes_sent', 'Bytes sent to LASAF.'),
+        ('bytes_received', 'Bytes received from LASAF.'),
+        ('timeouts', 'Commands without response before timeout.'),
+        ('flushed_messages', 'Messages discarded before sending.'),
+        ('reconnects', 'Reconnects to LASAF.')]
+    for key, helptext in counters:
+        name = 'matrixscreener_cam_' + key + '_total'
+        lines.append('# HELP {} {}'.format(name, helptext))
+        lines.append('# TYPE {} counter'.format(name))
+        for stats, labels in metrics:
+            lines.append('{}{} {}'.format(name, label(labels), stats[key]))
+
+    name = 'matrixscreener_cam_command_seconds'
+    lines.append('# HELP {} Round trip latency of commands.'.format(name))
+    lines.append('# TYPE {} histogram'.format(name))
+    for stats, labels in metrics:
+        for cmd, hist in stats['commands'].items():
+            cumulative = 0
+            for bound, count in hist['buckets']:
+                cumulative += count
+                le = '+Inf' if bound == 'inf' else bound
+                lines.append('{}_bucket{} {}'.format(
+                    name, label(labels, cmd=cmd, le=le), cumulative))
+            lines.append('{}_sum{} {}'.format(
+                name, label(labels, cmd=cmd), hist['sum']))
+            lines.append('{}_count{} {}'.format(
+                name, label(labels, cmd=cmd), hist['count']))
+    return '\n'.join(lines) + '\n'
+
+
+def parse_value(value):
+    """Parse string to int or float if possible, otherwise return value.
+
+    Parameters
+    ----------
+    value : string
+
+    Returns
+    -------
+    int, float or string
+    """
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def cam_list_add(job='job1', slide=0, wellx=1, welly=1, fieldx=1, fieldy=1,
+                 dxpos=0, dypos=0, autofocus=False):
+    """Command adding a job to the CAM list, for :meth:`CAM.send` or
+    :meth:`CAM.send_many`.
+
+    Parameters
+    ----------
+    job : string
+        Name of job in scanning template.
+    slide, wellx, welly, fieldx, fieldy : ints
+        Field to scan, wells and fields count from 1.
+    dxpos, dypos : numbers
+        Offset from center of field.
+    autofocus : bool
+        Run autofocus before scanning job.
+
+    Returns
+    -------
+    list of tuples
+    """
+    return [
+        ('cmd', 'add'),
+        ('tar', 'camlist'),
+        ('exp', str(job)),
+        ('ext', 'af' if autofocus else 'none'),
+        ('slide', str(slide)),
+        ('wellx', str(wellx)),
+        ('welly', str(welly)),
+        ('fieldx', str(fieldx)),
+        ('fieldy', str(fieldy)),
+        ('dxpos', str(dxpos)),
+        ('dypos', str(dypos))
+    ]
+
+
+def _command_name(msg):
+    "Value of /cmd: in CAM message bytes, empty string if missing."
+    return bytes_as_dict(msg).get('cmd', '')
+
+
 def tuples_as_bytes(cmds):
     """Format list of tuples to CAM message with format /key:val.
 
@@ -0,0 +1,331 @@
+# encoding: utf-8
+"""
+Export experiments to one chunked array with axes (well, field, T, Z, C, Y,
+X), stored in the Zarr v2 directory format: a ``.zarray`` with shape, chunks
+and dtype, and one zlib compressed file per chunk. The store can be read with
+:class:`ChunkedArray` or any Zarr v2 reader, without opening every image file.
+
+Wells and fields are indexed in the order they are first exported, and their
+names are stored in ``.zattrs``. T, Z and C are indexed by their attribute
+value.
+
+Example
+-------
+>>> from matrixscreener.experiment import Experiment
+>>> array = Experiment('/path/to/experiment').to_chunked('/path/to/store')
+>>> array.shape
+(1, 2, 1, 1, 2, 1024, 1024)
+>>> field = array[0, 1, 0, 0, :, 100:200, 100:200]
+"""
+import os, json, zlib, pydebug
+from itertools import product
+from .utils import apply_async
+from .storage import temporary
+
+debug = pydebug.debug('matrixscreener')
+
+AXES = ['well', 'field', 'T', 'Z', 'C', 'Y', 'X']
+
+
+class ChunkedArray(object):
+    """Lazy reader of chunked array store. Chunks are read when sliced, such
+    that several processes can read different parts of the store at once.
+
+    Parameters
+    ----------
+    path : string
+        Path to store.
+
+    Attributes
+    ----------
+    shape, chunks : tuples
+        Shape of array and of every chunk.
+    dtype : numpy.dtype
+    attrs : dict
+        ``axes``, ``wells`` and ``fields``.
+    """
+
+    def __init__(self, path):
+        import numpy as np
+        self.path = path
+        with open(os.path.join(path, '.zarray')) as f:
+            meta = json.load(f)
+        self.shape = tuple(meta['shape'])
+        self.chunks = tuple(meta['chunks'])
+        self.dtype = np.dtype(meta['dtype'])
+        self.fill_value = meta['fill_value'] or 0
+        self.attrs = {}
+        if os.path.isfile(os.path.join(path, '.zattrs')):
+            with open(os.path.join(path, '.zattrs')) as f:
+                self.attrs = json.load(f)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return 'matrixscreener.ChunkedArray({}, shape={}, dtype={})'.format(
+            self.path, self.shape, self.dtype)
+
+    def __getitem__(self, key):
+        import numpy as np
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > self.ndim:
+            raise IndexError('too many indices for array')
+        key = key + (slice(None),) * (self.ndim - len(key))
+
+        ranges, steps, drop = [], [], []
+        for i, (k, size) in enumerate(zip(key, self.shape)):
+            if isinstance(k, slice):
+                start, stop, step = k.indices(size)
+                if step < 0:
+                    raise IndexError('negative steps are not supported')
+                ranges.append((start, max(start, stop)))
+                steps.append(slice(None, None, step))
+            else:
+                k = int(k)
+                if k < 0:
+                    k += size
+                if not 0 <= k < size:
+                    raise IndexError('index {} is out of bounds for axis {} '
+                                     'with size {}'.format(k, i, size))
+                ranges.append((k, k + 1))
+                steps.append(slice(None))
+                drop.append(i)
+
+        out = np.empty([stop - start for start, stop in ranges],
+                       dtype=self.dtype)
+        out.fill(self.fill_value)
+        chunk_ranges = [range(start // c, -(-stop // c)) if stop > start
+                        else range(0)
+                        for (start, stop), c in zip(ranges, self.chunks)]
+        for index in product(*chunk_ranges):
+            chunk = self.read_chunk(index)
+            if chunk is None:
+                continue
+            src, dst = [], []
+            for i, c, (start, stop) in zip(index, self.chunks, ranges):
+                lo = max(start, i * c)
+                hi = min(stop, (i + 1) * c)
+                src.append(slice(lo - i * c, hi - i * c))
+                dst.append(slice(lo - start, hi - start))
+            out[tuple(dst)] = chunk[tuple(src)]
+        out = out[tuple(steps)]
+        if drop:
+            out = out.reshape([n for i, n in enumerate(out.shape)
+                               if i not in drop])
+        return out
+
+    def read_chunk(self, index):
+        """Read and decompress one chunk.
+
+        Parameters
+        ----------
+        index : tuple of ints
+            Chunk index.
+
+        Returns
+        -------
+        numpy.ndarray or None
+            None if chunk is not written.
+        """
+        import numpy as np
+        filename = os.path.join(self.path, _chunk_key(index))
+        if not os.path.isfile(filename):
+            return None
+        with open(filename, 'rb') as f:
+            data = zlib.decompress(f.read())
+        return np.frombuffer(data, dtype=self.dtype).reshape(self.chunks)
+
+
+def export(images, path, chunks=(512, 512), level=6, flatfield=None):
+    """Write images to chunked array store, see :class:`ChunkedArray`.
+
+    If store exists, the array is grown to fit new wells, fields, time points,
+    z-stacks and channels. Chunks which are newer than their image are not
+    written again, such that new time points can be appended by exporting
+    again while scanning.
+
+    Parameters
+    ----------
+    images : list of filenames
+        Images of experiment. If both TIFF and PNG of an image exists, TIFF
+        is used.
+    path : string
+        Where to store array.
+    chunks : tuple of ints
+        Chunk size in Y and X.
+    level : int
+        zlib compression level.
+    flatfield : dict
+        Channel -> flat-field profile, images are corrected when read, see
+        :func:`matrixscreener.flatfield.profiles`.
+
+    Returns
+    -------
+    ChunkedArray
+    """
+    from .experiment import attributes
+    from .flatfield import read
+
+    # one image per plane, prefer TIFF as in projections
+    planes = {}
+    for image in images:
+        stem = image.rsplit('.ome.tif', 1)[0].rsplit('.png', 1)[0]
+        if stem not in planes or image.endswith('.tif'):
+            planes[stem] = image
+    images = [planes[k] for k in sorted(planes)]
+    if not images:
+        raise ValueError('no images to export')
+
+    if os.path.isfile(os.path.join(path, '.zarray')):
+        array = ChunkedArray(path)
+        wells = array.attrs.get('wells', [])
+        fields = array.attrs.get('fields', [])
+        shape = list(array.shape)
+        dtype = array.dtype
+        chunks = array.chunks
+    else:
+        first = read(images[0])
+        wells, fields = [], []
+        shape = [0, 0, 0, 0, 0] + list(first.shape[:2])
+        dtype = first.dtype
+        chunks = (1, 1, 1, 1, 1) + tuple(chunks)
+
+    jobs = []
+    for image in images:
+        attr = attributes(image)
+        well = 'U{}--V{}'.format(attr.U, attr.V)
+        field = 'X{}--Y{}'.format(attr.X, attr.Y)
+        for name, names in ((well, wells), (field, fields)):
+            if name not in names:
+                names.append(name)
+        index = (wells.index(well), fields.index(field), attr.t, attr.z,
+                 attr.c)
+        shape[:5] = [max(n, i + 1) for n, i in zip(shape[:5], index)]
+        jobs.append((image, index))
+
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    _write_json(os.path.join(path, '.zarray'), {
+        'zarr_format': 2,
+        'shape': shape,
+        'chunks': list(chunks),
+        'dtype': dtype.str,
+        'compressor': {'id': 'zlib', 'level': level},
+        'fill_value': 0,
+        'order': 'C',
+        'filters': None,
+    })
+    _write_json(os.path.join(path, '.zattrs'), {
+        'axes': AXES,
+        'wells': wells,
+        'fields': fields,
+    })
+
+    debug('exporting {} images to {}'.format(len(jobs), path))
+    apply_async(export_blocking, jobs=(jobs, True), path=(path, False),
+                chunks=(chunks, False), level=(level, False),
+                flatfield=(flatfield, False))
+    return ChunkedArray(path)
+
+
+def export_blocking(jobs, path, chunks, level=6, flatfield=None):
+    """Write chunks of images.
+
+    Parameters
+    ----------
+    jobs : list of tuples
+        (image, (well, field, T, Z, C)) for every image.
+    path : string
+        Path to store.
+    chunks : tuple of ints
+        Chunk shape of store.
+    level : int
+        zlib compression level.
+    flatfield : dict
+        Channel -> flat-field profile.
+
+    Returns
+    -------
+    list of filenames
+        Images written, images with up to date chunks are omitted.
+
+    Raises
+    ------
+    ValueError
+        If an image has another Y/X shape than the array, or values outside
+        the range of its dtype.
+    """
+    import numpy as np
+    from .flatfield import read
+    from .experiment import _mtime
+
+    array = ChunkedArray(path)
+    cy, cx = chunks[-2:]
+    written = []
+    for image, index in jobs:
+        first = os.path.join(path, _chunk_key(tuple(index) + (0, 0)))
+        if (os.path.isfile(first) and
+                os.path.getmtime(first) >= (_mtime(image) or 0)):
+            continue
+        data = read(image, flatfield)
+        if data.shape != array.shape[-2:]:
+            raise ValueError('{} has shape {}, array {} has {}'.format(
+                image, data.shape, path, array.shape[-2:]))
+        data = _as_dtype(data, array.dtype, image)
+        tiles = [(y, x) for y in range(0, data.shape[0], cy)
+                 for x in range(0, data.shape[1], cx)]
+        # first chunk is written last, it marks image as written
+        for y, x in reversed(tiles):
+            tile = data[y:y + cy, x:x + cx]
+            if tile.shape != (cy, cx):
+                # edge chunks are stored with full size
+                padded = np.zeros((cy, cx), dtype=data.dtype)
+                padded[:tile.shape[0], :tile.shape[1]] = tile
+                tile = padded
+            key = _chunk_key(tuple(index) + (y // cy, x // cx))
+            _write_atomic(os.path.join(path, key), zlib.compress(
+                np.ascontiguousarray(tile).tobytes(), level))
+        written.append(image)
+    return written
+
+
+def _as_dtype(data, dtype, image):
+    """Image data as dtype of array, such that chunks have the byte length
+    of the array. Raises ValueError if values are out of range of dtype."""
+    import numpy as np
+    if data.dtype == dtype:
+        return data
+    if np.issubdtype(dtype, np.integer):
+        if not np.issubdtype(data.dtype, np.integer):
+            data = np.rint(data)
+        info = np.iinfo(dtype)
+        if data.size and (data.min() < info.min or data.max() > info.max):
+            raise ValueError('{} has values {}..{}, outside range of {}'
+                             .format(image, data.min(), data.max(),
+                                     dtype.name))
+    return data.astype(dtype, copy=False)
+
+
+def _chunk_key(index):
+    "Filename of chunk with index."
+    return '.'.join(str(i) for i in index)
+
+
+def _write_atomic(filename, data):
+    "Write bytes through a temporary file."
+    tmp = temporary(filename)
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.rename(tmp, filename)
+
+
+def _write_json(filename, obj):
+    "Write json through a temporary file."
+    _write_atomic(filename, json.dumps(obj, indent=4,
+                                       sort_keys=True).encode('utf-8'))
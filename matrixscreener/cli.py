@@ -0,0 +1,435 @@
+# encoding: utf-8
+"""
+Command line interface for batch operations on experiments.
+
+Progress is written to stderr as JSON lines, such that it can be read by other
+programs. Example::
+
+    matrixscreener compress /path/to/experiment --workers 8 --chunk-size 16
+"""
+import argparse, json, os, sys, time
+
+from . import experiment as ms_experiment
+from .experiment import Experiment
+from .utils import _pools
+
+
+def main(argv=None):
+    """Entry point for the ``matrixscreener`` console script.
+
+    Parameters
+    ----------
+    argv : list of strings
+        Command line arguments, defaults to ``sys.argv[1:]``.
+
+    Returns
+    -------
+    int
+        Exit code.
+    """
+    from . import utils
+    args = parser().parse_args(argv)
+    if not hasattr(args, 'func'):
+        parser().print_help()
+        return 2
+    # workers and memory budget of every parallel operation
+    defaults = utils._pools, utils._memory_limit
+    args.workers = utils._pools = max(1, args.workers)
+    utils._memory_limit = getattr(args, 'memory_limit', None)
+    try:
+        if not getattr(args, 'profile', None):
+            return args.func(args) or 0
+
+        from . import profiling
+        folder = profiling.enable()
+        try:
+            return args.func(args) or 0
+        finally:
+            profiling.chrome_trace(args.profile, folder)
+            sys.stderr.write(profiling.summary(folder) + '\n')
+            profiling.disable()
+            import shutil
+            shutil.rmtree(folder, ignore_errors=True)
+    finally:
+        utils._pools, utils._memory_limit = defaults
+
+
+def parser():
+    "Argument parser for the command line interface."
+    p = argparse.ArgumentParser(
+        prog='matrixscreener',
+        description='Batch operations on Leica LAS AF MatrixScreener '
+                    'experiments. Progress is written to stderr as JSON '
+                    'lines.')
+    sub = p.add_subparsers(title='commands')
+
+    def add(name, func, help_):
+        cmd = sub.add_parser(name, help=help_, description=help_)
+        cmd.add_argument('path', help='path to experiment')
+        cmd.add_argument('--workers', type=int, default=_pools,
+                         help='number of worker processes '
+                              '(default: %(default)s)')
+        cmd.add_argument('--chunk-size', type=int, default=None,
+                         help='items sent to a worker at a time '
+                              '(default: spread evenly on 4 chunks per '
+                              'worker)')
+        cmd.add_argument('--memory-limit', type=parse_size, default=None,
+                         help='run chunks in parallel only while their '
+                              'estimated memory is below limit, example: 8G '
+                              '(default: half of available memory)')
+        cmd.add_argument('--profile', metavar='TRACE',
+                         help='time stages in all workers, write Chrome '
+                              'trace JSON to TRACE and summary table to '
+                              'stderr')
+        cmd.set_defaults(func=func)
+        return cmd
+
+    add('index', index, 'list images in experiment with attributes as '
+                        'JSON lines on stdout')
+
+    cmd = add('compress', compress, 'lossless compress images to PNG')
+    cmd.add_argument('--folder', help='where to store PNGs')
+    cmd.add_argument('--delete-tif', action='store_true',
+                     help='delete original images')
+    cmd.add_argument('--prefetch', type=int, default=2,
+                     help='files read ahead and written behind in every '
+                          'worker (default: %(default)s)')
+    cmd.add_argument('--dedup', action='store_true',
+                     help='store images with identical pixels once, '
+                          'deduplication ratio is written as JSON on stdout')
+
+    cmd = add('decompress', decompress, 'decompress PNGs to OME-TIFF')
+    cmd.add_argument('--folder', help='where to store OME-TIFFs')
+    cmd.add_argument('--delete-png', action='store_true',
+                     help='delete PNG images')
+    cmd.add_argument('--delete-json', action='store_true',
+                     help='delete TIFF-tags stored in json files')
+
+    cmd = add('pack', pack, 'pack every chamber into one uncompressed zip '
+                            'with random access to images')
+    cmd.add_argument('--delete', action='store_true',
+                     help='delete chamber folders after packing')
+
+    cmd = add('stitch', stitch, 'stitch wells with Fiji')
+    cmd.add_argument('--folder', help='where to store stitched images')
+    cmd.add_argument('--positions', choices=['registered', 'stage'],
+                     default=None,
+                     help='registered: compute overlap once per well and '
+                          'reuse it for all channels and z-stacks, stage: '
+                          'place tiles at stage positions (default: compute '
+                          'overlap for every channel and z-stack)')
+    cmd.add_argument('--retries', type=int, default=1,
+                     help='retries of failing wells (default: %(default)s)')
+    cmd.add_argument('--restart', action='store_true',
+                     help='stitch all wells, also wells done by an earlier '
+                          'run')
+
+    cmd = add('project', project, 'z-projection of fields')
+    cmd.add_argument('--folder', help='where to store projections')
+    cmd.add_argument('--method', choices=['max', 'min', 'mean'],
+                     default='max', help='projection (default: max)')
+    cmd.add_argument('--flatfield', action='store_true',
+                     help='correct illumination with flat-field profile of '
+                          'every channel')
+
+    cmd = add('preview', preview, 'downsampled previews of fields, wells '
+                                  'and plate')
+    cmd.add_argument('--folder', help='where to store previews (default: '
+                                      'previews in experiment)')
+    cmd.add_argument('--scale', type=float, default=0.1,
+                     help='size relative to images (default: %(default)s)')
+    cmd.add_argument('--flatfield', action='store_true',
+                     help='correct illumination with flat-field profile of '
+                          'every channel')
+
+    cmd = add('watch', watch, 'compress, project and stitch wells while '
+                              'scanning')
+    cmd.add_argument('--folder', help='where to store stitched images and '
+                                      'projections')
+    cmd.add_argument('--delete-tif', action='store_true',
+                     help='delete original images')
+    cmd.add_argument('--interval', type=float, default=5.0,
+                     help='seconds between polls (default: %(default)s)')
+    cmd.add_argument('--no-compress', action='store_true',
+                     help='do not compress wells')
+    cmd.add_argument('--no-stitch', action='store_true',
+                     help='do not stitch wells')
+    cmd.add_argument('--project', action='store_true',
+                     help='z-project fields of wells')
+
+    cmd = add('submit', submit, 'queue one work unit per well in a queue '
+                                'folder shared by several nodes')
+    cmd.add_argument('operation', choices=['compress', 'decompress', 'stitch'])
+    cmd.add_argument('--queue', required=True, help='queue folder')
+    cmd.add_argument('--folder', help='where to store output')
+    cmd.add_argument('--delete-tif', action='store_true',
+                     help='delete original images when compressing')
+
+    cmd = sub.add_parser('work', help='run work units from queue folder',
+                         description='run work units from queue folder')
+    cmd.add_argument('queue', help='queue folder')
+    cmd.add_argument('--workers', type=int, default=_pools,
+                     help='number of worker processes (default: %(default)s)')
+    cmd.add_argument('--wait', action='store_true',
+                     help='wait for units claimed by other nodes')
+    cmd.add_argument('--lease', type=float, default=600.0,
+                     help='seconds before claims expire (default: '
+                          '%(default)s)')
+    cmd.add_argument('--retries', type=int, default=3,
+                     help='retries of failing units (default: %(default)s)')
+    cmd.set_defaults(func=work)
+
+    add('verify', verify, 'check that compressed images decode to pixels '
+                          'and TIFF-tags of originals, or to their stored '
+                          'checksum, errors are written as JSON lines on '
+                          'stdout')
+    return p
+
+
+##
+# commands
+##
+def index(args):
+    "List images with attributes as JSON lines."
+    e = Experiment(args.path)
+    images = e.images
+    progress = Progress('index', len(images))
+    for image in images:
+        attr = ms_experiment.attributes(image)
+        line = {'path': image}
+        line.update((k, getattr(attr, k)) for k in attr._fields if k.isupper())
+        sys.stdout.write(json.dumps(line) + '\n')
+    progress.update(len(images), _size(images))
+    progress.done()
+
+
+def compress(args):
+    "Compress experiment."
+    e = Experiment(args.path)
+    e._check_writable('compress', args.folder, args.delete_tif)
+    images = [i for i in e.images if i.endswith('.tif')]
+    dedup = None
+    if args.dedup:
+        dedup = (os.path.join(args.folder, '.dedup') if args.folder else
+                 os.path.join(e.path, 'AdditionalData', 'dedup'))
+
+    def memory(chunk):
+        return ms_experiment._compress_memory(chunk, args.prefetch)
+
+    compressed = run(ms_experiment.compress_blocking, images, args, memory,
+                     delete_tif=args.delete_tif, folder=args.folder,
+                     prefetch=args.prefetch, dedup=dedup)
+    if dedup:
+        stats = ms_experiment.dedup_stats(compressed)
+        sys.stdout.write(json.dumps(stats, sort_keys=True) + '\n')
+
+
+def decompress(args):
+    "Decompress experiment."
+    e = Experiment(args.path)
+    e._check_writable('decompress', args.folder,
+                      args.delete_png or args.delete_json)
+    images = [i for i in e.images if i.endswith('.png')]
+    run(ms_experiment.decompress, images, args,
+        ms_experiment._decompress_memory, delete_png=args.delete_png,
+        delete_json=args.delete_json, folder=args.folder)
+
+
+def pack(args):
+    "Pack chambers of experiment."
+    from .packed import pack_blocking
+    # files are streamed to archive
+    run(pack_blocking, Experiment(args.path).wells, args, lambda wells: 0,
+        delete=args.delete)
+
+
+def stitch(args):
+    "Stitch experiment, one well at a time per worker, resuming earlier runs."
+    e = Experiment(args.path)
+    progress = Progress('stitch', len(e.wells), workers=args.workers)
+    failed = 0
+    for result in e.iter_stitch(args.folder, args.positions,
+                                retries=args.retries,
+                                resume=not args.restart):
+        failed += bool(result['error'])
+        progress.update(1, _size(result['files']), extra={
+            'well': result['well'], 'error': result['error'],
+            'resumed': result['resumed']})
+    progress.done(failed=failed)
+    return 1 if failed else 0
+
+
+def project(args):
+    "Z-projection of experiment."
+    e = Experiment(args.path)
+    groups = ms_experiment.projections(e.images, args.folder or e.path)
+    run(ms_experiment.project_blocking, groups, args,
+        ms_experiment._projection_memory, method=args.method,
+        flatfield=e._flatfield(args.flatfield))
+
+
+def preview(args):
+    "Previews of experiment."
+    e = Experiment(args.path)
+    folder = args.folder or os.path.join(e.path, 'previews')
+    groups = ms_experiment.projections(e.images, folder, prefix='preview')
+    fields = run(ms_experiment.preview_blocking, groups, args,
+                 ms_experiment._projection_memory, scale=args.scale,
+                 flatfield=e._flatfield(args.flatfield))
+    ms_experiment.montages(fields, folder)
+
+
+def watch(args):
+    "Process wells as they are scanned."
+    from .pipeline import Pipeline
+    progress = Progress('watch', None)
+    pipeline = Pipeline(args.path, compress=not args.no_compress,
+                        stitch=not args.no_stitch,
+                        delete_tif=args.delete_tif, folder=args.folder,
+                        workers=args.workers, project=args.project)
+    results = pipeline.watch(args.interval)
+    for well, result in results.items():
+        progress.update(1, extra={'well': well,
+                                  'compressed': len(result['compressed']),
+                                  'projected': len(result['projected']),
+                                  'stitched': len(result['stitched'])})
+    progress.done()
+
+
+def submit(args):
+    "Queue work units for distributed processing."
+    from .distributed import FileBroker, submit as submit_units
+    kwargs = {'folder': args.folder}
+    if args.operation == 'compress':
+        kwargs['delete_tif'] = args.delete_tif
+    broker = FileBroker(args.queue)
+    progress = Progress('submit', None)
+    units = submit_units(broker, args.path, args.operation, **kwargs)
+    progress.update(len(units))
+    progress.done(queue=broker.status())
+
+
+def work(args):
+    "Run queued work units."
+    from .distributed import FileBroker, work as work_units
+    broker = FileBroker(args.queue, lease=args.lease, retries=args.retries)
+    progress = Progress('work', None, workers=args.workers)
+    status = work_units(broker, args.workers, wait=args.wait)
+    progress.done(queue=status)
+    return 1 if status['failed'] else 0
+
+
+def verify(args):
+    "Verify compressed images."
+    images = [i for i in Experiment(args.path).images if i.endswith('.png')]
+    errors = run(ms_experiment.verify_blocking, images, args,
+                 ms_experiment._verify_memory)
+    for error in errors:
+        sys.stdout.write(json.dumps(error, sort_keys=True) + '\n')
+    return 1 if errors else 0
+
+
+##
+# helpers
+##
+def run(fn, items, args, cost, **kwargs):
+    """Run ``fn(chunk, **kwargs)`` on chunks of items in a pool of
+    ``args.workers`` processes within the memory budget, writing progress as
+    chunks finish, see :func:`matrixscreener.utils.iter_budgeted`.
+
+    Parameters
+    ----------
+    cost : function
+        Estimated memory of a chunk in bytes.
+
+    Returns
+    -------
+    list
+        Merged results of all chunks.
+    """
+    from .utils import iter_budgeted
+
+    chunk_size = args.chunk_size or max(
+        1, -(-len(items) // (args.workers * 4)))
+    progress = Progress(args.func.__name__, len(items),
+                        workers=args.workers, chunk_size=chunk_size)
+    results = {}
+    for i, chunk, result in iter_budgeted(fn, items, cost,
+                                          workers=args.workers,
+                                          chunk_size=chunk_size, **kwargs):
+        results[i] = result
+        progress.update(len(chunk), _size(chunk))
+    merged = []
+    for i in sorted(results):
+        merged.extend(results[i])
+    progress.done(results=len(merged))
+    return merged
+
+
+def parse_size(size):
+    """Parse size with optional suffix K, M, G or T to bytes.
+
+    Example
+    -------
+    >>> parse_size('1.5G')
+    1610612736
+    """
+    units = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+    size = size.strip().upper().rstrip('B')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def _size(items):
+    """Bytes of files in items. Items may be filenames, folders (size of
+    images in folder) or tuples of (output, images)."""
+    total = 0
+    for item in items:
+        if isinstance(item, tuple):
+            total += _size(item[1])
+        elif os.path.isdir(item):
+            total += _size(ms_experiment.glob(os.path.join(
+                item, ms_experiment._field + '--*',
+                ms_experiment._image + '--*')))
+        elif os.path.isfile(item):
+            total += os.path.getsize(item)
+    return total
+
+
+class Progress(object):
+    """Write progress and throughput as JSON lines to stderr."""
+
+    def __init__(self, command, total, **info):
+        self.command = command
+        self.total = total
+        self.done_items = 0
+        self.bytes = 0
+        self.begin = time.time()
+        self._write('start', **info)
+
+    def update(self, items, nbytes=0, extra=None):
+        self.done_items += items
+        self.bytes += nbytes
+        self._write('progress', **(extra or {}))
+
+    def done(self, **info):
+        self._write('done', **info)
+
+    def _write(self, event, **info):
+        elapsed = time.time() - self.begin
+        line = {
+            'command': self.command,
+            'event': event,
+            'done': self.done_items,
+            'total': self.total,
+            'bytes': self.bytes,
+            'elapsed': round(elapsed, 3),
+            'items_per_second': round(self.done_items / elapsed, 3)
+                                if elapsed else None,
+            'bytes_per_second': round(self.bytes / elapsed)
+                                if elapsed else None,
+        }
+        line.update(info)
+        sys.stderr.write(json.dumps(line, sort_keys=True) + '\n')
+        sys.stderr.flush()
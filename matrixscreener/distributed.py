@@ -0,0 +1,566 @@
+# encoding: utf-8
+"""
+Process an experiment on several nodes. The experiment is cut into one work
+unit per well, which is claimed by workers through a broker. The
+:class:`FileBroker` keeps the queue as files on storage shared by all nodes,
+:class:`LocalBroker` keeps it in memory for workers in one process.
+
+Example
+-------
+On one node, queue work::
+
+    broker = FileBroker('/shared/queue')
+    submit(broker, '/shared/experiment--', 'compress', delete_tif=True)
+
+On every node::
+
+    work(FileBroker('/shared/queue'), workers=8)
+"""
+import os, json, socket, threading, time, pydebug
+from collections import OrderedDict
+
+from .experiment import Experiment, compress_blocking, decompress, _images
+from .storage import temporary
+
+# debug with `DEBUG=matrixscreener python script.py`
+debug = pydebug.debug('matrixscreener')
+
+
+##
+# operations
+##
+def compress_well(well, delete_tif=False, folder=None):
+    "Compress TIFFs in well, see :func:`experiment.compress_blocking`."
+    images = [i for i in _images(well) if i.endswith('.tif')]
+    return compress_blocking(images, delete_tif, folder)
+
+
+def decompress_well(well, delete_png=False, delete_json=False, folder=None):
+    "Decompress PNGs in well, see :func:`experiment.decompress`."
+    images = [i for i in _images(well) if i.endswith('.png')]
+    return decompress(images, delete_png, delete_json, folder)
+
+
+def stitch_unit(well, folder=None, positions=None, resume=True):
+    """Stitch well with :meth:`experiment.Experiment.iter_stitch`, sharing
+    its state in ``AdditionalData/stitch.json``. Wells done before are not
+    stitched again if resume is given. Retries are done by the broker.
+
+    Raises
+    ------
+    RuntimeError
+        If well failed.
+    """
+    experiment = Experiment(os.path.dirname(os.path.dirname(well)))
+    for result in experiment.iter_stitch(folder, positions, retries=0,
+                                         resume=resume, wells=[well]):
+        if result['error']:
+            raise RuntimeError(result['error'])
+        return result['files']
+
+
+# operations available for work units
+OPERATIONS = {
+    'compress': compress_well,
+    'decompress': decompress_well,
+    'stitch': stitch_unit,
+}
+
+
+def work_units(experiment, operation, **kwargs):
+    """Cut experiment into one work unit per well.
+
+    Parameters
+    ----------
+    experiment : Experiment or string
+        Experiment to process.
+    operation : string
+        Key in ``OPERATIONS``.
+    kwargs : keyword arguments
+        Sent to operation. Must be JSON serializable.
+
+    Returns
+    -------
+    list of dicts
+        Work units with keys id, operation, well and kwargs.
+    """
+    if operation not in OPERATIONS:
+        raise ValueError('unknown operation {}, should be one of {}'
+                         .format(operation, sorted(OPERATIONS)))
+    if not isinstance(experiment, Experiment):
+        experiment = Experiment(experiment)
+    units = []
+    for well in experiment.wells:
+        slide = os.path.basename(os.path.dirname(well))
+        unit_id = '{}--{}--{}'.format(operation, slide,
+                                      os.path.basename(well))
+        units.append(OrderedDict([('id', unit_id),
+                                  ('operation', operation),
+                                  ('well', well),
+                                  ('kwargs', kwargs)]))
+    return units
+
+
+def submit(broker, experiment, operation, **kwargs):
+    """Queue one work unit per well of experiment in broker.
+
+    Units which already are queued are not queued again.
+
+    Returns
+    -------
+    list of dicts
+        Work units, see :func:`work_units`.
+    """
+    units = work_units(experiment, operation, **kwargs)
+    broker.put(units)
+    return units
+
+
+def run_unit(unit):
+    "Run operation of work unit. Returns the result of the operation."
+    debug('running {}'.format(unit['id']))
+    return OPERATIONS[unit['operation']](unit['well'], **unit['kwargs'])
+
+
+def work(broker, workers=1, wait=False, poll=5.0):
+    """Claim and run work units until queue is empty.
+
+    Parameters
+    ----------
+    broker : Broker
+        Where to claim units.
+    workers : int
+        Number of workers. Processes for brokers shared between processes,
+        threads otherwise.
+    wait : bool
+        Keep polling for work while other workers hold leases, until all
+        units are done or failed.
+    poll : float
+        Seconds between polls when waiting.
+
+    Returns
+    -------
+    dict
+        Status of broker when done, see :meth:`Broker.status`.
+    """
+    if workers <= 1:
+        _work_loop(broker, wait, poll)
+        return broker.status()
+
+    if broker.shared:
+        from multiprocessing import Process as Worker
+    else:
+        Worker = threading.Thread
+    procs = [Worker(target=_work_loop, args=(broker, wait, poll))
+             for _ in range(workers)]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+    return broker.status()
+
+
+def _work_loop(broker, wait, poll):
+    "Claim and run units until broker has no more work."
+    while True:
+        unit = broker.claim()
+        if unit is None:
+            if wait and not broker.finished():
+                time.sleep(poll)
+                continue
+            return
+        renewer = _LeaseRenewer(broker, unit)
+        renewer.start()
+        try:
+            result = run_unit(unit)
+        except Exception as e:
+            renewer.stop()
+            debug('failed {}: {}'.format(unit['id'], e))
+            if renewer.lost:
+                # unit is run by the worker which took over the lease
+                continue
+            broker.fail(unit, '{}: {}'.format(type(e).__name__, e))
+        else:
+            renewer.stop()
+            broker.complete(unit, result)
+
+
+class _LeaseRenewer(threading.Thread):
+    "Renew lease of unit while it is processed, ``lost`` if it expired."
+
+    def __init__(self, broker, unit):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.broker = broker
+        self.unit = unit
+        self.lost = False
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.broker.lease / 3.0):
+            if not self.broker.renew(self.unit):
+                debug('lost lease of {}'.format(self.unit['id']))
+                self.lost = True
+                return
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+##
+# brokers
+##
+class Broker(object):
+    """Interface of work queues.
+
+    Parameters
+    ----------
+    lease : float
+        Seconds a claim is valid without being renewed. Units with expired
+        leases are given to other workers.
+    retries : int
+        Times a unit is retried after failing or loosing its lease. A unit
+        which is not done after ``retries + 1`` attempts is failed.
+
+    Attributes
+    ----------
+    shared : bool
+        If the broker can be used by workers in several processes.
+    """
+
+    shared = False
+
+    def __init__(self, lease=600.0, retries=3):
+        self.lease = lease
+        self.retries = retries
+
+    def put(self, units):
+        "Queue work units."
+        raise NotImplementedError
+
+    def claim(self):
+        "Claim a unit, None if no unit is available."
+        raise NotImplementedError
+
+    def renew(self, unit):
+        """Renew lease of claimed unit. False if the lease was lost to
+        another worker, which then runs the unit."""
+        raise NotImplementedError
+
+    def complete(self, unit, result):
+        "Mark unit as done with result, release lease if still held."
+        raise NotImplementedError
+
+    def fail(self, unit, error):
+        """Release unit after error, it is retried if retries are left.
+        Nothing is done if the lease was lost."""
+        raise NotImplementedError
+
+    def status(self):
+        """Dict with number of units which are queued, claimed, done and
+        failed (no retries left)."""
+        raise NotImplementedError
+
+    def finished(self):
+        "True if every unit is done or failed."
+        status = self.status()
+        return status['queued'] == 0 and status['claimed'] == 0
+
+
+class LocalBroker(Broker):
+    """Work queue in memory, for workers in threads of one process."""
+
+    def __init__(self, lease=600.0, retries=3):
+        Broker.__init__(self, lease, retries)
+        self._lock = threading.Lock()
+        self.units = OrderedDict()
+        self.claims = {}  # id -> lease expiry
+        self.attempts = {}
+        self.results = {}
+        self.errors = {}
+
+    def put(self, units):
+        with self._lock:
+            for unit in units:
+                self.units.setdefault(unit['id'], unit)
+
+    def claim(self):
+        with self._lock:
+            now = time.time()
+            for unit_id, unit in self.units.items():
+                if unit_id in self.results or \
+                        self.claims.get(unit_id, 0) > now or \
+                        self.attempts.get(unit_id, 0) > self.retries:
+                    continue
+                self.attempts[unit_id] = self.attempts.get(unit_id, 0) + 1
+                self.claims[unit_id] = now + self.lease
+                return unit
+        return None
+
+    def renew(self, unit):
+        with self._lock:
+            if unit['id'] not in self.claims:
+                return False
+            self.claims[unit['id']] = time.time() + self.lease
+            return True
+
+    def complete(self, unit, result):
+        with self._lock:
+            self.results[unit['id']] = result
+            self.claims.pop(unit['id'], None)
+
+    def fail(self, unit, error):
+        with self._lock:
+            self.errors.setdefault(unit['id'], []).append(error)
+            self.claims.pop(unit['id'], None)
+
+    def status(self):
+        with self._lock:
+            now = time.time()
+            status = {'queued': 0, 'claimed': 0, 'done': 0, 'failed': 0}
+            for unit_id in self.units:
+                if unit_id in self.results:
+                    status['done'] += 1
+                elif self.claims.get(unit_id, 0) > now:
+                    status['claimed'] += 1
+                elif self.attempts.get(unit_id, 0) > self.retries:
+                    status['failed'] += 1
+                else:
+                    status['queued'] += 1
+            return status
+
+
+class FileBroker(Broker):
+    """Work queue as files in folder on storage shared by all nodes.
+
+    Claims are lock files created with ``O_CREAT | O_EXCL``, which is atomic
+    on local file systems and NFSv3+, holding the name of the worker. Leases
+    are renewed by touching the lock file, and an expired lock is taken over
+    by renaming it, such that only one worker wins. Locks are only renewed
+    and removed by the worker named in them. Folder layout::
+
+        units/<id>.json      work unit
+        claims/<id>.lock     claimed by worker, mtime is last renewal
+        attempts/<id>.<n>    attempt n has been started
+        done/<id>.json       result of finished unit
+        errors/<id>.<n>      error message of failed attempt
+
+    Parameters
+    ----------
+    folder : string
+        Folder for queue, created if missing.
+    lease, retries
+        See :class:`Broker`.
+    """
+
+    shared = True
+
+    def __init__(self, folder, lease=600.0, retries=3):
+        Broker.__init__(self, lease, retries)
+        self.folder = os.path.abspath(folder)
+        self.worker = _worker_name()
+        for sub in ('units', 'claims', 'attempts', 'done', 'errors'):
+            path = os.path.join(self.folder, sub)
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+                except OSError:
+                    # created by another node
+                    pass
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['worker']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # new process, new worker name
+        self.worker = _worker_name()
+
+    def _path(self, sub, name):
+        return os.path.join(self.folder, sub, name)
+
+    def _ids(self, sub, extension='.json'):
+        return sorted(f[:-len(extension)]
+                      for f in os.listdir(os.path.join(self.folder, sub))
+                      if f.endswith(extension))
+
+    def _count(self, sub, unit_id):
+        "Number of attempts or errors of unit."
+        prefix = unit_id + '.'
+        return len([f for f in os.listdir(os.path.join(self.folder, sub))
+                    if f.startswith(prefix) and f[len(prefix):].isdigit()])
+
+    def put(self, units):
+        for unit in units:
+            path = self._path('units', unit['id'] + '.json')
+            if os.path.isfile(path):
+                continue
+            _write_atomic(path, json.dumps(unit))
+
+    def claim(self):
+        done = set(self._ids('done'))
+        for unit_id in self._ids('units'):
+            if unit_id in done:
+                continue
+            attempts = self._count('attempts', unit_id)
+            if attempts > self.retries:
+                continue
+            if not self._lock(unit_id):
+                continue
+            if os.path.isfile(self._path('done', unit_id + '.json')):
+                # finished while we were looking
+                self._unlock(unit_id)
+                continue
+            open(self._path('attempts', '{}.{}'.format(unit_id, attempts)),
+                 'w').close()
+            with open(self._path('units', unit_id + '.json')) as f:
+                return json.load(f, object_pairs_hook=OrderedDict)
+        return None
+
+    def _lock(self, unit_id):
+        "Create lock file, take over expired locks. True if claimed."
+        lock = self._path('claims', unit_id + '.lock')
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError:
+            try:
+                found = _lock_state(lock)
+            except (IOError, OSError):
+                # released in the meantime
+                return self._lock(unit_id)
+            if time.time() - found[1] <= self.lease:
+                return False
+            # only one worker can rename the expired lock
+            stale = '{}.stale.{}'.format(lock, self.worker)
+            try:
+                os.rename(lock, stale)
+            except OSError:
+                return False
+            if _lock_state(stale) != found:
+                # lock was renewed or released and claimed again after it
+                # was found expired, give it back to its owner
+                debug('lease of {} was renewed, not taking over'.format(
+                    unit_id))
+                try:
+                    os.link(stale, lock)
+                except (OSError, AttributeError) as e:
+                    print('matrixscreener could not give back lock {}: '
+                          '{}'.format(lock, e))
+                os.remove(stale)
+                return False
+            os.remove(stale)
+            debug('took over expired lease of {}'.format(unit_id))
+            return self._lock(unit_id)
+        os.write(fd, self.worker.encode())
+        os.close(fd)
+        return True
+
+    def _owns(self, unit_id):
+        "True if lock of unit is held by this worker."
+        try:
+            owner = _lock_state(self._path('claims', unit_id + '.lock'))[2]
+        except (IOError, OSError):
+            return False
+        return owner == self.worker.encode()
+
+    def _unlock(self, unit_id):
+        "Remove lock of unit if held by this worker. True if removed."
+        lock = self._path('claims', unit_id + '.lock')
+        # move lock away before checking owner, such that a lock taken over
+        # after the check is not removed
+        released = '{}.release.{}'.format(lock, self.worker)
+        try:
+            os.rename(lock, released)
+        except OSError:
+            return False
+        if _lock_state(released)[2] == self.worker.encode():
+            os.remove(released)
+            return True
+        debug('lease of {} was taken over, not releasing'.format(unit_id))
+        try:
+            os.link(released, lock)
+        except (OSError, AttributeError) as e:
+            print('matrixscreener could not give back lock {}: '
+                  '{}'.format(lock, e))
+        os.remove(released)
+        return False
+
+    def renew(self, unit):
+        if not self._owns(unit['id']):
+            return False
+        try:
+            os.utime(self._path('claims', unit['id'] + '.lock'), None)
+        except OSError:
+            return False
+        return True
+
+    def complete(self, unit, result):
+        _write_atomic(self._path('done', unit['id'] + '.json'),
+                      json.dumps({'worker': self.worker, 'result': result}))
+        self._unlock(unit['id'])
+
+    def fail(self, unit, error):
+        if not self._owns(unit['id']):
+            debug('lost lease of {}, not failing it'.format(unit['id']))
+            return
+        n = self._count('errors', unit['id'])
+        with open(self._path('errors', '{}.{}'.format(unit['id'], n)),
+                  'w') as f:
+            f.write(error)
+        self._unlock(unit['id'])
+
+    def results(self):
+        "Results of done units as an OrderedDict, id -> result."
+        results = OrderedDict()
+        for unit_id in self._ids('done'):
+            with open(self._path('done', unit_id + '.json')) as f:
+                results[unit_id] = json.load(f)['result']
+        return results
+
+    def status(self):
+        done = set(self._ids('done'))
+        status = {'queued': 0, 'claimed': 0, 'done': 0, 'failed': 0}
+        for unit_id in self._ids('units'):
+            if unit_id in done:
+                status['done'] += 1
+            elif self._claimed(unit_id):
+                status['claimed'] += 1
+            elif self._count('attempts', unit_id) > self.retries:
+                status['failed'] += 1
+            else:
+                status['queued'] += 1
+        return status
+
+    def _claimed(self, unit_id):
+        "True if unit has a lease which has not expired."
+        try:
+            mtime = os.path.getmtime(self._path('claims', unit_id + '.lock'))
+        except OSError:
+            return False
+        return time.time() - mtime <= self.lease
+
+
+def _worker_name():
+    "Unique name of worker, host and process id."
+    import uuid
+    return '{}-{}-{}'.format(socket.gethostname(), os.getpid(),
+                             uuid.uuid4().hex[:8])
+
+
+def _lock_state(lock):
+    "Identity, modification time and owner of lock file."
+    stat = os.stat(lock)
+    with open(lock, 'rb') as f:
+        owner = f.read()
+    return (stat.st_dev, stat.st_ino), stat.st_mtime, owner
+
+
+def _write_atomic(path, content):
+    "Write content to path through a temporary file."
+    tmp = temporary(path)
+    with open(tmp, 'w') as f:
+        f.write(content)
+    os.rename(tmp, path)
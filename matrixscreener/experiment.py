@@ -6,16 +6,19 @@ through an object.
 ##
 # imports
 ##
-import os, re, pydebug, fijibin.macro
+import os, re, pydebug
 from collections import namedtuple
-from .utils import chop, apply_async
-
-# compress
-import json
-from PIL import Image
-from PIL.ImagePalette import ImagePalette
+from itertools import groupby
+from .utils import (chop, apply_async, apply_budgeted, iter_budgeted,
+                    image_memory)
+from .profiling import stage
+from .storage import (storage_for, is_local, mount, unmount, temporary,
+                      LocalStorage)
 from copy import copy
 
+# fijibin, PIL and json are imported where they are used, such that
+# `import matrixscreener` stays fast for scripts not processing images
+
 # debug with `DEBUG=matrixscreener python script.py`
 debug = pydebug.debug('matrixscreener')
 
@@ -34,13 +37,20 @@ _image = 'image'
 
 # classes
 class Experiment:
-    def __init__(self, path):
+    def __init__(self, path, storage=None):
         """Leica LAS AF MatrixScreener experiment.
 
         Parameters
         ----------
         path : string
             Path to matrix scan containing ``slide-SXX`` and ``AdditinalData``.
+            May be an URL, such as ``s3://bucket/experiment--1``, see
+            :mod:`matrixscreener.storage`.
+        storage : matrixscreener.storage.Storage
+            Backend for listing and reading files, defaults to backend of
+            path. Experiments with packed chambers are read through
+            :class:`matrixscreener.packed.PackedStorage`. Path is mounted on
+            storage, see :func:`matrixscreener.storage.mount`.
 
         Attributes
         ----------
@@ -50,8 +60,20 @@ class Experiment:
             Path to folder below experiment.
         basename : string
             Foldername of experiment.
+        storage : matrixscreener.storage.Storage
+            Backend of experiment.
         """
         _set_path(self, path)
+        if storage is None and is_local(self.path):
+            from .packed import is_packed, PackedStorage
+            storage = storage_for(self.path)
+            if is_packed(self.path) and not isinstance(storage,
+                                                       PackedStorage):
+                storage = PackedStorage()
+        self.storage = storage or storage_for(self.path)
+        if self.storage is not storage_for(self.path):
+            # functions given paths of experiment use storage, also workers
+            mount(self.path, self.storage)
 
         self._slide_path = _pattern(self.path, _slide)
         self._well_path = _pattern(self._slide_path, _chamber)
@@ -64,32 +86,109 @@ class Experiment:
     @property
     def slides(self):
         "List of paths to slides."
-        return glob(self._slide_path)
+        return self.storage.glob(self._slide_path)
 
     @property
     def wells(self):
         "List of paths to wells."
-        return glob(self._well_path)
+        return self.storage.glob(self._well_path)
 
     @property
     def fields(self):
         "List of paths to fields."
-        return glob(self._field_path)
+        return self.storage.glob(self._field_path)
 
     @property
     def images(self):
-        "List of paths to images."
+        """List of paths to images, TIFFs first. Remote experiments are listed
+        once, not once per folder."""
         tifs = _pattern(self._image_path, extension='tif')
         pngs = _pattern(self._image_path, extension='png')
-        imgs = []
-        imgs.extend(glob(tifs))
-        imgs.extend(glob(pngs))
-        return imgs
+        with stage('glob'):
+            return self.storage.glob(tifs, pngs)
 
     @property
     def stitched(self):
         "List of stitched images if they are in experiment folder."
-        return glob(_pattern(self.path, 'stitched'))
+        return self.storage.glob(_pattern(self.path, 'stitched'))
+
+    def groupby(self, *keys):
+        """Generator of images grouped by attributes, sorted by key.
+
+        If all keys are attributes of wells (S, U, V) or fields (S, U, V, X,
+        Y), images are globbed one well/field at a time, such that only one
+        group is held in memory. Otherwise all images are indexed once and
+        sorted by key.
+
+        Parameters
+        ----------
+        keys : strings
+            Attributes to group by. Upper case gives key values as strings,
+            lower case as integers. Example: ``groupby('U', 'V')``.
+
+        Yields
+        ------
+        key, images : tuple, list
+            Attribute values and sorted list of images in group.
+
+        Example
+        -------
+        >>> for (u, v), images in experiment.groupby('u', 'v'):
+        ...     print(u, v, len(images))
+        """
+        def key(path):
+            attr = attributes(path)
+            return tuple(getattr(attr, k) for k in keys)
+
+        upper = set(k.upper() for k in keys)
+        if upper <= set('SUV'):
+            folders = self.wells
+        elif upper <= set('SUVXY'):
+            folders = self.fields
+        else:
+            folders = None
+
+        if folders is not None:
+            # stream folder by folder
+            for k, group in groupby(sorted(folders, key=key), key):
+                images = []
+                for folder in group:
+                    images.extend(_images(folder))
+                yield k, images
+        else:
+            # one index pass
+            index = sorted((key(image), image) for image in self.images)
+            for k, group in groupby(index, lambda item: item[0]):
+                yield k, [image for _, image in group]
+
+    def iter_fields(self):
+        """Generator of fields, one field globbed at a time.
+
+        Yields
+        ------
+        field, images : string, list
+            Field path and sorted list of images in field.
+        """
+        for field in self.fields:
+            yield field, _images(field)
+
+    def iter_stacks(self):
+        """Generator of z-stacks, one field globbed at a time.
+
+        Yields
+        ------
+        key, images : tuple, list
+            Attributes (U, V, X, Y, T, C) as strings and images of stack
+            sorted by Z.
+        """
+        def key(path):
+            attr = attributes(path)
+            return (attr.U, attr.V, attr.X, attr.Y, attr.T, attr.C)
+
+        for _, images in self.iter_fields():
+            stacks = sorted(images, key=lambda i: (key(i), attribute(i, 'Z')))
+            for k, stack in groupby(stacks, key):
+                yield k, list(stack)
 
     def __str__(self):
         return 'matrixscreener.Experiment({})'.format(self.path)
@@ -97,41 +196,277 @@ class Experiment:
     def __repr__(self):
         return self.__str__()
 
-    def stitch(self, folder=None):
-        """Stitches all wells in experiment with ImageJ. Stitched images are
-        saved in experiment root.
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Unmount path of experiment from its storage, see
+        :func:`matrixscreener.storage.unmount`. Paths of experiment are then
+        read through the storage of their protocol."""
+        unmount(self.path, self.storage)
 
-        Images which already exists are omitted stitching.
+    @property
+    def metadata(self):
+        """OME-XML metadata of all fields as a table, see
+        :func:`matrixscreener.metadata.table`. Cached in
+        ``AdditionalData/metadata.npz``."""
+        from .metadata import table
+        return table(self.path)
+
+    def qc(self, cache=True):
+        """Intensity statistics, saturation and focus of every image as a
+        table, see :func:`matrixscreener.qc.table`. Images are measured in
+        parallel and cached in ``AdditionalData/qc.npz``, such that only new
+        or modified images are measured when called again.
+
+        Parameters
+        ----------
+        cache : bool
+            Whether to read and write the cache.
+
+        Returns
+        -------
+        collections.OrderedDict
+            Column name -> numpy array, one row per image.
+        """
+        from .qc import table
+        return table(self.path, self.images, cache)
+
+    def stitch(self, folder=None, positions=None, flatfield=False,
+               retries=1, resume=True):
+        """Stitches all wells in experiment with ImageJ. Stitched images are
+        saved in experiment root. See :meth:`iter_stitch`, which yields
+        results as wells finish.
 
         Parameters
         ----------
         folder : string
             Where to store stitched images. Defaults to experiment path.
+        positions : string
+            ``'stage'`` places tiles at stage coordinates from
+            :attr:`metadata` instead of computing overlap between tiles.
+            ``'registered'`` computes overlap once per well (if the well has
+            no ``TileConfiguration.registered.txt``) and fuses all channels
+            and z-stacks with the registered positions.
+        flatfield : bool
+            Correct tiles with flat-field profiles while reading, see
+            :mod:`matrixscreener.flatfield`. Requires positions, tiles are
+            fused with linear blending by :func:`fuse_blocking` instead of
+            Fiji.
+        retries : int
+            Times a failing well is retried.
+        resume : bool
+            Skip wells stitched by an earlier run.
 
         Returns
         -------
         list
             Filenames of stitched images. Files which already exists before
             stitching are also returned.
+
+        Raises
+        ------
+        StitchError
+            If any well failed, after all wells are done. Has ``errors``
+            (well -> error) and ``files`` (stitched images of other wells).
+        """
+        stitched = []
+        errors = {}
+        for result in self.iter_stitch(folder, positions, flatfield, retries,
+                                       resume):
+            if result['error']:
+                errors[result['well']] = result['error']
+            stitched.extend(result['files'])
+        if errors:
+            raise StitchError(errors, sorted(stitched))
+        return sorted(stitched)
+
+    def iter_stitch(self, folder=None, positions=None, flatfield=False,
+                    retries=1, resume=True, wells=None):
+        """Stitch wells as independent jobs, yielding every well when it is
+        done. Wells are stitched in parallel, as many at a time as fits in
+        the memory budget ``matrixscreener.utils._memory_limit``, see
+        :func:`matrixscreener.utils.iter_budgeted`.
+
+        The state of every well is saved in ``AdditionalData/stitch.json``
+        when it finishes, such that an interrupted run resumes with the wells
+        that were not done. A failing well does not stop other wells, it is
+        retried alone when the others are done. See :meth:`stitch` for
+        parameters, and ``wells`` (paths) to stitch some of the wells.
+
+        Yields
+        ------
+        dict
+            ``well``, ``files`` (stitched images), ``error`` (None if
+            stitched), ``attempts`` and ``resumed`` (True if done by an
+            earlier run).
+
+        Example
+        -------
+        >>> for result in experiment.iter_stitch(positions='registered'):
+        ...     print(result['well'], result['files'], result['error'])
         """
         debug('stitching ' + self.__str__())
         if not folder:
             folder = self.path
+        if flatfield and positions is None:
+            raise ValueError('flat-field correction needs positions')
+        if positions not in (None, 'stage', 'registered'):
+            raise ValueError('unknown positions {!r}'.format(positions))
+
+        state = _StitchState(os.path.join(self.path, 'AdditionalData',
+                                          'stitch.json'))
+        options = {'folder': folder if '://' in folder
+                   else os.path.abspath(folder),
+                   'positions': positions, 'flatfield': bool(flatfield)}
+        todo = []
+        for well in (self.wells if wells is None else wells):
+            previous = state.get(well)
+            if (resume and previous and previous['status'] == 'done' and
+                    previous['options'] == options and
+                    all(storage_for(f).exists(f) for f in previous['files'])):
+                yield {'well': well, 'files': previous['files'],
+                       'error': None, 'attempts': previous['attempts'],
+                       'resumed': True}
+            else:
+                todo.append(well)
+        if not todo:
+            return
+
+        profiles = self._flatfield(flatfield)
+        items = []
+        if positions == 'stage':
+            from .metadata import tile_positions
+            table = self.metadata
+            for well in todo:
+                items.append((well, tile_positions(
+                    table, attribute(well, 'U'), attribute(well, 'V'))))
+        else:
+            items = [(well, positions) for well in todo]
+
+        attempts = {}
+        for attempt in range(retries + 1):
+            failed = []
+            for _, _, results in iter_budgeted(
+                    stitch_wells, items, _stitch_memory, chunk_size=1,
+                    folder=folder, flatfield=profiles):
+                for result in results:
+                    well = result['well']
+                    attempts[well] = result['attempts'] = attempt + 1
+                    result['resumed'] = False
+                    state.set(well, result, options)
+                    if result['error'] and attempt < retries:
+                        debug('retrying {}: {}'.format(well, result['error']))
+                        failed.append(well)
+                    else:
+                        yield result
+            items = [item for item in items if item[0] in failed]
+            if not items:
+                break
+
+    def previews(self, scale=0.1, folder=None, flatfield=False):
+        """Downsampled previews of fields, wells and the whole plate, without
+        stitching. Fields are placed in a grid by their X and Y attributes,
+        and wells by their U and V attributes.
+
+        Field previews are maximum z-projections, created in parallel.
+        Previews newer than their source images are reused.
+
+        Saved in folder as ``preview--UXX--VXX--XXX--YXX--TXX--CXX.png``
+        (fields), ``preview--UXX--VXX--TXX--CXX.png`` (wells) and
+        ``preview--TXX--CXX.png`` (plate).
+
+        Parameters
+        ----------
+        scale : float
+            Size of field previews relative to images, rounded to 1/n.
+        folder : string
+            Where to store previews. Defaults to ``previews`` in experiment.
+        flatfield : bool
+            Correct images with flat-field profiles while reading, see
+            :mod:`matrixscreener.flatfield`.
+
+        Returns
+        -------
+        list
+            Filenames of previews, fields first, then wells and plate.
+        """
+        folder = folder or os.path.join(self.path, 'previews')
+        groups = projections(self.images, folder, prefix='preview')
+        fields = apply_async(preview_blocking, groups=(groups, True),
+                             scale=(scale, False),
+                             flatfield=(self._flatfield(flatfield), False))
+        return fields + montages(fields, folder)
+
+    def decompress(self, delete_png=False, delete_json=False, folder=None):
+        """Decompress all PNG images in experiment to OME-TIFF, see
+        :func:`decompress`. Runs in parallel within memory budget, see
+        :func:`matrixscreener.utils.apply_budgeted`.
 
-        # create list of macros and files
-        macros = []
-        files = []
-        for well in self.wells:
-            f,m = stitch_macro(well, folder)
-            macros.extend(m)
-            files.extend(f)
+        Parameters
+        ----------
+        delete_png : bool
+            Whether to delete PNG images.
+        delete_json : bool
+            Whether to delete TIFF-tags stored in json files.
+        folder : string
+            Where to store OME-TIFFs. Defaults to the folder they are in.
 
-        output_files = apply_async(fijibin.macro.run, macro=(macros, True),
-                                   output_files=(files,True))
+        Returns
+        -------
+        list
+            Filenames of OME-TIFFs.
+        """
+        self._check_writable('decompress', folder, delete_png or delete_json)
+        pngs = [image for image in self.images if image.endswith('.png')]
+        return apply_budgeted(decompress, pngs, _decompress_memory,
+                              delete_png=delete_png, delete_json=delete_json,
+                              folder=folder)
+
+    def verify(self):
+        """Check that compressed images in experiment decode to the pixels
+        and TIFF tags of their source, see :func:`verify`.
+
+        Returns
+        -------
+        list of dicts
+            ``image`` and ``error`` for every mismatch.
+        """
+        return verify([image for image in self.images
+                       if image.endswith('.png')])
+
+    def to_chunked(self, path, chunks=(512, 512), level=6, flatfield=False):
+        """Export experiment to one chunked array with axes (well, field, T,
+        Z, C, Y, X), see :mod:`matrixscreener.chunked`. Chunks are written in
+        parallel. Exporting again to the same path appends new images, such
+        as new time points.
+
+        Parameters
+        ----------
+        path : string
+            Where to store array.
+        chunks : tuple of ints
+            Chunk size in Y and X.
+        level : int
+            zlib compression level.
+        flatfield : bool
+            Correct images with flat-field profiles while reading, see
+            :mod:`matrixscreener.flatfield`.
 
-        return output_files
+        Returns
+        -------
+        matrixscreener.chunked.ChunkedArray
+            Lazy reader of array.
+        """
+        from .chunked import export
+        return export(self.images, path, chunks, level,
+                      self._flatfield(flatfield))
 
-    def compress(self, delete_tif=False, folder=None):
+    def compress(self, delete_tif=False, folder=None, prefetch=2,
+                 dedup=False):
         """Lossless compress all images in experiment to PNG. If folder is
         omitted, images will not be moved.
 
@@ -143,6 +478,13 @@ class Experiment:
             Where to store PNGs. Defaults to the folder they are in.
         delete_tif : bool
             If set to truthy value, ome.tifs will be deleted after compression.
+        prefetch : int
+            Files read ahead and written behind in every worker, see
+            :func:`compress_blocking`.
+        dedup : bool
+            Store images with identical pixels once. Content store is
+            ``AdditionalData/dedup`` in experiment, or ``.dedup`` in folder
+            if given. See :func:`dedup_stats` for dedup ratio.
 
         Returns
         -------
@@ -150,12 +492,108 @@ class Experiment:
             Filenames of PNG images. Files which already exists before
             compression are also returned.
         """
-        return compress(self.images, delete_tif, folder)
+        self._check_writable('compress', folder, delete_tif)
+        if dedup:
+            if folder:
+                dedup = os.path.join(folder, '.dedup')
+            else:
+                dedup = os.path.join(self.path, 'AdditionalData', 'dedup')
+        return compress(self.images, delete_tif, folder, prefetch,
+                        dedup or None)
+
+    def pack(self, delete=False):
+        """Pack every chamber into one uncompressed zip with an index, see
+        :mod:`matrixscreener.packed`. Chambers are packed in parallel.
+
+        Parameters
+        ----------
+        delete : bool
+            Delete chamber folders after packing. Images are still listed and
+            read through ``Experiment(path)``.
+
+        Returns
+        -------
+        list of filenames
+            Archives, ``slide--SXX/chamber--UXX--VXX.zip``.
+        """
+        from .packed import pack, PackedStorage
+        if not is_local(self.path):
+            raise ValueError('only local experiments can be packed')
+        archives = pack(self.wells, delete)
+        if not isinstance(self.storage, PackedStorage):
+            self.storage = PackedStorage()
+            mount(self.path, self.storage)
+        return archives
+
+    def project(self, folder=None, method='max', flatfield=False):
+        """Z-projection of all fields, channels and time points in
+        experiment. Projections are saved as
+        ``projected--UXX--VXX--XXX--YXX--TXX--CXX.png``.
+
+        Images which already exists are omitted.
+
+        Parameters
+        ----------
+        folder : string
+            Where to store projections. Defaults to experiment path.
+        method : string
+            ``'max'``, ``'min'`` or ``'mean'`` intensity projection.
+        flatfield : bool
+            Correct images with flat-field profiles while reading, see
+            :mod:`matrixscreener.flatfield`.
+
+        Returns
+        -------
+        list
+            Filenames of projections. Files which already exists before
+            projection are also returned.
+        """
+        folder = folder or self.path
+        groups = projections(self.images, folder)
+        return apply_async(project_blocking, groups=(groups, True),
+                           method=(method, False),
+                           flatfield=(self._flatfield(flatfield), False))
+
+    def _check_writable(self, action, folder=None, delete=False):
+        """Raise ValueError if action would write to or delete from packed
+        chambers, which are read only."""
+        from .packed import PackedStorage
+        if isinstance(self.storage, PackedStorage) and (delete or not folder):
+            raise ValueError('cannot {} packed experiment {} in place, '
+                             'packed chambers are read only. Give folder '
+                             'and do not delete originals.'.format(
+                                 action, self.path))
+
+    def _flatfield(self, flatfield):
+        "Flat-field profiles if flatfield is truthy, else None."
+        if not flatfield:
+            return None
+        from .flatfield import profiles
+        return profiles(self.path, self.images)
+
+
+
+class StitchError(RuntimeError):
+    """Wells failed in :meth:`Experiment.stitch`.
+
+    Attributes
+    ----------
+    errors : dict
+        Well -> error message, for every failed well.
+    files : list
+        Stitched images of wells which did not fail.
+    """
 
+    def __init__(self, errors, files):
+        RuntimeError.__init__(self, 'failed stitching {} wells: {}'.format(
+            len(errors), '; '.join('{}: {}'.format(well, error)
+                                   for well, error in sorted(errors.items()))))
+        self.errors = errors
+        self.files = files
 
 
 # methods
-def stitch_macro(path, output_folder=None):
+def stitch_macro(path, output_folder=None, positions=None):
     """Create fiji-macros for stitching all channels and z-stacks for a well.
 
     Parameters
@@ -164,28 +602,360 @@ def stitch_macro(path, output_folder=None):
         Well path.
     output_folder : string
         Folder to store images. If not given well path is used.
+    positions : dict or string
+        (X, Y) of field -> (x, y) position in pixels, see
+        :func:`matrixscreener.metadata.tile_positions`. If given, tiles are
+        placed at positions and fused without computing overlap. A
+        ``TileConfiguration.positions--ZNN--CNN.txt`` is written to the well
+        for every channel and z-stack. ``'registered'`` reads positions from
+        ``TileConfiguration.registered.txt`` in well, see
+        :func:`register_macro`.
 
     Returns
     -------
     output_files, macros : tuple
         Tuple with filenames and macros for stitched well.
     """
+    import fijibin.macro
     output_folder = output_folder or path
     debug('stitching ' + path + ' to ' + output_folder)
 
-    fields = glob(_pattern(path, _field))
+    if positions == 'registered':
+        from .metadata import registered_positions
+        positions = registered_positions(path)
+        if positions is None:
+            print('matrixscreener no registered tile configuration in {}, '
+                  'computing overlap'.format(path))
+
+    grid, planes = _stitch_planes(path)
+    macros = []
+    output_files = []
+    for Z, C, filenames in planes:
+        output = os.path.join(output_folder, _stitched_filename(filenames))
+        debug('output ' + output)
+        output_files.append(output)
+        if os.path.isfile(output):
+            # file already exists
+            print('matrixscreener stitched file already exists {}'.format(output))
+            continue
+        if positions:
+            from .metadata import tile_configuration
+            layout = 'TileConfiguration.positions--Z{}--C{}.txt'.format(Z, C)
+            tiles = [(filenames.format(xx='%02d' % X, yy='%02d' % Y), xy)
+                     for (X, Y), xy in sorted(positions.items())]
+            tile_configuration(os.path.join(path, layout), tiles)
+            macros.append(fuse_macro(path, layout, output))
+            continue
+        macros.append(fijibin.macro.stitch(path, filenames,
+                              output_filename=output, **grid))
+
+    return (output_files, macros)
+
+
+# estimated memory of one Fiji process before loading images
+_fiji_memory = 1024**3
+
+
+def stitch_wells(items, folder, flatfield=None):
+    """Stitch wells one at a time, see :func:`stitch_well`. Errors are
+    returned, such that a failing well does not stop the others.
+
+    Parameters
+    ----------
+    items : list of tuples
+        (well, positions) for every well.
+    folder : string
+        Where to store stitched images.
+    flatfield : dict
+        Channel -> flat-field profile.
+
+    Returns
+    -------
+    list of dicts
+        ``well``, ``files`` and ``error`` of every well.
+    """
+    results = []
+    for well, positions in items:
+        try:
+            files, error = stitch_well(well, folder, positions, flatfield), None
+        except Exception as e:
+            files, error = [], '{}: {}'.format(type(e).__name__, e)
+        results.append({'well': well, 'files': files, 'error': error})
+    return results
+
+
+def stitch_well(well, folder=None, positions=None, flatfield=None):
+    """Stitch all channels and z-stacks of one well.
+
+    Parameters
+    ----------
+    well : string
+        Well path.
+    folder : string
+        Where to store stitched images. Defaults to well path.
+    positions : dict or string
+        See :func:`stitch_macro`. With ``'registered'``, overlap is computed
+        first if well has no ``TileConfiguration.registered.txt``.
+    flatfield : dict
+        Channel -> flat-field profile. Tiles are corrected and fused with
+        :func:`fuse_blocking`, requires positions.
+
+    Returns
+    -------
+    list of filenames
+        Stitched images.
+
+    Raises
+    ------
+    IOError
+        If a stitched image is not written.
+    """
+    import fijibin.macro
+    from .metadata import registered_positions
+    folder = folder or well
+    fiji = not flatfield or (positions == 'registered' and
+                             registered_positions(well) is None)
+    if fiji and not _on_disk(well):
+        raise ValueError('stitching with Fiji needs images on the local file '
+                         'system, {} is packed or remote. Fuse with '
+                         'positions and flatfield instead.'.format(well))
+    if positions == 'registered':
+        if registered_positions(well) is None:
+            # fused with flat-field correction below, keep Fiji output apart
+            register_folder = folder
+            if flatfield:
+                from tempfile import mkdtemp
+                register_folder = mkdtemp(prefix='matrixscreener-')
+            output, macro = register_macro(well, register_folder)
+            with stage('fiji', file=well):
+                fijibin.macro.run([macro], [output])
+            if register_folder != folder:
+                import shutil
+                shutil.rmtree(register_folder, ignore_errors=True)
+        if flatfield:
+            positions = registered_positions(well)
+
+    if flatfield:
+        if not positions:
+            raise ValueError('no tile positions for {}'.format(well))
+        files = fuse_blocking(fuse_jobs(well, folder, positions), flatfield)
+    else:
+        files, macros = stitch_macro(well, folder, positions)
+        if macros:
+            with stage('fiji', file=well):
+                fijibin.macro.run(macros, files)
+
+    missing = [f for f in files if not storage_for(f).exists(f)]
+    if missing:
+        raise IOError('stitched image not written: {}'.format(
+            ', '.join(missing)))
+    return files
+
+
+class _StitchState(object):
+    "State of stitched wells, saved as json in filename."
+
+    def __init__(self, filename):
+        import json
+        self.filename = filename
+        self.storage = storage_for(filename)
+        self.wells = {}
+        if self.storage.exists(self.filename):
+            try:
+                self.wells = json.loads(
+                    self.storage.read(self.filename).decode('utf-8'))['wells']
+            except (IOError, ValueError, KeyError) as e:
+                print('matrixscreener ignoring {}: {}'.format(
+                    self.filename, e))
+
+    def get(self, well):
+        "State of well, None if not stitched before."
+        return self.wells.get(well)
+
+    def set(self, well, result, options):
+        """Save result of well. Wells saved by others, such as workers of
+        :mod:`matrixscreener.distributed`, are read before writing."""
+        import json
+        if self.storage.exists(self.filename):
+            try:
+                self.wells.update(json.loads(self.storage.read(
+                    self.filename).decode('utf-8'))['wells'])
+            except (IOError, ValueError, KeyError):
+                pass
+        self.wells[well] = {
+            'status': 'failed' if result['error'] else 'done',
+            'files': result['files'],
+            'error': result['error'],
+            'attempts': result['attempts'],
+            'options': options,
+        }
+        self.storage.write(self.filename, json.dumps(
+            {'wells': self.wells}, indent=2, sort_keys=True).encode('utf-8'))
+
+
+def _stitch_memory(items):
+    """Estimated memory of stitching wells in items, one at a time: Fiji,
+    tiles of one plane and fused image."""
+    memory = 0
+    for well, _ in items:
+        fields = storage_for(well).glob(_pattern(well, _field))
+        tile = image_memory(_images(fields[0])[:1]) if fields else 0
+        memory = max(memory, _fiji_memory + 2 * len(fields) * tile)
+    return memory
+
+
+def _decompress_memory(images):
+    "Estimated memory of decompressing images, one at a time."
+    return image_memory(images, 3)
+
+
+def _projection_memory(groups):
+    """Estimated memory of projecting or previewing groups from
+    :func:`projections`, one at a time: largest image, result and buffer."""
+    return image_memory([image for _, images in groups for image in images],
+                        3)
+
+
+def register_macro(path, output_folder=None):
+    """Create fiji-macro which computes overlap between tiles of first channel
+    and z-stack of a well. Fiji saves the registered positions in
+    ``TileConfiguration.registered.txt`` in the well, which can be reused for
+    all channels and z-stacks with ``stitch_macro(path,
+    positions='registered')``.
+
+    Parameters
+    ----------
+    path : string
+        Well path.
+    output_folder : string
+        Folder to store stitched image of first channel and z-stack. If not
+        given well path is used.
+
+    Returns
+    -------
+    output_file, macro : tuple
+        Filename of stitched image and macro.
+    """
+    import fijibin.macro
+    output_folder = output_folder or path
+    grid, planes = _stitch_planes(path)
+    _, _, filenames = planes[0]
+    output = os.path.join(output_folder, _stitched_filename(filenames))
+    debug('registering ' + path + ' with ' + filenames)
+    return output, fijibin.macro.stitch(path, filenames,
+                                        output_filename=output, **grid)
+
+
+def fuse_jobs(path, output_folder, positions):
+    """Tiles of every plane in well, for :func:`fuse_blocking`.
+
+    Parameters
+    ----------
+    path : string
+        Well path.
+    output_folder : string
+        Folder to store stitched images.
+    positions : dict
+        (X, Y) of field -> (x, y) position in pixels.
+
+    Returns
+    -------
+    list of tuples
+        (output_filename, [(image, (x, y)), ...]) for every plane.
+    """
+    _, planes = _stitch_planes(path)
+    jobs = []
+    for _, _, filenames in planes:
+        output = os.path.join(output_folder, _stitched_filename(filenames))
+        tiles = [(os.path.join(path, filenames.format(xx='%02d' % X,
+                                                      yy='%02d' % Y)), xy)
+                 for (X, Y), xy in sorted(positions.items())]
+        jobs.append((output, tiles))
+    return jobs
+
+
+def fuse_blocking(jobs, flatfield=None):
+    """Fuse tiles at positions with linear blending, correcting tiles with
+    flat-field profiles while they are read.
+
+    Parameters
+    ----------
+    jobs : list of tuples
+        (output_filename, [(image, (x, y)), ...]), see :func:`fuse_jobs`.
+    flatfield : dict
+        Channel -> flat-field profile, see
+        :func:`matrixscreener.flatfield.profiles`.
+
+    Returns
+    -------
+    list of filenames
+        Fused images, files which already exists are also returned.
+    """
+    import numpy as np
+    from .flatfield import read
+
+    fused = []
+    for output, tiles in jobs:
+        fused.append(output)
+        if storage_for(output).exists(output):
+            print('matrixscreener stitched file already exists {}'.format(output))
+            continue
+        debug('fusing {} tiles to {}'.format(len(tiles), output))
+        xs = [int(round(x)) for _, (x, _) in tiles]
+        ys = [int(round(y)) for _, (_, y) in tiles]
+        x_min, y_min = min(xs), min(ys)
+        canvas = weights = ramp = dtype = None
+        for (image, _), x, y in zip(tiles, xs, ys):
+            with stage('fuse', file=image):
+                data = read(image, flatfield)
+                h, w = data.shape[:2]
+                if canvas is None:
+                    dtype = data.dtype
+                    height = max(ys) - y_min + h
+                    width = max(xs) - x_min + w
+                    canvas = np.zeros((height, width), dtype=np.float32)
+                    weights = np.zeros((height, width), dtype=np.float32)
+                    # weight by distance to tile edge
+                    ramp = np.minimum.outer(
+                        np.minimum(np.arange(1, h + 1), np.arange(h, 0, -1)),
+                        np.minimum(np.arange(1, w + 1), np.arange(w, 0, -1))
+                    ).astype(np.float32)
+                region = (slice(y - y_min, y - y_min + h),
+                          slice(x - x_min, x - x_min + w))
+                canvas[region] += data * ramp
+                weights[region] += ramp
+        np.maximum(weights, 1e-6, out=weights)
+        canvas /= weights
+        _save_png(output, canvas.round().astype(dtype))
+    return fused
+
+
+def _stitch_planes(path):
+    """Grid of fields and filename patterns of every plane in well.
+
+    Returns
+    -------
+    grid, planes : dict, list
+        Keyword arguments for ``fijibin.macro.stitch`` with grid size and
+        start, and list of tuples (Z, C, filenames) where filenames has
+        ``{xx}`` and ``{yy}`` in place of field X and Y.
+    """
+    storage = storage_for(path)
+    fields = storage.glob(_pattern(path, _field))
 
     # assume we have rectangle of fields
     xs = [attribute(field, 'X') for field in fields]
     ys = [attribute(field, 'Y') for field in fields]
-    x_min, x_max = min(xs), max(xs)
-    y_min, y_max = min(ys), max(ys)
-    fields_x = len(set(xs))
-    fields_y = len(set(ys))
+    grid = {
+        'x_size': len(set(xs)),
+        'y_size': len(set(ys)),
+        'x_start': min(xs),
+        'y_start': min(ys),
+    }
 
     # assume all fields are the same
     # and get properties from images in first field
-    images = glob(_pattern(fields[0], _image))
+    images = storage.glob(_pattern(fields[0], _image))
 
     # assume attributes are the same on all images
     attr = attributes(images[0])
@@ -205,13 +975,11 @@ def stitch_macro(path, output_folder=None):
     debug('channels ' + str(channels))
     debug('z-stacks ' + str(z_stacks))
 
-    # create macro
     _, extension = os.path.splitext(images[-1])
     if extension == '.tif':
         # assume .ome.tif
         extension = '.ome.tif'
-    macros = []
-    output_files = []
+    planes = []
     for Z in z_stacks:
         for C in channels:
             filenames = (_field + '--X{xx}--Y{yy}/' +
@@ -228,29 +996,59 @@ def stitch_macro(path, output_folder=None):
                     '--C' + C +
                     extension)
             debug('filenames ' + filenames)
+            planes.append((Z, C, filenames))
+    return grid, planes
 
-            cur_attr = attributes(filenames)._asdict()
-            output_file = 'stitched--U{U}--V{V}--C{C}--Z{Z}.png'.format(**cur_attr)
-
-            output = os.path.join(output_folder, output_file)
-            debug('output ' + output)
-            output_files.append(output)
-            if os.path.isfile(output):
-                # file already exists
-                print('matrixscreener stitched file already exists {}'.format(output))
-                continue
-            macros.append(fijibin.macro.stitch(path, filenames,
-                                  fields_x, fields_y,
-                                  output_filename=output,
-                                  x_start=x_min, y_start=y_min))
 
-    return (output_files, macros)
+def _stitched_filename(filenames):
+    "Filename of stitched image of plane with filename pattern filenames."
+    cur_attr = attributes(filenames)._asdict()
+    return 'stitched--U{U}--V{V}--C{C}--Z{Z}.png'.format(**cur_attr)
+
+
+def fuse_macro(folder, layout_file, output_filename):
+    """Create fiji-macro which fuses tiles at positions in a TileConfiguration,
+    without computing overlap.
 
+    Parameters
+    ----------
+    folder : string
+        Folder with TileConfiguration. Images in TileConfiguration are
+        relative to folder.
+    layout_file : string
+        Filename of TileConfiguration in folder.
+    output_filename : string
+        Where to store fused image. Should be ``.png``.
 
-def compress(images, delete_tif=False, folder=None):
+    Returns
+    -------
+    string
+        IJM-macro.
+    """
+    macro = []
+    macro.append('run("Grid/Collection stitching",')
+    macro.append('"type=[Positions from file]')
+    macro.append('order=[Defined by TileConfiguration]')
+    macro.append('directory=[{}]'.format(folder))
+    macro.append('layout_file=[{}]'.format(layout_file))
+    macro.append('fusion_method=[Linear Blending]')
+    macro.append('regression_threshold=0.30')
+    macro.append('max/avg_displacement_threshold=2.50')
+    macro.append('absolute_displacement_threshold=3.50')
+    macro.append('subpixel_accuracy')
+    macro.append('computation_parameters=[Save computation time (but use more RAM)]')
+    macro.append('image_output=[Fuse and display]");')
+    macro.append('selectWindow("Fused");')
+    macro.append('saveAs("PNG", "{}");'.format(output_filename))
+    macro.append('close();')
+    return ' '.join(macro)
+
+
+def compress(images, delete_tif=False, folder=None, prefetch=2, dedup=None):
     """Lossless compression. Save images as PNG and TIFF tags to json. Can be
     reversed with `decompress`. Will run in multiprocessing, where
-    number of workers is decided by ``matrixscreener.experiment._pools``.
+    number of workers is decided by ``matrixscreener.utils._pools`` and the
+    memory budget ``matrixscreener.utils._memory_limit``.
 
     Parameters
     ----------
@@ -260,6 +1058,11 @@ def compress(images, delete_tif=False, folder=None):
         Wheter to delete original images.
     folder : string
         Where to store images. Basename will be kept.
+    prefetch : int
+        Files read ahead and written behind in every worker, see
+        :func:`compress_blocking`.
+    dedup : string
+        Content store for deduplication, see :func:`compress_blocking`.
 
     Returns
     -------
@@ -268,24 +1071,52 @@ def compress(images, delete_tif=False, folder=None):
     """
     if type(images) == str:
         # only one image
-        return compress_blocking([images], delete_tif, folder)
+        return compress_blocking([images], delete_tif, folder, prefetch,
+                                 dedup)
 
     filenames = copy(images) # as images property will change when looping
 
-    return apply_async(compress_blocking, images=(filenames, True),
-                       delete_tif=(delete_tif, False), folder=(folder, False))
+    def memory(chunk):
+        return _compress_memory(chunk, prefetch)
+
+    return apply_budgeted(compress_blocking, filenames, memory,
+                          delete_tif=delete_tif, folder=folder,
+                          prefetch=prefetch, dedup=dedup)
+
+
+def _compress_memory(images, prefetch=2):
+    "Estimated memory of compressing images, one at a time."
+    # read ahead and written behind files + decoded image and buffers
+    return image_memory(images, 3) + 2 * prefetch * max(
+        [storage_for(f).size(f) for f in images] or [0])
 
 
-def compress_blocking(images, delete_tif=False, folder=None):
+def compress_blocking(images, delete_tif=False, folder=None, prefetch=2,
+                      dedup=None):
     """Lossless compression. Save images as PNG and TIFF tags to json. Process
     can be reversed with `decompress`.
 
+    Reading and writing files is done in threads, such that I/O overlaps with
+    decoding/encoding (zlib releases the GIL).
+
     Parameters
     ----------
     images : list of filenames
         Images to lossless compress.
     delete_tif : bool
         Wheter to delete original images.
+    folder : string
+        Where to store images. Basename will be kept.
+    prefetch : int
+        Number of files read ahead and written behind. 0 reads and writes
+        sequentially in the calling thread.
+    dedup : string
+        Folder of content store. If given, pixel data is hashed and images
+        with identical pixels are stored once: the PNG is a hard link to
+        ``<hash>.png`` in the content store. Every image keeps its own json
+        with TIFF tags, such that :func:`decompress` rebuilds originals.
+        Images are stored in full if the file system does not support hard
+        links. Must be on the same file system as PNGs, which must be local.
 
     Returns
     -------
@@ -294,70 +1125,363 @@ def compress_blocking(images, delete_tif=False, folder=None):
     """
     if type(images) == str:
         # only one image
-        return compress_blocking([images], delete_tif, folder)
+        return compress_blocking([images], delete_tif, folder, prefetch,
+                                 dedup)
+
+    if dedup and not is_local(_compressed_filename(images[0], folder)):
+        raise ValueError('dedup needs PNGs on the local file system')
+    if dedup and not os.path.isdir(dedup):
+        try:
+            os.makedirs(dedup)
+        except OSError:
+            # created by other worker
+            pass
 
     filenames = copy(images) # as images property will change when looping
 
+    # skip images which should not be compressed before reading them
+    todo = []
     compressed_images = []
     for orig_filename in filenames:
-        debug('compressing {}'.format(orig_filename))
         try:
-            new_filename, extension = os.path.splitext(orig_filename)
-            # remove last occurrence of .ome
-            new_filename = new_filename.rsplit('.ome', 1)[0]
-
-            # if compressed file should be put in specified folder
-            if folder:
-                basename = os.path.basename(new_filename)
-                new_filename = os.path.join(folder, basename + '.png')
-            else:
-                new_filename = new_filename + '.png'
-
+            new_filename = _compressed_filename(orig_filename, folder)
             # check if png exists
-            if os.path.isfile(new_filename):
+            if storage_for(new_filename).exists(new_filename):
                 compressed_images.append(new_filename)
                 msg = "Aborting compress, PNG already exists: {}".format(new_filename)
                 raise AssertionError(msg)
-            if extension != '.tif':
+            if not orig_filename.endswith('.tif'):
                 msg = "Aborting compress, not a TIFF: {}".format(orig_filename)
                 raise AssertionError(msg)
-
-            # open image, load and close file pointer
-            img = Image.open(orig_filename)
-            img.load() # load img-data before switching mode, also closes fp
-
-            # get tags and save them as json
-            tags = img.tag.as_dict()
-            with open(new_filename[:-4] + '.json', 'w') as f:
-                if img.mode == 'P':
-                    # keep palette
-                    tags['palette'] = img.getpalette()
-                json.dump(tags, f)
-
-            # check if image is palette-mode
-            if img.mode == 'P':
-                # switch to luminance to keep data intact
-                debug('palette-mode switched to luminance')
-                img.mode = 'L'
-            if img.mode == 'I;16':
-                # https://github.com/python-pillow/Pillow/issues/1099
-                img = img.convert(mode='I')
-
-            # compress/save
-            debug('saving to {}'.format(new_filename))
-            img.save(new_filename)
-            compressed_images.append(new_filename)
-
-            if delete_tif:
-                os.remove(orig_filename)
-
-        except (IOError, AssertionError) as e:
+            todo.append((orig_filename, new_filename))
+        except AssertionError as e:
             # print error - continue
             print('matrixscreener {}'.format(e))
 
+    readers = writers = None
+    reads, writes = [], []
+    if prefetch:
+        from concurrent.futures import ThreadPoolExecutor
+        readers = ThreadPoolExecutor(prefetch)
+        writers = ThreadPoolExecutor(prefetch)
+    try:
+        if prefetch:
+            reads = [readers.submit(_read, f) for f, _ in todo[:prefetch]]
+
+        for i, (orig_filename, new_filename) in enumerate(todo):
+            debug('compressing {}'.format(orig_filename))
+            try:
+                if prefetch:
+                    if i + prefetch < len(todo):
+                        reads.append(
+                            readers.submit(_read, todo[i + prefetch][0]))
+                    data = reads[i].result()
+                    reads[i] = None  # release memory
+                else:
+                    data = _read(orig_filename)
+                tags, png, stored = _encode(data, dedup)
+                del data
+                if prefetch:
+                    # limit number of encoded images waiting to be written
+                    if len(writes) >= prefetch:
+                        _wait(writes[-prefetch])
+                    writes.append(writers.submit(
+                        _write_compressed, orig_filename, new_filename, tags,
+                        png, delete_tif, stored))
+                else:
+                    writes.append(_write_compressed(
+                        orig_filename, new_filename, tags, png, delete_tif,
+                        stored))
+            except IOError as e:
+                # print error - continue
+                print('matrixscreener {}'.format(e))
+
+        for write in writes:
+            if prefetch:
+                write = _wait(write)
+            if write:
+                compressed_images.append(write)
+    finally:
+        # on errors, skip reads not started and finish writes started
+        for read in reads:
+            if read is not None:
+                read.cancel()
+        if readers:
+            readers.shutdown()
+        if writers:
+            writers.shutdown()
+
     return compressed_images
 
 
+def _compressed_filename(orig_filename, folder=None):
+    "PNG filename of image, in folder if given."
+    new_filename, extension = os.path.splitext(orig_filename)
+    # remove last occurrence of .ome
+    new_filename = new_filename.rsplit('.ome', 1)[0]
+
+    # if compressed file should be put in specified folder
+    if folder:
+        basename = os.path.basename(new_filename)
+        return os.path.join(folder, basename + '.png')
+    return new_filename + '.png'
+
+
+def _read(filename):
+    "Read file to bytes, from storage backend of filename."
+    with stage('read', file=filename) as s:
+        data = storage_for(filename).read(filename)
+        s.bytes = len(data)
+    return data
+
+
+def _encode(data, dedup=None):
+    """Decode TIFF bytes and encode it as PNG. If dedup is given, encoding is
+    skipped when the content store has an image with the same pixels.
+
+    Returns
+    -------
+    tags, png, stored : dict, bytes, string
+        TIFF tags (palette and checksum of pixels), PNG bytes (None if found
+        in content store) and filename in content store (None if dedup is not
+        given).
+    """
+    from io import BytesIO
+    from PIL import Image
+
+    # open image, load and close file pointer
+    with stage('decode', len(data)):
+        img = Image.open(BytesIO(data))
+        img.load() # load img-data before switching mode, also closes fp
+
+    # get tags
+    with stage('tags'):
+        tags = img.tag.as_dict()
+        if img.mode == 'P':
+            # keep palette
+            tags['palette'] = img.getpalette()
+
+    # check if image is palette-mode
+    if img.mode == 'P':
+        # switch to luminance to keep data intact
+        debug('palette-mode switched to luminance')
+        img.mode = 'L'
+    if img.mode == 'I;16':
+        # https://github.com/python-pillow/Pillow/issues/1099
+        img = img.convert(mode='I')
+
+    # checksum of pixels, see verify
+    with stage('hash'):
+        tags['checksum'] = _pixel_hash(img)
+
+    stored = None
+    if dedup:
+        stored = os.path.join(dedup, tags['checksum'] + '.png')
+        if os.path.isfile(stored):
+            debug('identical pixels in {}'.format(stored))
+            return tags, None, stored
+
+    with stage('encode') as s:
+        png = BytesIO()
+        img.save(png, format='PNG')
+        s.bytes = png.tell()
+    return tags, png.getvalue(), stored
+
+
+def _pixel_hash(img):
+    "Hex digest of mode, size and pixels of PIL image."
+    import hashlib
+    if img.mode.startswith('I;16'):
+        # 16 bit PNGs open as I or I;16 depending on Pillow version
+        img = img.convert('I')
+    try:
+        h = hashlib.blake2b(digest_size=20)
+    except AttributeError:
+        # python < 3.6
+        h = hashlib.sha1()
+    h.update('{} {} {}'.format(img.mode, *img.size).encode('ascii'))
+    h.update(img.tobytes())
+    return h.hexdigest()
+
+
+def _write_compressed(orig_filename, new_filename, tags, png, delete_tif,
+                      stored=None):
+    """Write tags as json and PNG. PNG is written to a temporary file which is
+    renamed when done, such that an existing PNG always is complete, also if
+    process is killed. Returns new_filename.
+
+    If stored is given, PNG is a hard link to stored in content store. If png
+    is None, it is linked from content store, else it is added to it."""
+    import json
+
+    storage = storage_for(new_filename)
+    with stage('json', file=new_filename[:-4] + '.json'):
+        storage.write(new_filename[:-4] + '.json',
+                      json.dumps(tags).encode('utf-8'))
+
+    debug('saving to {}'.format(new_filename))
+    with stage('write', len(png or b''), file=new_filename):
+        if stored:
+            _write_png(new_filename, png, stored)
+        else:
+            storage.write(new_filename, png)
+
+    if delete_tif:
+        storage_for(orig_filename).remove(orig_filename)
+    return new_filename
+
+
+def _write_png(new_filename, png, stored):
+    "Write PNG bytes, or link from content store if png is None."
+    if png is None:
+        try:
+            _link(stored, new_filename)
+        except OSError:
+            # removed from content store since encoding, store in full
+            with open(stored, 'rb') as f:
+                png = f.read()
+    if png is not None:
+        tmp = temporary(new_filename)
+        with open(tmp, 'wb') as f:
+            f.write(png)
+        os.rename(tmp, new_filename)
+        if stored and not os.path.isfile(stored):
+            try:
+                _link(new_filename, stored)
+            except OSError as e:
+                debug('not deduplicating: {}'.format(e))
+
+
+def verify(images):
+    """Check that compressed images decode to the pixels and TIFF tags of
+    their source, in parallel and without writing files. If the source
+    OME-TIFF is gone, pixels are compared against the checksum stored on
+    compression.
+
+    Parameters
+    ----------
+    images : list of filenames
+        PNG images.
+
+    Returns
+    -------
+    list of dicts
+        ``image`` and ``error`` for every mismatch, empty if all images are
+        ok.
+    """
+    if type(images) == str:
+        # only one image
+        return verify_blocking([images])
+    return apply_budgeted(verify_blocking, list(images), _verify_memory)
+
+
+def verify_blocking(images):
+    """Verify images in this process, see :func:`verify`.
+
+    Parameters
+    ----------
+    images : list of filenames
+        PNG images.
+
+    Returns
+    -------
+    list of dicts
+        ``image`` and ``error`` for every mismatch.
+    """
+    import json
+    import numpy as np
+    from PIL import Image
+
+    errors = []
+    for image in images:
+        debug('verifying {}'.format(image))
+        try:
+            storage = storage_for(image)
+            filename = os.path.splitext(image)[0]
+            tags = json.loads(storage.read(filename + '.json').decode('utf-8'))
+            with storage.open(image) as f:
+                img = Image.open(f)
+                img.load()
+
+            source = filename + '.ome.tif'
+            if storage.exists(source):
+                with storage.open(source) as f:
+                    orig = Image.open(f)
+                    orig.load()
+                if not np.array_equal(np.asarray(orig), np.asarray(img)):
+                    raise ValueError('pixels differ from ' + source)
+                orig_tags = json.loads(json.dumps(orig.tag.as_dict()))
+                stored_tags = dict((k, v) for k, v in tags.items()
+                                   if k.isdigit())
+                if orig_tags != stored_tags:
+                    raise ValueError('TIFF tags differ from ' + source)
+            elif 'checksum' in tags:
+                if _pixel_hash(img) != tags['checksum']:
+                    raise ValueError('pixels differ from checksum')
+            else:
+                raise ValueError('no source or checksum to compare with')
+        except (IOError, ValueError, SyntaxError) as e:
+            errors.append({'image': image, 'error': str(e)})
+    return errors
+
+
+def _verify_memory(images):
+    "Estimated memory of verifying images, one at a time."
+    return image_memory(images, 3)
+
+
+def _link(source, destination):
+    "Hard link source to destination through a temporary file."
+    tmp = temporary(destination)
+    if not hasattr(os, 'link'):
+        raise OSError('hard links are not supported')
+    os.link(source, tmp)
+    os.rename(tmp, destination)
+
+
+def dedup_stats(images):
+    """Deduplication ratio of compressed images, counted from hard links.
+
+    Parameters
+    ----------
+    images : list of filenames
+        PNG images.
+
+    Returns
+    -------
+    dict
+        ``files`` and ``unique`` number of images, ``bytes`` of all images,
+        ``stored_bytes`` on disk and ``ratio`` of bytes to stored bytes.
+    """
+    files = 0
+    total = 0
+    inodes = {}
+    for image in images:
+        if not os.path.isfile(image):
+            continue
+        stat = os.stat(image)
+        files += 1
+        total += stat.st_size
+        inodes[(stat.st_dev, stat.st_ino)] = stat.st_size
+    stored = sum(inodes.values())
+    return {
+        'files': files,
+        'unique': len(inodes),
+        'bytes': total,
+        'stored_bytes': stored,
+        'ratio': round(float(total) / stored, 3) if stored else 1.0,
+    }
+
+
+def _wait(future):
+    "Result of future, None and print error message if IOError."
+    try:
+        return future.result()
+    except IOError as e:
+        print('matrixscreener {}'.format(e))
+        return None
+
+
 
 def decompress(images, delete_png=False, delete_json=False, folder=None):
     """Reverse compression from tif to png and save them in original format
@@ -383,6 +1507,10 @@ def decompress(images, delete_png=False, delete_json=False, folder=None):
         # only one image
         return decompress([images])
 
+    import json
+    from io import BytesIO
+    from PIL import Image
+
     filenames = copy(images) # as images property will change when looping
 
     decompressed_images = []
@@ -398,8 +1526,11 @@ def decompress(images, delete_png=False, delete_json=False, folder=None):
             else:
                 new_filename = filename + '.ome.tif'
 
+            storage = storage_for(new_filename)
+            source = storage_for(orig_filename)
+
             # check if tif exists
-            if os.path.isfile(new_filename):
+            if storage.exists(new_filename):
                 decompressed_images.append(new_filename)
                 msg = "Aborting decompress, TIFF already exists: {}".format(orig_filename)
                 raise AssertionError(msg)
@@ -407,25 +1538,26 @@ def decompress(images, delete_png=False, delete_json=False, folder=None):
                 msg = "Aborting decompress, not a PNG: {}".format(orig_filename)
                 raise AssertionError(msg)
 
-            # open image, load and close file pointer
-            img = Image.open(orig_filename)
-            img.load() # load img-data before switching mode, also closes fp
+            # png and json are read concurrently from remote storage
+            png, tags = source.read_many([orig_filename, filename + '.json'])
+            img = Image.open(BytesIO(png))
+            img.load() # load img-data before switching mode
+            del png
 
             # get tags from json
             info = {}
-            with open(filename + '.json', 'r') as f:
-                tags = json.load(f)
-                # convert dictionary to original types (lost in json conversion)
-                for tag,val in tags.items():
-                    if tag == 'palette':
-                        # hack hack
-                        continue
-                    if type(val) == list:
-                        val = tuple(val)
-                    if type(val[0]) == list:
-                        # list of list
-                        val = tuple(tuple(x) for x in val)
-                    info[int(tag)] = val
+            tags = json.loads(tags.decode('utf-8'))
+            # convert dictionary to original types (lost in json conversion)
+            for tag,val in tags.items():
+                if not tag.isdigit():
+                    # palette and checksum, hack hack
+                    continue
+                if type(val) == list:
+                    val = tuple(val)
+                if type(val[0]) == list:
+                    # list of list
+                    val = tuple(tuple(x) for x in val)
+                info[int(tag)] = val
 
             # check for color map
             if 'palette' in tags:
@@ -433,13 +1565,16 @@ def decompress(images, delete_png=False, delete_json=False, folder=None):
 
             # save as tif
             debug('saving to {}'.format(new_filename))
-            img.save(new_filename, tiffinfo=info)
+            tif = BytesIO()
+            img.save(tif, format='TIFF', tiffinfo=info)
+            storage.write(new_filename, tif.getvalue())
+            del tif
             decompressed_images.append(new_filename)
 
             if delete_png:
-                os.remove(orig_filename)
+                source.remove(orig_filename)
             if delete_json:
-                os.remove(filename + '.json')
+                source.remove(filename + '.json')
 
         except (IOError, AssertionError) as e:
             # print error - continue
@@ -448,6 +1583,200 @@ def decompress(images, delete_png=False, delete_json=False, folder=None):
     return decompressed_images
 
 
+def projections(images, folder, prefix='projected'):
+    """Group images for z-projection. Images with equal attributes except Z
+    are grouped. If both TIFF and PNG of an image exists, TIFF is used.
+
+    Parameters
+    ----------
+    images : list of filenames
+        Images to group.
+    folder : string
+        Where projections should be stored.
+    prefix : string
+        Start of output filenames.
+
+    Returns
+    -------
+    list of tuples
+        (output_filename, images) for every projection.
+    """
+    groups = {}
+    for image in images:
+        attr = attributes(image)
+        key = prefix + '--U{}--V{}--X{}--Y{}--T{}--C{}.png'.format(
+            attr.U, attr.V, attr.X, attr.Y, attr.T, attr.C)
+        stem = image.rsplit('.ome.tif', 1)[0].rsplit('.png', 1)[0]
+        group = groups.setdefault(os.path.join(folder, key), {})
+        if stem not in group or image.endswith('.tif'):
+            group[stem] = image
+    return [(output, [group[k] for k in sorted(group)])
+            for output, group in sorted(groups.items())]
+
+
+def project_blocking(groups, method='max', flatfield=None):
+    """Z-project groups of images. See :func:`projections`.
+
+    Parameters
+    ----------
+    groups : list of tuples
+        (output_filename, images) for every projection.
+    method : string
+        ``'max'``, ``'min'`` or ``'mean'`` intensity projection.
+    flatfield : dict
+        Channel -> flat-field profile, see
+        :func:`matrixscreener.flatfield.profiles`.
+
+    Returns
+    -------
+    list of filenames
+        Projections written. Files which already exists are also returned.
+    """
+    import numpy as np
+    from .flatfield import read
+
+    reduce_ = {'max': np.maximum, 'min': np.minimum, 'mean': np.add}[method]
+
+    projected = []
+    for output, images in groups:
+        if storage_for(output).exists(output):
+            projected.append(output)
+            print('matrixscreener projection already exists {}'.format(output))
+            continue
+        debug('projecting {} images to {}'.format(len(images), output))
+        result = None
+        for image in images:
+            data = read(image, flatfield)
+            if result is None:
+                dtype = data.dtype
+                result = data.astype(np.float64 if method == 'mean'
+                                     else data.dtype)
+            else:
+                reduce_(result, data, out=result)
+        if method == 'mean':
+            result = (result / len(images)).round().astype(dtype)
+        _save_png(output, result)
+        projected.append(output)
+    return projected
+
+
+def preview_blocking(groups, scale=0.1, flatfield=None):
+    """Downsampled maximum z-projection of groups of images. See
+    :func:`projections` and :meth:`Experiment.previews`.
+
+    Images are downsampled by block mean before they are projected, and
+    previews which are newer than all images in group are not created again.
+
+    Parameters
+    ----------
+    groups : list of tuples
+        (output_filename, images) for every preview.
+    scale : float
+        Size of preview relative to images, rounded to 1/n.
+    flatfield : dict
+        Channel -> flat-field profile, see
+        :func:`matrixscreener.flatfield.profiles`.
+
+    Returns
+    -------
+    list of filenames
+        Previews, including previews which already are up to date.
+    """
+    import numpy as np
+    from .flatfield import read
+
+    factor = max(1, int(round(1 / scale)))
+    previews = []
+    for output, images in groups:
+        previews.append(output)
+        if _up_to_date(output, images):
+            continue
+        debug('preview of {} images to {}'.format(len(images), output))
+        result = None
+        for image in images:
+            data = _downsample(read(image, flatfield), factor)
+            if result is None:
+                result = data
+            else:
+                np.maximum(result, data, out=result)
+        _save_png(output, result)
+    return previews
+
+
+def montages(fields, folder):
+    """Well and plate montages of field previews, see
+    :meth:`Experiment.previews`.
+
+    Parameters
+    ----------
+    fields : list of filenames
+        Field previews.
+    folder : string
+        Where to store montages.
+
+    Returns
+    -------
+    list of filenames
+        Well montages followed by plate montages.
+    """
+    wells = {}
+    for field in fields:
+        attr = attributes(field)
+        output = os.path.join(folder, 'preview--U{}--V{}--T{}--C{}.png'
+                              .format(attr.U, attr.V, attr.T, attr.C))
+        wells.setdefault(output, {})[(attr.x, attr.y)] = field
+    plates = {}
+    for output, tiles in sorted(wells.items()):
+        montage(tiles, output)
+        attr = attributes(output)
+        plate = os.path.join(folder, 'preview--T{}--C{}.png'.format(
+            attr.T, attr.C))
+        plates.setdefault(plate, {})[(attr.u, attr.v)] = output
+    for output, tiles in sorted(plates.items()):
+        montage(tiles, output)
+    return sorted(wells) + sorted(plates)
+
+
+def montage(tiles, output):
+    """Place equally sized previews in a grid and save as one image. Montage
+    is not created again if it is newer than all tiles.
+
+    Parameters
+    ----------
+    tiles : dict
+        (column, row) -> filename.
+    output : string
+        Where to save montage.
+
+    Returns
+    -------
+    string
+        Filename of montage.
+    """
+    import numpy as np
+    from PIL import Image
+
+    if _up_to_date(output, tiles.values()):
+        return output
+    data = {}
+    for k, f in tiles.items():
+        with storage_for(f).open(f) as fp:
+            data[k] = np.asarray(Image.open(fp))
+    height = max(d.shape[0] for d in data.values())
+    width = max(d.shape[1] for d in data.values())
+    columns = sorted(set(c for c, _ in data))
+    rows = sorted(set(r for _, r in data))
+    first = next(iter(data.values()))
+    result = np.zeros((len(rows) * height, len(columns) * width) +
+                      first.shape[2:], dtype=first.dtype)
+    for (column, row), d in data.items():
+        y = rows.index(row) * height
+        x = columns.index(column) * width
+        result[y:y + d.shape[0], x:x + d.shape[1]] = d
+    _save_png(output, result)
+    return output
+
+
 def attribute(path, name):
     """Returns the two numbers found behind --[A-Z] in path. If several matches
     are found, the last one is returned.
@@ -530,6 +1859,60 @@ def attributes(path):
 
 
 # helper functions
+def _images(path):
+    """Sorted list of TIFF and PNG images in well or field path, listed
+    through storage of path."""
+    if os.path.basename(path).startswith(_field):
+        pattern = _pattern(path, _image)
+    else:
+        pattern = _pattern(_pattern(path, _field), _image)
+    return sorted(storage_for(path).glob(pattern + 'tif', pattern + 'png'))
+
+
+def _on_disk(path):
+    "Whether files below path are plain files on the local file system."
+    return type(storage_for(path)) is LocalStorage
+
+
+def _mtime(path):
+    "Modification time of file from its storage, None if it does not exist."
+    info = storage_for(path).info(path)
+    return info[1] if info else None
+
+
+def _up_to_date(output, sources):
+    "True if output exists and is newer than all sources."
+    mtime = _mtime(output)
+    if mtime is None:
+        return False
+    return all((_mtime(source) or 0) <= mtime for source in sources)
+
+
+def _downsample(data, factor):
+    "Block mean of 2D image, keeps dtype."
+    if factor == 1:
+        return data
+    h = data.shape[0] // factor * factor
+    w = data.shape[1] // factor * factor
+    blocks = data[:h, :w].reshape((h // factor, factor, w // factor, factor)
+                                  + data.shape[2:])
+    return blocks.mean(axis=(1, 3)).round().astype(data.dtype)
+
+
+def _save_png(output, data):
+    """Save array as PNG through storage of output, which writes complete
+    files only."""
+    from io import BytesIO
+    import numpy as np
+    from PIL import Image
+    if data.dtype == np.uint16:
+        # https://github.com/python-pillow/Pillow/issues/1099
+        data = data.astype(np.int32)
+    png = BytesIO()
+    Image.fromarray(data).save(png, format='PNG')
+    storage_for(output).write(output, png.getvalue())
+
+
 def _pattern(*names, **kwargs):
     """Returns globbing pattern for name1/name2/../lastname + '--*' or
     name1/name2/../lastname + extension if parameter `extension` it set.
@@ -557,6 +1940,11 @@ def _pattern(*names, **kwargs):
 def _set_path(self, path):
     "Set self.path, self.dirname and self.basename."
     import os.path
-    self.path = os.path.abspath(path)
+    if '://' in path:
+        # URL of remote storage
+        path = path.rstrip('/')
+        self.path = path
+    else:
+        self.path = os.path.abspath(path)
     self.dirname = os.path.dirname(path)
     self.basename = os.path.basename(path)
@@ -0,0 +1,241 @@
+# encoding: utf-8
+"""
+Feedback scans: analyze fields of a prescan while it is running and scan
+the objects found with another job. Every field of the prescan is given to
+a user function in a pool of workers as soon as the scan has moved on to
+the next field. Objects found are added to the CAM list as soon as their
+field is analyzed, and the CAM scan is started when the prescan is done.
+
+Example
+-------
+>>> from matrixscreener.cam import CAM
+>>> from matrixscreener.feedback import Feedback
+>>> def find_cells(images):
+...     # return offsets from field center, as given to /dxpos and /dypos
+...     return [(10, -20), (300, 40)]
+>>> cam = CAM()
+>>> feedback = Feedback('/path/to/prescan--', find_cells, cam, job='job2')
+>>> cam.start_scan()
+>>> while scanning:
+...     for msg in cam.receive() or []:
+...         feedback.feed(msg)
+>>> report = feedback.finish()
+>>> print(report['latency'])
+
+``find_cells`` must be picklable, that is defined at module level.
+"""
+import time, pydebug
+from collections import OrderedDict
+
+from .experiment import attribute, _images, _field
+from .cam import cam_list_add
+from .pipeline import ScanEvents
+from .utils import _pools, _executor
+
+# debug with `DEBUG=matrixscreener python script.py`
+debug = pydebug.debug('matrixscreener')
+
+
+class Feedback(ScanEvents):
+    def __init__(self, experiment, analyze, cam, job='job1', workers=None,
+                 batch_size=50, autofocus=False, clear=True):
+        """Analyze fields of prescan as they are completed, and add jobs to
+        the CAM list.
+
+        Events are given either as CAM messages with :meth:`feed` or by
+        polling the experiment folder with :meth:`poll` / :meth:`watch`.
+        A field is considered complete when images from another field show
+        up, or when :meth:`finish` is called, see
+        :class:`matrixscreener.pipeline.ScanEvents`. Jobs of a field are sent
+        as soon as it is analyzed.
+
+        Parameters
+        ----------
+        experiment : Experiment or string
+            Prescan experiment.
+        analyze : function
+            Called with sorted list of images of a field in a worker.
+            Returns offsets ``(dxpos, dypos)`` of objects to scan, or dicts
+            with keyword arguments to :func:`matrixscreener.cam.cam_list_add`
+            which overrides job and field.
+        cam : matrixscreener.cam.CAM
+            Connection to LAS AF.
+        job : string
+            Job in scanning template to scan objects with.
+        workers : int
+            Fields analyzed in parallel. Defaults to
+            ``matrixscreener.utils._pools``.
+        batch_size : int
+            Maximum jobs added to CAM list in one message. Jobs of fields
+            analyzed at the same time are sent together.
+        autofocus : bool
+            Autofocus before scanning every object.
+        clear : bool
+            Delete CAM list before adding first job.
+
+        Attributes
+        ----------
+        fields : OrderedDict
+            Latency of every analyzed field, dicts with keys ``jobs``,
+            ``analysis`` (seconds in analyze), ``latency`` (seconds from field
+            was complete until its jobs were sent), ``error`` and
+            ``complete`` (time field was complete).
+        """
+        ScanEvents.__init__(self, experiment)
+        self.analyze = analyze
+        self.cam = cam
+        self.job = job
+        self.batch_size = batch_size
+        self.autofocus = autofocus
+        self.clear = clear
+        self.fields = OrderedDict()
+        self._futures = self._scheduled  # field -> (future, time complete)
+        self._pending = []  # (field, command) not sent
+        self._executor = _executor(workers or _pools)
+
+    _prefix = _field
+
+    def __str__(self):
+        return 'matrixscreener.Feedback({})'.format(self.experiment.path)
+
+    def __repr__(self):
+        return self.__str__()
+
+    def watch(self, interval=1.0, until=None, start=True):
+        """Poll experiment folder every interval seconds until ``until()``
+        returns truthy, then finish, see :meth:`ScanEvents.watch`.
+
+        Returns
+        -------
+        OrderedDict
+            Same as :meth:`finish`.
+        """
+        return ScanEvents.watch(self, interval, until, start=start)
+
+    def collect(self, wait=False):
+        """Queue jobs of analyzed fields and send them, in batches of at most
+        ``batch_size`` jobs.
+
+        Parameters
+        ----------
+        wait : bool
+            Wait for all fields being analyzed.
+        """
+        for field, (future, complete) in list(self._futures.items()):
+            if field in self.fields or not (wait or future.done()):
+                continue
+            info = OrderedDict([('jobs', 0), ('analysis', None),
+                                ('latency', None), ('error', None),
+                                ('complete', complete)])
+            self.fields[field] = info
+            try:
+                objects, info['analysis'] = future.result()
+            except Exception as e:
+                print('matrixscreener {}: {}'.format(field, e))
+                info['error'] = str(e)
+                continue
+            for command in self._commands(field, objects):
+                self._pending.append((field, command))
+                info['jobs'] += 1
+            if not info['jobs']:
+                info['latency'] = time.time() - complete
+        while self._pending:
+            self._send(self._pending[:self.batch_size])
+            del self._pending[:self.batch_size]
+
+    def finish(self, start=True):
+        """Complete remaining fields, wait for analysis, send all jobs and
+        start the CAM scan.
+
+        Parameters
+        ----------
+        start : bool
+            Start CAM scan if any jobs were added.
+
+        Returns
+        -------
+        OrderedDict
+            See :meth:`report`.
+        """
+        ScanEvents.finish(self)
+        self.collect(wait=True)
+        self._executor.shutdown()
+        if start and any(f['jobs'] for f in self.fields.values()):
+            debug('starting cam scan')
+            self.cam.start_cam_scan()
+        return self.report()
+
+    def report(self):
+        """Latency of fields analyzed so far.
+
+        Returns
+        -------
+        OrderedDict
+            ``fields``, ``jobs``, ``errors``, and ``latency`` and
+            ``analysis`` with ``mean``, ``median``, ``p95`` and ``max`` in
+            seconds.
+        """
+        import numpy as np
+        report = OrderedDict([
+            ('fields', len(self.fields)),
+            ('jobs', sum(f['jobs'] for f in self.fields.values())),
+            ('errors', sum(1 for f in self.fields.values() if f['error']))])
+        for key in ('latency', 'analysis'):
+            values = np.array([f[key] for f in self.fields.values()
+                               if f[key] is not None], dtype=float)
+            report[key] = OrderedDict(
+                (name, float(fn(values)) if len(values) else None)
+                for name, fn in (('mean', np.mean), ('median', np.median),
+                                 ('p95', lambda v: np.percentile(v, 95)),
+                                 ('max', np.max)))
+        return report
+
+    def _submit(self, field):
+        "Analyze field in a worker."
+        return (self._executor.submit(analyze_field, field, self.analyze),
+                time.time())
+
+    def _commands(self, field, objects):
+        "CAM list commands of objects found in field."
+        for obj in objects or []:
+            kwargs = {
+                'job': self.job,
+                'slide': attribute(field, 'S') or 0,
+                # CAM counts wells and fields from 1
+                'wellx': attribute(field, 'U') + 1,
+                'welly': attribute(field, 'V') + 1,
+                'fieldx': attribute(field, 'X') + 1,
+                'fieldy': attribute(field, 'Y') + 1,
+                'autofocus': self.autofocus,
+            }
+            if isinstance(obj, dict):
+                kwargs.update(obj)
+            else:
+                kwargs['dxpos'], kwargs['dypos'] = obj
+            yield cam_list_add(**kwargs)
+
+    def _send(self, batch):
+        "Send batch of (field, command) in one message."
+        if self.clear:
+            self.cam.delete_list()
+            self.clear = False
+        debug('adding {} jobs to cam list'.format(len(batch)))
+        self.cam.send_many([command for _, command in batch])
+        sent = time.time()
+        for field, _ in batch:
+            info = self.fields[field]
+            info['latency'] = sent - info['complete']
+
+
+def analyze_field(field, analyze):
+    """Call analyze with images of field. Runs in a worker of
+    :class:`Feedback`.
+
+    Returns
+    -------
+    objects, seconds : list, float
+        Result of analyze and time spent.
+    """
+    begin = time.time()
+    objects = analyze(_images(field))
+    return list(objects or []), time.time() - begin
@@ -0,0 +1,261 @@
+# encoding: utf-8
+"""
+Flat-field (illumination) correction per channel. A profile is estimated
+from a sample of images of every channel (the ``--C`` attribute), smoothed
+and normalized to mean 1. Profiles are cached as
+``AdditionalData/flatfield--CXX.npy`` in the experiment, with the size and
+modification time of the sampled images in ``flatfield--CXX.json``. A
+profile is estimated again when its sample changes.
+
+Images are corrected when they are read, by dividing with the profile of
+their channel, such that no corrected copy is written. Experiment.project,
+Experiment.previews, Experiment.to_chunked and Experiment.stitch (with
+positions) take ``flatfield=True``.
+
+Example
+-------
+>>> from matrixscreener import flatfield
+>>> profiles = flatfield.profiles(experiment.path, experiment.images)
+>>> data = flatfield.read(experiment.images[0], profiles)
+"""
+import os, json, pydebug
+from .utils import apply_async
+from .storage import storage_for
+
+debug = pydebug.debug('matrixscreener')
+
+_cache = 'AdditionalData'
+
+# loaded profiles in this process, filename -> (mtime, array)
+_loaded = {}
+
+
+def profiles(path, images, sample=20, recompute=False):
+    """Flat-field profiles of all channels in images, estimated in parallel
+    if they are not cached.
+
+    Parameters
+    ----------
+    path : string
+        Experiment path, profiles are cached in ``AdditionalData``.
+    images : list of filenames
+        Images to estimate profiles from.
+    sample : int
+        Maximum number of images per channel used for estimate, spread
+        evenly over images.
+    recompute : bool
+        Estimate profiles even if they are cached and the sample is
+        unchanged.
+
+    Returns
+    -------
+    dict
+        Channel (``'00'``) -> filename of profile.
+    """
+    from .experiment import attribute_as_str
+
+    # one image per field, prefer TIFF as in projections
+    stems = {}
+    for image in images:
+        stem = image.rsplit('.ome.tif', 1)[0].rsplit('.png', 1)[0]
+        if stem not in stems or image.endswith('.tif'):
+            stems[stem] = image
+
+    channels = {}
+    for stem in sorted(stems):
+        image = stems[stem]
+        channels.setdefault(attribute_as_str(image, 'C'), []).append(image)
+
+    result = {}
+    groups = []
+    for channel, group in sorted(channels.items()):
+        filename = os.path.join(path, _cache,
+                                'flatfield--C{}.npy'.format(channel))
+        result[channel] = filename
+        step = max(1, len(group) // sample)
+        group = group[::step][:sample]
+        signature = _signature(path, group)
+        if recompute or not storage_for(filename).exists(filename) or \
+                _saved_signature(filename) != signature:
+            groups.append((filename, group, signature))
+
+    if groups:
+        debug('estimating flat-field of {} channels'.format(len(groups)))
+        apply_async(estimate_blocking, groups=(groups, True))
+    return result
+
+
+def estimate_blocking(groups):
+    """Estimate and save flat-field profiles, see :func:`estimate`.
+
+    Parameters
+    ----------
+    groups : list of tuples
+        (output_filename, images, signature) for every channel, where
+        signature is saved next to profile, see :func:`profiles`.
+
+    Returns
+    -------
+    list of filenames
+        Saved profiles.
+    """
+    from io import BytesIO
+    import numpy as np
+    saved = []
+    for output, images, signature in groups:
+        profile = BytesIO()
+        np.save(profile, estimate(images))
+        storage = storage_for(output)
+        storage.write(output, profile.getvalue())
+        # written last, an interrupted estimate is repeated
+        storage.write(_signature_file(output),
+                      json.dumps(signature).encode('utf-8'))
+        saved.append(output)
+    return saved
+
+
+def _signature(path, images):
+    "[name, size, mtime] of images, names relative to path."
+    prefix = path.rstrip('/\\') + os.sep
+    signature = []
+    for image in images:
+        info = storage_for(image).info(image)
+        size, mtime = info if info is not None else (None, None)
+        name = image[len(prefix):] if image.startswith(prefix) else image
+        signature.append([name.replace(os.sep, '/'), size, mtime])
+    return signature
+
+
+def _signature_file(filename):
+    "Sample signature saved next to profile filename."
+    return filename.rsplit('.npy', 1)[0] + '.json'
+
+
+def _saved_signature(filename):
+    "Signature saved with profile, None if missing or unreadable."
+    signature = _signature_file(filename)
+    storage = storage_for(signature)
+    try:
+        return json.loads(storage.read(signature).decode('utf-8'))
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def estimate(images, smooth=16):
+    """Flat-field profile: median of images, smoothed with a box filter of
+    1/smooth of image size and normalized to mean 1.
+
+    Parameters
+    ----------
+    images : list of filenames
+        Images of one channel.
+    smooth : int
+        Box filter size is image size divided by smooth.
+
+    Returns
+    -------
+    numpy.ndarray
+        float32 profile with same shape as images.
+    """
+    import numpy as np
+
+    stack = np.stack([_open(image).astype(np.float32) for image in images])
+    profile = np.median(stack, axis=0)
+    del stack
+    size = max(1, min(profile.shape[:2]) // smooth)
+    profile = _box_filter(_box_filter(profile, size, 0), size, 1)
+    mean = profile.mean()
+    if mean <= 0:
+        return np.ones_like(profile)
+    profile /= mean
+    # avoid amplifying noise in dark corners
+    np.maximum(profile, 0.05, out=profile)
+    return profile.astype(np.float32)
+
+
+def _box_filter(data, size, axis):
+    "Mean filter along axis, with edges repeated."
+    import numpy as np
+    if size <= 1:
+        return data
+    before = size // 2
+    after = size - before - 1
+    pad = [(0, 0)] * data.ndim
+    pad[axis] = (before + 1, after)
+    padded = np.pad(data, pad, mode='edge')
+    csum = np.cumsum(padded, axis=axis, dtype=np.float64)
+    n = data.shape[axis]
+    upper = np.take(csum, np.arange(size, size + n), axis=axis)
+    lower = np.take(csum, np.arange(0, n), axis=axis)
+    return ((upper - lower) / size).astype(np.float32)
+
+
+def load(filename):
+    "Profile from file, cached in process until file changes."
+    import numpy as np
+    storage = storage_for(filename)
+    info = storage.info(filename)
+    if info is None:
+        raise IOError('no flat-field profile {}'.format(filename))
+    mtime = info[1]
+    cached = _loaded.get(filename)
+    if cached is None or cached[0] != mtime:
+        with storage.open(filename) as f:
+            cached = (mtime, np.load(f))
+        _loaded[filename] = cached
+    return cached[1]
+
+
+def correct(data, profile):
+    """Divide image with profile, keeping dtype.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        Image.
+    profile : numpy.ndarray
+        Profile with same shape as image, see :func:`estimate`.
+
+    Returns
+    -------
+    numpy.ndarray
+        Corrected image, clipped to range of dtype.
+    """
+    import numpy as np
+    result = data / profile
+    if np.issubdtype(data.dtype, np.integer):
+        info = np.iinfo(data.dtype)
+        np.clip(result, info.min, info.max, out=result)
+        np.round(result, out=result)
+    return result.astype(data.dtype)
+
+
+def read(image, profiles=None):
+    """Read image as array, corrected with profile of its channel if given.
+
+    Parameters
+    ----------
+    image : string
+        Filename.
+    profiles : dict
+        Channel -> filename of profile, see :func:`profiles`.
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    from .experiment import attribute_as_str
+    data = _open(image)
+    if profiles:
+        profile = profiles.get(attribute_as_str(image, 'C'))
+        if profile is not None:
+            data = correct(data, load(profile))
+    return data
+
+
+def _open(image):
+    "Image as array, read through storage of image."
+    import numpy as np
+    from PIL import Image
+    with storage_for(image).open(image) as f:
+        return np.asarray(Image.open(f))
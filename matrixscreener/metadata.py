@@ -0,0 +1,281 @@
+# encoding: utf-8
+"""
+Read OME-XML metadata of matrix scans. The Data Exporter saves one metadata
+file per field and time point in ``field--XNN--YNN/metadata/``.
+
+Files are parsed with ``iterparse`` and parsing stops when the ``Image``
+element has been read, such that the large ``OriginalMetadata`` block is not
+loaded into memory. The metadata of an experiment is cached as a table in
+``AdditionalData/metadata.npz`` inside the experiment, and only new or
+modified files are parsed again.
+
+Example
+-------
+>>> from matrixscreener.experiment import Experiment
+>>> e = Experiment('/path/to/experiment')
+>>> table = e.metadata
+>>> table['stage_x'], table['physical_size_x']
+"""
+import os, pydebug
+from .utils import cached_columns
+
+debug = pydebug.debug('matrixscreener')
+
+_metadata = 'metadata'
+_cache = os.path.join('AdditionalData', 'metadata.npz')
+
+# (name, dtype) of columns in metadata table, see parse
+COLUMNS = [
+    ('U', int), ('V', int), ('X', int), ('Y', int), ('T', int),
+    ('image', str),
+    ('creation_date', str),
+    ('pixel_type', str),
+    ('size_x', int), ('size_y', int),
+    ('physical_size_x', float), ('physical_size_y', float),
+    ('physical_size_z', float),
+    ('stage_x', float), ('stage_y', float), ('stage_z', float),
+]
+
+
+def metadata_files(path):
+    """Sorted list of OME-XML metadata files in experiment, well or field.
+
+    Parameters
+    ----------
+    path : string
+        Path to experiment, well or field.
+
+    Returns
+    -------
+    list of strings
+    """
+    from .experiment import _slide, _chamber, _field
+    from .storage import storage_for
+    storage = storage_for(path)
+    patterns = [
+        os.path.join(path, _metadata),
+        os.path.join(path, _field + '--*', _metadata),
+        os.path.join(path, _slide + '--*', _chamber + '--*', _field + '--*',
+                     _metadata),
+    ]
+    for pattern in patterns:
+        files = storage.glob(os.path.join(pattern, '*.ome.xml'))
+        if files:
+            return files
+    return []
+
+
+def parse(filename):
+    """Parse OME-XML metadata file.
+
+    Parameters
+    ----------
+    filename : string
+        Path to ``.ome.xml`` file.
+
+    Returns
+    -------
+    dict
+        Keys as in :data:`COLUMNS`. Attributes U, V, X, Y and T are read
+        from filename. Physical sizes are in µm, stage positions in meters.
+    """
+    from xml.etree.ElementTree import iterparse
+    from .experiment import attributes
+    from .storage import storage_for
+
+    attr = attributes(filename)
+    row = {
+        'U': attr.u, 'V': attr.v, 'X': attr.x, 'Y': attr.y, 'T': attr.t,
+        'image': '', 'creation_date': '', 'pixel_type': '',
+        'size_x': 0, 'size_y': 0,
+        'physical_size_x': 0.0, 'physical_size_y': 0.0,
+        'physical_size_z': 0.0,
+        'stage_x': 0.0, 'stage_y': 0.0, 'stage_z': 0.0,
+    }
+    stage = False
+    with storage_for(filename).open(filename) as f:
+        for event, element in iterparse(f, events=('start', 'end')):
+            tag = element.tag.rsplit('}', 1)[-1]
+            if event == 'start':
+                if tag == 'Image':
+                    row['image'] = element.get('Name', '').replace('\\', '/')
+                    row['image'] = row['image'].rsplit('/', 1)[-1]
+                continue
+            if tag == 'CreationDate':
+                row['creation_date'] = element.text or ''
+            elif tag == 'Pixels':
+                row['pixel_type'] = element.get('PixelType', '')
+                row['size_x'] = int(element.get('SizeX', 0))
+                row['size_y'] = int(element.get('SizeY', 0))
+                for dim in 'xyz':
+                    value = element.get('PhysicalSize' + dim.upper(), 0)
+                    row['physical_size_' + dim] = float(value)
+            elif tag == 'StagePosition' and not stage:
+                # first plane
+                stage = True
+                for dim in 'xyz':
+                    value = element.get('Position' + dim.upper(), 0)
+                    row['stage_' + dim] = float(value)
+            elif tag == 'Image':
+                # rest is OriginalMetadata
+                break
+            element.clear()
+    return row
+
+
+def parse_blocking(paths):
+    """Parse several metadata files, see :func:`parse`.
+
+    Parameters
+    ----------
+    paths : list of strings
+        Paths to ``.ome.xml`` files.
+
+    Returns
+    -------
+    list of dicts
+    """
+    rows = []
+    for path in paths:
+        try:
+            rows.append(parse(path))
+        except Exception as e:
+            print('matrixscreener could not parse {}: {}'.format(path, e))
+            from .experiment import attributes
+            attr = attributes(path)
+            row = dict((name, dtype()) for name, dtype in COLUMNS)
+            row.update(U=attr.u, V=attr.v, X=attr.x, Y=attr.y, T=attr.t)
+            rows.append(row)
+    return rows
+
+
+def table(path, cache=True):
+    """Metadata of experiment as a table with one row per metadata file.
+
+    Files are parsed in parallel, and the table is cached in
+    ``AdditionalData/metadata.npz``. Only new or modified files are parsed
+    when the cache exists.
+
+    Parameters
+    ----------
+    path : string
+        Path to experiment.
+    cache : bool
+        Whether to read and write the cache.
+
+    Returns
+    -------
+    collections.OrderedDict
+        Column name -> numpy array. Columns are ``path``, ``mtime`` and the
+        ones in :data:`COLUMNS`.
+    """
+    files = metadata_files(path)
+    cache_file = os.path.join(path, _cache) if cache else None
+    debug('metadata of {} files in {}'.format(len(files), path))
+    return cached_columns(cache_file, files, parse_blocking, COLUMNS)
+
+
+def tile_positions(table, U, V, T=0):
+    """Tile positions in pixels of fields in a well, from stage positions.
+    Positions are relative to the upper left field.
+
+    Parameters
+    ----------
+    table : dict
+        Metadata table, see :func:`table`.
+    U, V, T : int
+        Well and time point.
+
+    Returns
+    -------
+    collections.OrderedDict
+        (X, Y) of field -> (x, y) in pixels.
+    """
+    from collections import OrderedDict
+    rows = ((table['U'] == U) & (table['V'] == V) & (table['T'] == T))
+    positions = OrderedDict()
+    if not rows.any():
+        return positions
+    # stage is in meters, pixel size in µm
+    size_x = table['physical_size_x'][rows] * 1e-6
+    size_y = table['physical_size_y'][rows] * 1e-6
+    x = table['stage_x'][rows]
+    y = table['stage_y'][rows]
+    x = (x - x.min()) / size_x
+    y = (y - y.min()) / size_y
+    for X, Y, x_px, y_px in zip(table['X'][rows], table['Y'][rows], x, y):
+        positions[(int(X), int(Y))] = (round(float(x_px), 3),
+                                       round(float(y_px), 3))
+    return positions
+
+
+def tile_configuration(filename, tiles):
+    """Write Fiji stitching TileConfiguration.
+
+    Parameters
+    ----------
+    filename : string
+        Where to save configuration.
+    tiles : list of tuples
+        (image, (x, y)), where image is relative to folder of configuration.
+    """
+    lines = ['# Define the number of dimensions we are working on',
+             'dim = 2', '', '# Define the image coordinates']
+    for image, (x, y) in tiles:
+        lines.append('{}; ; ({}, {})'.format(image, float(x), float(y)))
+    with open(filename, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def read_tile_configuration(filename):
+    """Read Fiji stitching TileConfiguration.
+
+    Parameters
+    ----------
+    filename : string
+        Path to TileConfiguration.
+
+    Returns
+    -------
+    list of tuples
+        (image, (x, y)) as in file.
+    """
+    from .storage import storage_for
+    tiles = []
+    text = storage_for(filename).read(filename).decode('utf-8')
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#') or ';' not in line:
+            continue
+        image, _, position = [s.strip() for s in line.split(';', 2)]
+        x, y = position.strip('()').split(',')[:2]
+        tiles.append((image, (float(x), float(y))))
+    return tiles
+
+
+def registered_positions(well):
+    """Tile positions of fields computed by Fiji, read from
+    ``TileConfiguration.registered.txt`` in well. Channels and z-stacks share
+    geometry, such that positions from one plane can be used for all planes.
+
+    Parameters
+    ----------
+    well : string
+        Path to well.
+
+    Returns
+    -------
+    collections.OrderedDict or None
+        (X, Y) of field -> (x, y) in pixels. None if well has no registered
+        tile configuration.
+    """
+    from collections import OrderedDict
+    from .experiment import attribute
+    from .storage import storage_for
+    filename = os.path.join(well, 'TileConfiguration.registered.txt')
+    if not storage_for(filename).exists(filename):
+        return None
+    positions = OrderedDict()
+    for image, xy in read_tile_configuration(filename):
+        positions[(attribute(image, 'X'), attribute(image, 'Y'))] = xy
+    return positions or None
@@ -0,0 +1,375 @@
+# encoding: utf-8
+"""
+Pack chambers into one container file each, such that an experiment has a
+handful of files instead of one PNG and one json per image. A chamber
+``slide--S00/chamber--U00--V00`` is stored as
+``slide--S00/chamber--U00--V00.zip``, an uncompressed zip where the central
+directory at the end of the file is the index. Single images are read with
+one seek, without extracting the archive, and the archives can be opened
+with any zip tool.
+
+Experiment opens packed experiments directly, listing and reading images
+inside archives with the same paths as before packing.
+
+Example
+-------
+>>> from matrixscreener.experiment import Experiment
+>>> e = Experiment('/path/to/experiment')
+>>> archives = e.pack(delete=True)
+>>> e = Experiment('/path/to/experiment')
+>>> data = e.storage.read(e.images[0])
+>>> archive = Archive(archives[0])
+>>> img = archive.image(X=0, Y=1, C=0)
+"""
+import os, struct, pydebug
+from .storage import Storage, LocalStorage, temporary
+from .utils import apply_async
+
+debug = pydebug.debug('matrixscreener')
+
+EXTENSION = '.zip'
+
+# zip local file header, see APPNOTE.TXT 4.3.7
+_header = struct.Struct('<4s22xHH')
+
+
+class Archive(object):
+    """Random access reader of packed chamber.
+
+    Parameters
+    ----------
+    filename : string
+        Path to archive.
+
+    Attributes
+    ----------
+    names : list of strings
+        Sorted files in archive, relative to chamber folder.
+    mtime : float
+        Modification time of archive.
+    """
+
+    def __init__(self, filename):
+        import zipfile
+        self.filename = filename
+        self.mtime = os.path.getmtime(filename)
+        self._members = {}
+        with zipfile.ZipFile(filename) as z:
+            for info in z.infolist():
+                if not info.filename.endswith('/'):
+                    self._members[info.filename] = (
+                        info.header_offset, info.file_size,
+                        info.compress_type)
+        self.names = sorted(self._members)
+
+    def __repr__(self):
+        return 'matrixscreener.Archive({}, {} files)'.format(
+            self.filename, len(self.names))
+
+    def __contains__(self, name):
+        return name in self._members
+
+    def size(self, name):
+        "Size of file in bytes."
+        return self._members[name][1]
+
+    def read(self, name, start=None, end=None):
+        """Bytes of file, or of range ``[start, end)``.
+
+        Parameters
+        ----------
+        name : string
+            File in archive.
+
+        Returns
+        -------
+        bytes
+        """
+        import zipfile
+        if name not in self._members:
+            raise IOError('{} not in {}'.format(name, self.filename))
+        offset, size, compression = self._members[name]
+        start = start or 0
+        end = size if end is None else min(end, size)
+        if compression != zipfile.ZIP_STORED:
+            with zipfile.ZipFile(self.filename) as z:
+                return z.read(name)[start:end]
+        with open(self.filename, 'rb') as f:
+            f.seek(offset)
+            signature, n, m = _header.unpack(f.read(_header.size))
+            if signature != b'PK\x03\x04':
+                raise IOError('corrupt archive {}'.format(self.filename))
+            f.seek(offset + _header.size + n + m + start)
+            return f.read(max(0, end - start))
+
+    def find(self, **attrs):
+        """Images with given attributes.
+
+        Parameters
+        ----------
+        attrs : ints
+            Attribute values, such as ``X=0, Y=1, C=0``.
+
+        Returns
+        -------
+        list of strings
+            Names of images.
+        """
+        from .experiment import attribute, _image
+        return [name for name in self.names
+                if os.path.basename(name).startswith(_image + '--') and
+                name.endswith(('.tif', '.png')) and
+                all(attribute(name, k) == int(v) for k, v in attrs.items())]
+
+    def image(self, **attrs):
+        """Open single image with given attributes.
+
+        Returns
+        -------
+        PIL.Image
+        """
+        from io import BytesIO
+        from PIL import Image
+        names = self.find(**attrs)
+        if len(names) != 1:
+            raise ValueError('{} images matching {} in {}'.format(
+                len(names), attrs, self.filename))
+        return Image.open(BytesIO(self.read(names[0])))
+
+
+class PackedStorage(LocalStorage):
+    """Local storage where packed chambers appear as folders. Files in a
+    chamber folder are preferred over files in its archive, such that the
+    archive can be written before the folder is deleted. Archives are indexed
+    once, until they are modified.
+
+    Packed chambers are read only: writing or removing files in a chamber
+    which only exists as archive raises IOError."""
+
+    def __init__(self):
+        self._archives = {}
+
+    def archive(self, filename):
+        "Cached :class:`Archive` of filename."
+        archive = self._archives.get(filename)
+        if archive is None or archive.mtime != os.path.getmtime(filename):
+            archive = Archive(filename)
+            self._archives[filename] = archive
+        return archive
+
+    # folders are derived from files in archives
+    glob = Storage.glob
+
+    def find(self, prefix):
+        from .experiment import _chamber
+        found = []
+        for folder, dirs, files in os.walk(prefix):
+            for f in files:
+                path = os.path.join(folder, f)
+                if not (f.startswith(_chamber) and f.endswith(EXTENSION)):
+                    found.append(path)
+                    continue
+                found.extend(self._members(path[:-len(EXTENSION)]))
+        # prefix is a packed chamber or a folder in it
+        chamber = self._chamber(prefix + '/')
+        if chamber is not None:
+            found.extend(m for m in self._members(chamber)
+                         if m.startswith(prefix + '/'))
+        return sorted(found)
+
+    def _members(self, chamber):
+        "Paths of files in archive of chamber, which are not in its folder."
+        members = [chamber + '/' + name
+                   for name in self.archive(chamber + EXTENSION).names]
+        if os.path.isdir(chamber):
+            # files in folder are listed by walk
+            members = [m for m in members if not os.path.isfile(m)]
+        return members
+
+    def _chamber(self, path):
+        "Packed chamber which path is in, None if not in a packed chamber."
+        folder = path
+        while True:
+            parent = os.path.dirname(folder)
+            if parent == folder:
+                return None
+            if os.path.isfile(parent + EXTENSION):
+                return parent
+            folder = parent
+
+    def _member(self, path):
+        "Archive and name of path, None if path is not in an archive."
+        chamber = self._chamber(path)
+        if chamber is None:
+            return None
+        archive = self.archive(chamber + EXTENSION)
+        name = path[len(chamber) + 1:]
+        return (archive, name) if name in archive else None
+
+    def info(self, path):
+        info = LocalStorage.info(self, path)
+        if info is None:
+            member = self._member(path)
+            if member:
+                archive, name = member
+                info = archive.size(name), archive.mtime
+        return info
+
+    def exists(self, path):
+        return self.info(path) is not None
+
+    def read(self, path, start=None, end=None):
+        if not os.path.isfile(path):
+            member = self._member(path)
+            if member:
+                archive, name = member
+                return archive.read(name, start, end)
+        return LocalStorage.read(self, path, start, end)
+
+    def open(self, path):
+        if os.path.isfile(path):
+            return LocalStorage.open(self, path)
+        return Storage.open(self, path)
+
+    def write(self, path, data):
+        chamber = self._chamber(path)
+        if chamber and not os.path.isdir(chamber):
+            raise IOError('{} is in packed chamber {}, which is read '
+                          'only'.format(path, chamber + EXTENSION))
+        LocalStorage.write(self, path, data)
+
+    def remove(self, path):
+        if not os.path.isfile(path) and self._member(path):
+            raise IOError('{} is in packed chamber, which is read '
+                          'only'.format(path))
+        LocalStorage.remove(self, path)
+
+
+def is_packed(path):
+    "Whether experiment has packed chambers."
+    from .experiment import glob, _pattern, _slide, _chamber
+    return bool(glob(_pattern(_pattern(path, _slide), _chamber,
+                              extension='--*' + EXTENSION)))
+
+
+def pack(wells, delete=False):
+    """Pack chambers in parallel, see :func:`pack_blocking`.
+
+    Returns
+    -------
+    list of filenames
+        Archives.
+    """
+    return apply_async(pack_blocking, wells=(wells, True),
+                       delete=(delete, False))
+
+
+def pack_blocking(wells, delete=False):
+    """Pack every chamber folder into ``<chamber>.zip``. Files are stored
+    uncompressed (PNGs are already compressed) and streamed to a temporary
+    archive which is renamed when done. Files of an existing archive are kept,
+    and files in the chamber folder are added or replace them. Archives
+    which already have every file of the folder are not written again.
+
+    Parameters
+    ----------
+    wells : list of strings
+        Chamber folders.
+    delete : bool
+        Delete chamber folder after packing. The folder is only deleted when
+        every file in it is in the archive with same size and CRC.
+
+    Returns
+    -------
+    list of filenames
+        Archives.
+
+    Raises
+    ------
+    IOError
+        If delete is given and a file in the chamber folder is not in the
+        archive.
+    """
+    import zipfile, shutil
+
+    archives = []
+    for well in wells:
+        output = well + EXTENSION
+        if not os.path.isdir(well):
+            # packed and deleted before
+            if os.path.isfile(output):
+                archives.append(output)
+            continue
+        files = dict((os.path.relpath(f, well).replace(os.sep, '/'), f)
+                     for f in (os.path.join(folder, name)
+                               for folder, _, names in os.walk(well)
+                               for name in names))
+        crcs = {}
+        members = _infos(output)
+        mtime = os.path.getmtime(output) if members is not None else None
+        changed = [name for name in sorted(files)
+                   if _changed(files[name], (members or {}).get(name), mtime,
+                               crcs if delete else None)]
+        if members is None or changed:
+            debug('packing {} files to {}'.format(len(changed), output))
+            tmp = temporary(output)
+            try:
+                with zipfile.ZipFile(tmp, 'w', zipfile.ZIP_STORED,
+                                     allowZip64=True) as z:
+                    if members:
+                        with zipfile.ZipFile(output) as old:
+                            for name in sorted(set(members) - set(changed)):
+                                z.writestr(members[name], old.read(name))
+                    for name in changed:
+                        z.write(files[name], name)
+                os.rename(tmp, output)
+            except BaseException:
+                if os.path.isfile(tmp):
+                    os.remove(tmp)
+                raise
+        if delete:
+            members = _infos(output)
+            missing = [files[name] for name in sorted(files)
+                       if _changed(files[name], members.get(name), None, crcs)]
+            if missing:
+                raise IOError('{} not deleted, {} files are not in {}: {}'
+                              .format(well, len(missing), output,
+                                      ', '.join(missing[:3])))
+            shutil.rmtree(well)
+        archives.append(output)
+    return archives
+
+
+def _infos(filename):
+    "Name -> ZipInfo of files in archive, None if there is no archive."
+    import zipfile
+    if not os.path.isfile(filename):
+        return None
+    with zipfile.ZipFile(filename) as z:
+        return dict((info.filename, info) for info in z.infolist()
+                    if not info.filename.endswith('/'))
+
+
+def _changed(path, info, mtime=None, crcs=None):
+    """Whether file differs from archive member ``info``: missing, other
+    size, newer than archive mtime or, if crcs is given, other CRC. CRCs
+    computed are cached in crcs."""
+    if info is None or os.path.getsize(path) != info.file_size:
+        return True
+    if mtime is not None and os.path.getmtime(path) > mtime:
+        return True
+    if crcs is None:
+        return False
+    if path not in crcs:
+        crcs[path] = _crc(path)
+    return crcs[path] != info.CRC
+
+
+def _crc(path):
+    "CRC-32 of file, as stored in zip."
+    import zlib
+    crc = 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            crc = zlib.crc32(block, crc)
+    return crc & 0xffffffff
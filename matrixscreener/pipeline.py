@@ -0,0 +1,289 @@
+# encoding: utf-8
+"""
+Process wells while the matrix scan is running. Wells are compressed,
+projected and stitched as soon as the microscope has moved on to the next
+well, instead of post-processing the whole experiment after the scan.
+"""
+import os, time, pydebug
+from collections import OrderedDict
+
+from .experiment import (Experiment, compress_blocking, projections,
+                         project_blocking, stitch_well, _images, _mtime,
+                         _slide, _chamber, _field)
+from .utils import _pools, _executor
+
+# debug with `DEBUG=matrixscreener python script.py`
+debug = pydebug.debug('matrixscreener')
+
+
+class ScanEvents(object):
+    """Folders of a running scan, such as wells or fields, completed from CAM
+    messages or by polling the experiment folder. A folder is considered
+    complete when images from another folder show up, or when
+    :meth:`finish` is called.
+
+    Subclasses give the folders with ``_prefix`` (``'chamber'`` or
+    ``'field'``), and process completed folders in :meth:`_submit`.
+    :meth:`collect` is called after every message and poll.
+
+    Parameters
+    ----------
+    experiment : Experiment or string
+        Experiment which is being scanned.
+    """
+
+    _prefix = None
+
+    def __init__(self, experiment):
+        if not isinstance(experiment, Experiment):
+            experiment = Experiment(experiment)
+        self.experiment = experiment
+        self._scheduled = OrderedDict()  # folder -> result of _submit
+        self._current = None  # folder being scanned
+        self._seen = set()  # folders with images found by poll
+
+    def feed(self, message):
+        """Handle a CAM message (OrderedDict from ``CAM.receive``).
+
+        Messages with ``relpath`` tells which image was saved, and
+        ``inf:scanfinished`` that the scan is done.
+        """
+        if message is None:
+            return
+        if message.get('inf') == 'scanfinished':
+            self._complete(self._current)
+            self._current = None
+        elif 'relpath' in message:
+            relpath = message['relpath'].replace('\\', '/')
+            # relpath might include experiment folder, start at slide--
+            start = relpath.find(_slide + '--')
+            if start > 0:
+                relpath = relpath[start:]
+            self.image_saved(os.path.join(self.experiment.path, relpath))
+        self.collect()
+
+    def image_saved(self, path):
+        """Register that the image at path has been written by the scan."""
+        folder = self._folder(path)
+        if not folder:
+            return
+        if folder != self._current:
+            # scan moved on, previous folder is complete
+            self._complete(self._current)
+            self._current = folder
+
+    def poll(self):
+        """Check experiment folder once, complete folders the scan has left.
+
+        The folder with the newest image is considered as being scanned.
+        """
+        newest = None
+        newest_mtime = -1
+        folders = (self.experiment.fields if self._prefix == _field else
+                   self.experiment.wells)
+        for folder in folders:
+            if folder in self._scheduled:
+                continue
+            images = _images(folder)
+            if not images:
+                continue
+            self._seen.add(folder)
+            mtime = max(_mtime(i) or 0 for i in images)
+            if mtime > newest_mtime:
+                newest, newest_mtime = folder, mtime
+        for folder in sorted(self._seen):
+            if folder != newest:
+                self._complete(folder)
+        self._current = newest
+        self.collect()
+
+    def watch(self, interval=5.0, until=None, **kwargs):
+        """Poll experiment folder every interval seconds until ``until()``
+        returns truthy, then finish.
+
+        Parameters
+        ----------
+        interval : float
+            Seconds between polls.
+        until : function
+            Called without arguments after every poll. Defaults to never
+            stop (until KeyboardInterrupt).
+        kwargs : keyword arguments
+            Given to :meth:`finish`.
+
+        Returns
+        -------
+        OrderedDict
+            Same as :meth:`finish`.
+        """
+        try:
+            while True:
+                self.poll()
+                if until and until():
+                    break
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            pass
+        self.poll()
+        return self.finish(**kwargs)
+
+    def collect(self, wait=False):
+        "Handle folders processed so far, wait for all if wait is given."
+        pass
+
+    def finish(self):
+        "Complete remaining folders, subclasses wait for processing."
+        for folder in sorted(self._seen):
+            self._complete(folder)
+        self._complete(self._current)
+        self._current = None
+
+    def _folder(self, path):
+        "Folder of image path, None if not in a folder."
+        prefix = self._prefix + '--'
+        while path and not os.path.basename(path).startswith(prefix):
+            parent = os.path.dirname(path)
+            if parent == path:
+                return None
+            path = parent
+        return path or None
+
+    def _complete(self, folder):
+        "Schedule processing of folder, if not already done."
+        if folder is None or folder in self._scheduled:
+            return
+        debug('{} complete {}'.format(self._prefix, folder))
+        self._seen.discard(folder)
+        self._scheduled[folder] = self._submit(folder)
+
+    def _submit(self, folder):
+        "Start processing of complete folder, returns what to keep for it."
+        raise NotImplementedError
+
+
+class Pipeline(ScanEvents):
+    def __init__(self, experiment, compress=True, stitch=True,
+                 delete_tif=False, folder=None, workers=None, project=False,
+                 method='max'):
+        """Schedule processing of wells as they are completed by the scan.
+
+        Events are given either as CAM messages with :meth:`feed` or by
+        polling the experiment folder with :meth:`poll` / :meth:`watch`.
+        A well is considered complete when images from another well show up,
+        or when :meth:`finish` is called, see :class:`ScanEvents`.
+
+        Parameters
+        ----------
+        experiment : Experiment or string
+            Experiment which is being scanned.
+        compress : bool
+            Lossless compress images of well to PNG.
+        stitch : bool
+            Stitch all channels and z-stacks of well.
+        delete_tif : bool
+            Delete original images after compression.
+        folder : string
+            Where to store stitched images and projections. Defaults to
+            experiment path.
+        workers : int
+            Maximum number of wells processed in parallel. Defaults to
+            ``matrixscreener.utils._pools``.
+        project : bool
+            Z-project fields of well, see :func:`experiment.project_blocking`.
+        method : string
+            Projection, ``'max'``, ``'min'`` or ``'mean'``.
+
+        Attributes
+        ----------
+        results : OrderedDict
+            ``concurrent.futures.Future`` for every scheduled well. Result is
+            a dict with keys ``compressed``, ``projected`` and ``stitched``.
+
+        Example
+        -------
+        >>> pipeline = Pipeline('/path/to/experiment--')
+        >>> cam.start_scan()
+        >>> while scanning:
+        ...     for msg in cam.receive() or []:
+        ...         pipeline.feed(msg)
+        >>> results = pipeline.finish()
+        """
+        ScanEvents.__init__(self, experiment)
+        self.compress = compress
+        self.stitch = stitch
+        self.delete_tif = delete_tif
+        self.project = project
+        self.method = method
+        self.folder = folder or self.experiment.path
+        self.results = self._scheduled
+        self._executor = _executor(workers or _pools)
+
+    _prefix = _chamber
+
+    def __str__(self):
+        return 'matrixscreener.Pipeline({})'.format(self.experiment.path)
+
+    def __repr__(self):
+        return self.__str__()
+
+    def finish(self):
+        """Complete remaining wells and wait for all processing.
+
+        Returns
+        -------
+        OrderedDict
+            Result of every well, dict with keys ``compressed``,
+            ``projected`` and ``stitched``.
+        """
+        ScanEvents.finish(self)
+        output = OrderedDict()
+        for well, future in self.results.items():
+            output[well] = future.result()
+        self._executor.shutdown()
+        return output
+
+    def _submit(self, well):
+        return self._executor.submit(
+            process_well, well, self.compress, self.stitch,
+            self.delete_tif, self.folder, self.project, self.method)
+
+
+def process_well(well, compress=True, stitch=True, delete_tif=False,
+                 folder=None, project=False, method='max'):
+    """Compress, project and stitch one well. Runs in a worker of
+    :class:`Pipeline`.
+
+    Parameters
+    ----------
+    well : string
+        Well path.
+    compress : bool
+        Lossless compress images to PNG.
+    stitch : bool
+        Stitch all channels and z-stacks of well, see
+        :func:`experiment.stitch_well`.
+    delete_tif : bool
+        Delete original images after compression.
+    folder : string
+        Where to store stitched images and projections. Defaults to well
+        path.
+    project : bool
+        Z-project fields, see :func:`experiment.project_blocking`.
+    method : string
+        Projection, ``'max'``, ``'min'`` or ``'mean'``.
+
+    Returns
+    -------
+    dict
+        Filenames with keys ``compressed``, ``projected`` and ``stitched``.
+    """
+    result = {'compressed': [], 'projected': [], 'stitched': []}
+    if compress:
+        tifs = [i for i in _images(well) if i.endswith('.tif')]
+        result['compressed'] = compress_blocking(tifs, delete_tif)
+    if project:
+        groups = projections(_images(well), folder or well)
+        result['projected'] = project_blocking(groups, method)
+    if stitch:
+        result['stitched'] = stitch_well(well, folder)
+    return result
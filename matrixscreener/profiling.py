@@ -0,0 +1,231 @@
+# encoding: utf-8
+"""
+Opt-in timing of processing stages, such as read, decode, encode and write
+in compress, or Fiji in stitch. Every stage records wall time, CPU time of
+the thread and bytes, per file. Workers started after :func:`enable` record
+to the same folder, such that :func:`summary` and :func:`chrome_trace`
+aggregate all processes.
+
+Example
+-------
+>>> from matrixscreener import profiling
+>>> profiling.enable()
+>>> experiment.compress()
+>>> print(profiling.summary())
+>>> profiling.chrome_trace('trace.json')  # open in chrome://tracing
+>>> profiling.disable()
+
+Instrument code with :func:`stage`::
+
+    with stage('decode', nbytes=len(data), file=filename):
+        img = Image.open(BytesIO(data))
+"""
+import os, time, threading
+
+# folder with events, inherited by workers through environment
+ENV = 'MATRIXSCREENER_PROFILE'
+
+try:
+    _cpu_time = time.thread_time
+except AttributeError:
+    # python < 3.7
+    _cpu_time = getattr(time, 'process_time', time.clock)
+
+_lock = threading.Lock()
+_files = {}
+
+
+class _Stage(object):
+    "Records one stage when exiting, see :func:`stage`."
+    __slots__ = ('name', 'bytes', 'file', 'start', 'cpu')
+
+    def __init__(self, name, nbytes, file):
+        self.name = name
+        self.bytes = nbytes
+        self.file = file
+
+    def __enter__(self):
+        self.start = time.time()
+        self.cpu = _cpu_time()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.time()
+        event = {
+            'name': self.name,
+            'pid': os.getpid(),
+            'tid': threading.current_thread().ident,
+            'ts': int(self.start * 1e6),
+            'dur': int((end - self.start) * 1e6),
+            'cpu': int((_cpu_time() - self.cpu) * 1e6),
+            'bytes': self.bytes,
+        }
+        if self.file:
+            event['file'] = self.file
+        _record(event)
+
+
+class _NoStage(object):
+    "Stage when profiling is disabled, does nothing."
+    __slots__ = ('bytes',)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+def stage(name, nbytes=0, file=None):
+    """Context manager timing a stage when profiling is enabled. Bytes can
+    also be set on the returned object, when they are known at the end of
+    the stage.
+
+    Parameters
+    ----------
+    name : string
+        Stage name, such as ``'read'`` or ``'encode'``.
+    nbytes : int
+        Bytes processed.
+    file : string
+        File processed.
+
+    Example
+    -------
+    >>> with stage('read', file=filename) as s:
+    ...     data = f.read()
+    ...     s.bytes = len(data)
+    """
+    if not os.environ.get(ENV):
+        return _NoStage()
+    return _Stage(name, nbytes, file)
+
+
+def enable(folder=None):
+    """Start recording stages in this process and in workers started
+    afterwards.
+
+    Parameters
+    ----------
+    folder : string
+        Where events are stored, one JSON-lines file per process. Defaults to
+        a new temporary folder.
+
+    Returns
+    -------
+    string
+        Folder with events.
+    """
+    if folder is None:
+        from tempfile import mkdtemp
+        folder = mkdtemp(prefix='matrixscreener-profile-')
+    elif not os.path.isdir(folder):
+        os.makedirs(folder)
+    os.environ[ENV] = folder
+    return folder
+
+
+def disable():
+    "Stop recording stages. Recorded events are kept in folder."
+    os.environ.pop(ENV, None)
+    with _lock:
+        for f in _files.values():
+            f.close()
+        _files.clear()
+
+
+def events(folder=None):
+    """Recorded events of all processes.
+
+    Parameters
+    ----------
+    folder : string
+        Defaults to folder of :func:`enable`.
+
+    Returns
+    -------
+    list of dicts
+        With ``name``, ``pid``, ``tid``, ``ts``, ``dur`` and ``cpu`` in
+        microseconds, ``bytes`` and optional ``file``. Sorted by ``ts``.
+    """
+    import json
+    from glob import glob
+    folder = folder or os.environ.get(ENV)
+    if not folder:
+        return []
+    with _lock:
+        for f in _files.values():
+            f.flush()
+    result = []
+    for filename in glob(os.path.join(folder, '*.jsonl')):
+        with open(filename) as f:
+            for line in f:
+                if line.endswith('\n'):
+                    result.append(json.loads(line))
+    return sorted(result, key=lambda e: e['ts'])
+
+
+def summary(folder=None):
+    """Table with count, wall time, CPU time, bytes and throughput per
+    stage, slowest stage first.
+
+    Returns
+    -------
+    string
+    """
+    totals = {}
+    for event in events(folder):
+        total = totals.setdefault(event['name'], [0, 0, 0, 0])
+        total[0] += 1
+        total[1] += event['dur']
+        total[2] += event['cpu']
+        total[3] += event['bytes']
+    lines = ['{:<16}{:>8}{:>12}{:>12}{:>14}{:>10}'.format(
+        'stage', 'count', 'wall [s]', 'cpu [s]', 'bytes', 'MB/s')]
+    for name, (count, wall, cpu, nbytes) in sorted(
+            totals.items(), key=lambda item: -item[1][1]):
+        rate = nbytes / float(wall) if wall else 0
+        lines.append('{:<16}{:>8}{:>12.3f}{:>12.3f}{:>14}{:>10.1f}'.format(
+            name, count, wall / 1e6, cpu / 1e6, nbytes, rate))
+    return '\n'.join(lines)
+
+
+def chrome_trace(filename, folder=None):
+    """Write events in Chrome trace format, viewable in ``chrome://tracing``
+    or Perfetto.
+
+    Parameters
+    ----------
+    filename : string
+        Where to save trace.
+    """
+    import json
+    trace = []
+    for event in events(folder):
+        args = {'cpu_us': event['cpu'], 'bytes': event['bytes']}
+        if 'file' in event:
+            args['file'] = event['file']
+        trace.append({'name': event['name'], 'cat': 'matrixscreener',
+                      'ph': 'X', 'ts': event['ts'], 'dur': event['dur'],
+                      'pid': event['pid'], 'tid': event['tid'],
+                      'args': args})
+    with open(filename, 'w') as f:
+        json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+
+
+def _record(event):
+    "Append event to file of this process."
+    import json
+    folder = os.environ.get(ENV)
+    if not folder:
+        return
+    line = json.dumps(event) + '\n'
+    key = (os.getpid(), folder)
+    with _lock:
+        f = _files.get(key)
+        if f is None:
+            # new file after fork, parent's handle is not ours
+            f = open(os.path.join(folder, '{}.jsonl'.format(key[0])), 'a')
+            _files[key] = f
+        f.write(line)
+        f.flush()
@@ -0,0 +1,238 @@
+# encoding: utf-8
+"""
+Per image statistics for quality control: intensity mean, standard
+deviation and percentiles, fraction of saturated pixels and a focus score.
+Images are read in parallel, with files read ahead in a thread while the
+previous image is measured, and the statistics are computed with NumPy on the
+decoded image. Integer images are measured from their histogram, such that
+percentiles do not need a sort.
+
+The table is cached in ``AdditionalData/qc.npz``, and only new or modified
+images are measured when it is computed again.
+
+Example
+-------
+>>> table = experiment.qc()
+>>> table['mean'][table['C'] == 1]
+>>> wells = qc.summary(table)
+"""
+import os, pydebug
+from .utils import cached_columns
+
+debug = pydebug.debug('matrixscreener')
+
+_cache = os.path.join('AdditionalData', 'qc.npz')
+
+# attributes of image, -1 if missing in filename
+ATTRIBUTES = ['S', 'U', 'V', 'X', 'Y', 'T', 'Z', 'C']
+
+# statistics of image
+STATISTICS = ['min', 'max', 'mean', 'std', 'p01', 'p50', 'p99', 'saturated',
+              'focus']
+
+# level is the saturation level from the bit depth of the stored image
+COLUMNS = ([(name, int) for name in ATTRIBUTES] +
+           [(name, float) for name in STATISTICS] +
+           [('level', float), ('dtype', str)])
+
+
+def table(path, images, cache=True):
+    """Statistics of images as a table with one row per image.
+
+    Images are measured in parallel, and the table is cached in
+    ``AdditionalData/qc.npz``. Only new or modified images are measured when
+    the cache exists.
+
+    Parameters
+    ----------
+    path : string
+        Path to experiment.
+    images : list of filenames
+        Images to measure. If both TIFF and PNG of an image exists, TIFF is
+        used.
+    cache : bool
+        Whether to read and write the cache.
+
+    Returns
+    -------
+    collections.OrderedDict
+        Column name -> numpy array. Columns are ``path``, ``mtime`` and the
+        ones in :data:`COLUMNS`, see :func:`measure` for statistics.
+    """
+    # one image per plane, prefer TIFF as in projections
+    planes = {}
+    for image in images:
+        stem = image.rsplit('.ome.tif', 1)[0].rsplit('.png', 1)[0]
+        if stem not in planes or image.endswith('.tif'):
+            planes[stem] = image
+    images = [planes[k] for k in sorted(planes)]
+    cache_file = os.path.join(path, _cache) if cache else None
+    debug('qc of {} images in {}'.format(len(images), path))
+    return cached_columns(cache_file, images, measure_blocking, COLUMNS)
+
+
+def measure_blocking(paths, prefetch=2):
+    """Statistics of images, see :func:`measure`. Files are read ahead in
+    threads, such that reading overlaps with decoding and measuring.
+
+    Parameters
+    ----------
+    paths : list of filenames
+        Images.
+    prefetch : int
+        Files read ahead.
+
+    Returns
+    -------
+    list of dicts
+        Keys as in :data:`COLUMNS`.
+    """
+    from io import BytesIO
+    from concurrent.futures import ThreadPoolExecutor
+    import numpy as np
+    from PIL import Image
+    from .experiment import attributes, _read
+
+    rows = []
+    with ThreadPoolExecutor(max(1, prefetch)) as readers:
+        reads = [readers.submit(_read, p) for p in paths[:prefetch]]
+        for i, path in enumerate(paths):
+            if i + prefetch < len(paths):
+                reads.append(readers.submit(_read, paths[i + prefetch]))
+            data = reads[i].result()
+            reads[i] = None  # release memory
+            attr = attributes(path)
+            row = dict((name, getattr(attr, name.lower(), -1))
+                       for name in ATTRIBUTES)
+            # palette images give their indices, which are the intensities
+            img = Image.open(BytesIO(data))
+            pixels = np.asarray(img)
+            del data
+            level = saturation_level(img, pixels)
+            row.update(measure(pixels, level))
+            row['level'] = float('nan') if level is None else float(level)
+            row['dtype'] = pixels.dtype.name
+            rows.append(row)
+    return rows
+
+
+def saturation_level(image, pixels):
+    """Saturation level from bit depth of stored image: maximum of its
+    dtype, 65535 for 16 bit PNGs decoded as 32 bit integers. None for
+    floats.
+
+    Parameters
+    ----------
+    image : PIL.Image.Image
+    pixels : numpy.ndarray
+        Decoded image.
+    """
+    import numpy as np
+    if image.format == 'PNG' and image.mode in ('I', 'I;16', 'I;16B'):
+        # PNG has at most 16 bit
+        return 2 ** 16 - 1
+    if np.issubdtype(pixels.dtype, np.integer):
+        return np.iinfo(pixels.dtype).max
+    return None
+
+
+def measure(data, level=None):
+    """Statistics of image.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        2D image.
+    level : number
+        Saturation level, see :func:`saturation_level`. Defaults to maximum
+        of integer dtype.
+
+    Returns
+    -------
+    dict
+        ``min``, ``max``, ``mean``, ``std``, percentiles ``p01``, ``p50``
+        and ``p99``, ``saturated`` (fraction of pixels at or above level,
+        NaN for floats without level) and ``focus`` (variance of Laplacian,
+        higher is sharper).
+    """
+    import numpy as np
+    data = np.asarray(data)
+    if level is None and np.issubdtype(data.dtype, np.integer):
+        level = np.iinfo(data.dtype).max
+    if data.ndim > 2:
+        # color, measure luminance
+        data = data.mean(axis=2)
+    n = data.size
+    if np.issubdtype(data.dtype, np.integer) and data.dtype.itemsize <= 2:
+        info = np.iinfo(data.dtype)
+        hist = np.bincount(data.ravel().astype(np.intp) - info.min)
+        values = np.arange(len(hist), dtype=np.float64) + info.min
+        nonzero = np.flatnonzero(hist)
+        mean = float(np.dot(hist, values) / n)
+        std = float(np.sqrt(np.dot(hist, (values - mean) ** 2) / n))
+        cumulative = np.cumsum(hist)
+        p01, p50, p99 = values[np.searchsorted(
+            cumulative, [0.01 * n, 0.5 * n, 0.99 * n])]
+        stats = {'min': values[nonzero[0]], 'max': values[nonzero[-1]],
+                 'mean': mean, 'std': std, 'p01': p01, 'p50': p50,
+                 'p99': p99,
+                 'saturated': hist[max(0, int(level) - info.min):].sum() /
+                 float(n)}
+    else:
+        flat = data.ravel().astype(np.float64)
+        p01, p50, p99 = np.percentile(flat, [1, 50, 99])
+        stats = {'min': flat.min(), 'max': flat.max(), 'mean': flat.mean(),
+                 'std': flat.std(), 'p01': p01, 'p50': p50, 'p99': p99,
+                 'saturated': np.count_nonzero(flat >= level) / float(n)
+                 if level is not None else float('nan')}
+    stats['focus'] = focus(data)
+    return dict((k, float(v)) for k, v in stats.items())
+
+
+def focus(data):
+    """Focus score: variance of the Laplacian of image."""
+    import numpy as np
+    if min(data.shape[:2]) < 3:
+        return 0.0
+    data = data.astype(np.float32)
+    laplacian = (data[:-2, 1:-1] + data[2:, 1:-1] + data[1:-1, :-2] +
+                 data[1:-1, 2:] - 4 * data[1:-1, 1:-1])
+    return float(laplacian.var())
+
+
+def summary(table, keys=('U', 'V')):
+    """Mean of statistics per group of images, such as wells.
+
+    Parameters
+    ----------
+    table : dict
+        Table from :func:`table`.
+    keys : tuple of strings
+        Columns to group by.
+
+    Returns
+    -------
+    collections.OrderedDict
+        Column name -> numpy array, one row per group. Columns are keys,
+        ``images`` (count) and :data:`STATISTICS`, ``saturated`` and ``max``
+        are the maximum of group.
+    """
+    from collections import OrderedDict
+    import numpy as np
+    groups = np.stack([np.asarray(table[k]) for k in keys], axis=1) \
+        if len(table['path']) else np.zeros((0, len(keys)), dtype=int)
+    unique, index = np.unique(groups, axis=0, return_inverse=True)
+    index = index.ravel()
+    count = np.bincount(index, minlength=len(unique))
+    result = OrderedDict((k, unique[:, i]) for i, k in enumerate(keys))
+    result['images'] = count
+    for name in STATISTICS:
+        values = np.asarray(table[name], dtype=np.float64)
+        if name in ('saturated', 'max'):
+            group_max = np.full(len(unique), -np.inf)
+            np.maximum.at(group_max, index, values)
+            result[name] = group_max
+        else:
+            result[name] = np.bincount(index, values, len(unique)) / \
+                np.maximum(count, 1)
+    return result
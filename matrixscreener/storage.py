@@ -0,0 +1,371 @@
+# encoding: utf-8
+"""
+Storage backends for experiments. Paths with a protocol, such as
+``s3://bucket/experiment--1``, are accessed through `fsspec
+<https://filesystem-spec.readthedocs.io>`_ (optional dependency), other paths
+on the local file system.
+
+Backends list all files below a prefix in one batched listing, instead of one
+glob per folder, and read byte ranges and several files concurrently.
+
+Example
+-------
+>>> from matrixscreener.experiment import Experiment
+>>> e = Experiment('s3://bucket/experiment--1')  # needs s3fs
+>>> e.images
+>>> e.compress()
+
+Other backends can be added with :func:`register`.
+"""
+import os, re, pydebug
+
+debug = pydebug.debug('matrixscreener')
+
+# protocol -> factory(protocol) returning Storage
+_backends = {}
+# protocol -> Storage instance
+_instances = {}
+# path prefix -> Storage, see mount
+_mounts = {}
+
+
+class Storage(object):
+    """Interface of storage backends. Paths are strings, with ``/`` as
+    separator. Subclasses implement :meth:`find`, :meth:`info`,
+    :meth:`read`, :meth:`write` and :meth:`remove`."""
+
+    def find(self, prefix):
+        """All files below prefix, in one listing.
+
+        Returns
+        -------
+        list of strings
+            Sorted paths.
+        """
+        raise NotImplementedError
+
+    def info(self, path):
+        """Size and modification time of file.
+
+        Returns
+        -------
+        size, mtime : int, float
+            None if file does not exist.
+        """
+        raise NotImplementedError
+
+    def read(self, path, start=None, end=None):
+        """Bytes of file, or of range ``[start, end)``.
+
+        Returns
+        -------
+        bytes
+        """
+        raise NotImplementedError
+
+    def write(self, path, data):
+        """Write bytes to file. A file is either complete or missing, also if
+        process is killed while writing."""
+        raise NotImplementedError
+
+    def remove(self, path):
+        "Remove file."
+        raise NotImplementedError
+
+    def exists(self, path):
+        "Whether file exists."
+        return self.info(path) is not None
+
+    def open(self, path):
+        """Readable binary file object of path, for readers such as
+        ``PIL.Image.open``. Use as context manager to close it."""
+        from io import BytesIO
+        return BytesIO(self.read(path))
+
+    def size(self, path):
+        "Size of file in bytes, 0 if it does not exist."
+        info = self.info(path)
+        return info[0] if info else 0
+
+    def read_many(self, paths, workers=8):
+        """Read several files concurrently.
+
+        Returns
+        -------
+        list of bytes
+            In order of paths.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        if len(paths) < 2:
+            return [self.read(path) for path in paths]
+        with ThreadPoolExecutor(min(workers, len(paths))) as executor:
+            return list(executor.map(self.read, paths))
+
+    def glob(self, *patterns):
+        """Files and folders matching patterns, where ``*`` matches anything
+        but ``/``. Folders are derived from one listing of files below the
+        common part of patterns without wildcards.
+
+        Returns
+        -------
+        list of strings
+            Sorted matches of first pattern, then of second pattern, etc.
+        """
+        roots = [p.split('*', 1)[0].rsplit('/', 1)[0] for p in patterns]
+        root = os.path.commonprefix(roots).rsplit('/', 1)[0] \
+            if len(set(roots)) > 1 else roots[0]
+        candidates = set()
+        for path in self.find(root):
+            while path.startswith(root) and path not in candidates:
+                candidates.add(path)
+                path = path.rsplit('/', 1)[0]
+        result = []
+        for pattern in patterns:
+            regex = re.compile('^' + '[^/]*'.join(
+                re.escape(part) for part in pattern.split('*')) + '$')
+            result.extend(sorted(p for p in candidates if regex.match(p)))
+        return result
+
+
+class LocalStorage(Storage):
+    "Local file system."
+
+    def find(self, prefix):
+        found = []
+        for folder, _, files in os.walk(prefix):
+            found.extend(os.path.join(folder, f) for f in files)
+        return sorted(found)
+
+    def glob(self, *patterns):
+        from .experiment import glob
+        return [path for pattern in patterns for path in glob(pattern)]
+
+    def info(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime
+
+    def exists(self, path):
+        return os.path.isfile(path)
+
+    def open(self, path):
+        return open(path, 'rb')
+
+    def read(self, path, start=None, end=None):
+        with open(path, 'rb') as f:
+            if start:
+                f.seek(start)
+            if end is None:
+                return f.read()
+            return f.read(end - (start or 0))
+
+    def read_many(self, paths, workers=8):
+        # little to gain from threads on local disks
+        return [self.read(path) for path in paths]
+
+    def write(self, path, data):
+        folder = os.path.dirname(path)
+        if folder and not os.path.isdir(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                # created by other worker
+                pass
+        tmp = temporary(path)
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.rename(tmp, path)
+        except BaseException:
+            _remove_quietly(tmp)
+            raise
+
+    def remove(self, path):
+        os.remove(path)
+
+
+class FSSpecStorage(Storage):
+    """Storage through an fsspec file system, such as s3fs or gcsfs.
+
+    Parameters
+    ----------
+    fs : fsspec.AbstractFileSystem
+    protocol : string
+        Prefix of paths, such as ``'s3'``.
+    """
+
+    def __init__(self, fs, protocol):
+        self.fs = fs
+        self.protocol = protocol
+
+    def _url(self, path):
+        "Path from fsspec with protocol."
+        if '://' in path:
+            return path
+        return '{}://{}'.format(self.protocol, path.lstrip('/')
+                                if self.protocol != 'memory' else path)
+
+    def find(self, prefix):
+        return sorted(self._url(p) for p in self.fs.find(prefix))
+
+    def info(self, path):
+        try:
+            info = self.fs.info(path)
+        except (IOError, OSError):
+            return None
+        mtime = info.get('mtime') or info.get('LastModified') or \
+            info.get('created') or 0
+        if hasattr(mtime, 'timestamp'):
+            mtime = mtime.timestamp()
+        return info.get('size', 0), float(mtime)
+
+    def read(self, path, start=None, end=None):
+        return self.fs.cat_file(path, start=start, end=end)
+
+    def read_many(self, paths, workers=8):
+        # fsspec fetches concurrently for async file systems
+        data = self.fs.cat(list(paths), on_error='raise')
+        return [data[p] if p in data else data[self.fs._strip_protocol(p)]
+                for p in paths]
+
+    def write(self, path, data):
+        # object stores replace objects atomically
+        self.fs.pipe_file(path, data)
+
+    def remove(self, path):
+        self.fs.rm_file(path)
+
+
+def temporary(path):
+    """Unique temporary filename next to path, with process id and a random
+    part, such that workers writing the same file do not share temporary
+    files."""
+    import uuid
+    return '{}.{}.{}.tmp'.format(path, os.getpid(), uuid.uuid4().hex[:12])
+
+
+def _remove_quietly(path):
+    "Remove file if it exists."
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def register(protocol, factory):
+    """Use factory for paths starting with ``protocol://``.
+
+    Parameters
+    ----------
+    protocol : string
+    factory : function
+        Called with protocol, returns a :class:`Storage`.
+    """
+    _backends[protocol] = factory
+    _instances.pop(protocol, None)
+
+
+def mount(prefix, storage):
+    """Use storage for paths below prefix, such that functions given paths
+    of an experiment read them through the storage of the experiment.
+    :class:`matrixscreener.experiment.Experiment` mounts its path when it has
+    a storage other than the one of its protocol, such as
+    :class:`matrixscreener.packed.PackedStorage`. Process pools of
+    :mod:`matrixscreener.utils` give the mounts to their workers, see
+    :func:`mounts`.
+
+    Parameters
+    ----------
+    prefix : string
+        Local path or URL.
+    storage : Storage
+    """
+    _mounts[prefix.rstrip('/' + os.sep)] = storage
+
+
+def unmount(prefix, storage=None):
+    """Remove mount of prefix made with :func:`mount`.
+
+    Parameters
+    ----------
+    prefix : string
+        Local path or URL.
+    storage : Storage
+        Only remove mount if prefix is mounted on storage.
+    """
+    prefix = prefix.rstrip('/' + os.sep)
+    if storage is None or _mounts.get(prefix) is storage:
+        _mounts.pop(prefix, None)
+
+
+def mounts():
+    """Copy of mount table, prefix -> storage. Workers which are not forked
+    do not inherit mounts, give them the table and call :func:`_restore` in
+    the worker."""
+    return dict(_mounts)
+
+
+def _restore(table):
+    "Replace mount table with table from :func:`mounts`, in workers."
+    _mounts.clear()
+    _mounts.update(table)
+
+
+def _mounted(path):
+    "Storage of longest mounted prefix of path, None if not mounted."
+    found = None
+    for prefix in _mounts:
+        if (path == prefix or path.startswith(prefix + '/') or
+                path.startswith(prefix + os.sep)):
+            if found is None or len(prefix) > len(found):
+                found = prefix
+    return _mounts[found] if found is not None else None
+
+
+def protocol(path):
+    "Protocol of path, ``'file'`` for local paths."
+    if '://' in path:
+        return path.split('://', 1)[0]
+    return 'file'
+
+
+def storage_for(path):
+    """Storage backend of path.
+
+    Parameters
+    ----------
+    path : string
+        Local path or URL.
+
+    Returns
+    -------
+    Storage
+        Mounted storage if path is below a mounted prefix, see :func:`mount`,
+        else backend of protocol.
+    """
+    if _mounts:
+        mounted = _mounted(path)
+        if mounted is not None:
+            return mounted
+    name = protocol(path)
+    if name not in _instances:
+        if name in _backends:
+            _instances[name] = _backends[name](name)
+        elif name == 'file':
+            _instances[name] = LocalStorage()
+        else:
+            try:
+                import fsspec
+            except ImportError:
+                raise ImportError('matrixscreener needs fsspec for {} '
+                                  'paths, pip install fsspec'.format(name))
+            debug('fsspec storage for {}'.format(name))
+            _instances[name] = FSSpecStorage(fsspec.filesystem(name), name)
+    return _instances[name]
+
+
+def is_local(path):
+    "Whether path is on the local file system."
+    return isinstance(storage_for(path), LocalStorage)
@@ -1,10 +1,32 @@
-from multiprocessing import Pool, cpu_count
+import pydebug
+try:
+    from os import cpu_count
+except ImportError:
+    # python 2
+    from multiprocessing import cpu_count
 
+# multiprocessing.Pool is imported in apply_async, such that
+# `import matrixscreener` stays fast
 try:
-    _pools = cpu_count()
+    _pools = cpu_count() or 4
 except NotImplementedError:
     _pools = 4
 
+# memory budget in bytes for apply_budgeted, None gives half of available
+# memory when work is started
+_memory_limit = None
+
+# prefix of shared memory blocks created by share in this worker, set when
+# worker is started by a pool helper, see _pool
+_shm_prefix = None
+
+# bits per pixel of PIL image modes, see image_memory
+_mode_bits = {'1': 1, 'L': 8, 'P': 8, 'I;16': 16, 'I;16B': 16, 'I;16L': 16,
+              'I': 32, 'F': 32, 'RGB': 24, 'RGBA': 32}
+
+# debug with `DEBUG=matrixscreener python script.py`
+debug = pydebug.debug('matrixscreener')
+
 
 def chop(list_, n):
     "Chop list_ into n chunks. Returns a list."
@@ -59,18 +81,524 @@ def apply_async(fn, **kwargs):
         if add:
             arglist.append(dict_)
 
+    from .profiling import stage
+
     # run in multiple Pools
     promises = []
     results = []
-    p = Pool(n)
-    for args in arglist:
-        res = p.apply_async(fn, kwds=args)
-        promises.append(res)
-    for res in promises:
-        result = res.get()
+    with stage('pool'):
+        p, prefix = _pool(n)
+    try:
+        for args in arglist:
+            res = p.apply_async(fn, kwds=args)
+            promises.append(res)
+        for res in promises:
+            result = res.get()
+            if hasattr(result, '__iter__'):
+                results.extend(result)
+            else:
+                results.append(result)
+        p.close()
+    except BaseException:
+        # nothing is returned, free shared arrays of all workers
+        p.terminate()
+        _release(results)
+        _unlink_shared(prefix)
+        raise
+    finally:
+        p.terminate()
+
+    return results
+
+
+def apply_budgeted(fn, items, cost, budget=None, workers=None,
+                   chunk_size=None, **kwargs):
+    """Call ``fn(chunk, **kwargs)`` on chunks of items in a pool of processes,
+    only running chunks whose estimated memory fits in budget, see
+    :func:`iter_budgeted`.
+
+    Returns
+    -------
+    list
+        Merged results of all chunks, in order of items.
+    """
+    results = {}
+    try:
+        for i, _, result in iter_budgeted(fn, items, cost, budget, workers,
+                                          chunk_size, **kwargs):
+            results[i] = result
+    except BaseException:
+        _release(results.values())
+        raise
+
+    merged = []
+    for i in sorted(results):
+        result = results[i]
         if hasattr(result, '__iter__'):
-            results.extend(result)
+            merged.extend(result)
         else:
-            results.append(result)
+            merged.append(result)
+    return merged
 
-    return results
+
+def iter_budgeted(fn, items, cost, budget=None, workers=None,
+                  chunk_size=None, **kwargs):
+    """Call ``fn(chunk, **kwargs)`` on chunks of items in a pool of processes,
+    only running chunks whose estimated memory fits in budget. Results are
+    yielded as chunks finish.
+
+    Chunks are started in order. A chunk is started when a worker is idle and
+    the estimated memory of running chunks plus the chunk is below budget,
+    such that fewer chunks run at once when images are large. A chunk is
+    always started when nothing is running, even if it exceeds budget.
+
+    Parameters
+    ----------
+    fn : function
+        Function to call in workers, must be picklable.
+    items : list
+        Items to split in chunks.
+    cost : function
+        Called with a chunk in this process, returns estimated peak memory in
+        bytes when processing chunk. See :func:`image_memory`.
+    budget : int
+        Bytes, defaults to ``matrixscreener.utils._memory_limit`` or half of
+        available memory.
+    workers : int
+        Maximum number of workers, defaults to
+        ``matrixscreener.utils._pools``.
+    chunk_size : int
+        Items in each chunk, defaults to spread items on 4 chunks per worker.
+    kwargs : keyword arguments
+        Passed to fn.
+
+    Yields
+    ------
+    index, chunk, result : int, list, object
+        Index of chunk, the chunk and result of fn, in order of completion.
+        If iteration stops early, by an error or by closing the generator,
+        workers are terminated and shared arrays (see :func:`share`) which
+        were not yielded are freed.
+    """
+    from .profiling import stage
+
+    workers = max(1, workers or _pools)
+    budget = memory_budget(budget)
+    chunk_size = chunk_size or max(1, -(-len(items) // (workers * 4)))
+    chunks = [items[i:i + chunk_size]
+              for i in range(0, len(items), chunk_size)]
+    if not chunks:
+        return
+    costs = [cost(chunk) for chunk in chunks]
+    debug('iter_budgeted {} chunks, budget {}, largest chunk {}'.format(
+        len(chunks), budget, max(costs)))
+
+    pending = list(range(len(chunks)))
+    running = {}
+    used = 0
+    yielded = set()
+    done = False
+    with stage('pool'):
+        pool, prefix = _pool(min(workers, len(chunks)))
+    try:
+        while pending or running:
+            while (pending and len(running) < workers and
+                   (not running or budget is None or
+                    used + costs[pending[0]] <= budget)):
+                i = pending.pop(0)
+                used += costs[i]
+                running[i] = pool.apply_async(fn, (chunks[i],), kwargs)
+            finished = [i for i, res in running.items() if res.ready()]
+            if not finished:
+                next(iter(running.values())).wait(0.05)
+                continue
+            for i in sorted(finished):
+                result = running.pop(i).get()
+                used -= costs[i]
+                yielded.update(a.name for a in _shared(result))
+                yield i, chunks[i], result
+        pool.close()
+        done = True
+    finally:
+        pool.terminate()
+        if not done:
+            _unlink_shared(prefix, yielded)
+
+
+def _pool(processes):
+    """Process pool whose workers name shared memory blocks with a prefix
+    unique to the pool, such that blocks of workers which are terminated can
+    be freed with :func:`_unlink_shared`.
+
+    Returns
+    -------
+    pool, prefix : multiprocessing.Pool, string
+    """
+    import uuid
+    from multiprocessing import Pool
+    try:
+        # workers register blocks with the resource tracker of this process,
+        # which frees blocks left when this process exits
+        from multiprocessing import resource_tracker
+        resource_tracker.ensure_running()
+    except ImportError:
+        # python < 3.8
+        pass
+    from .storage import mounts
+    prefix = 'ms' + uuid.uuid4().hex[:10]
+    return Pool(processes, _init_worker, (prefix, mounts())), prefix
+
+
+def _executor(workers):
+    """ProcessPoolExecutor whose workers have the storage mounts of this
+    process, also when they are spawned instead of forked."""
+    from concurrent.futures import ProcessPoolExecutor
+    from .storage import mounts
+    return ProcessPoolExecutor(workers, initializer=_init_worker,
+                               initargs=(None, mounts()))
+
+
+def _init_worker(prefix, mounts=None):
+    """Set prefix of shared memory blocks and storage mounts in pool
+    worker."""
+    global _shm_prefix
+    from .storage import _restore
+    if prefix:
+        _shm_prefix = prefix
+    if mounts is not None:
+        _restore(mounts)
+
+
+def memory_budget(budget=None):
+    """Memory budget in bytes: budget if given, else
+    ``matrixscreener.utils._memory_limit``, else half of available memory.
+    None if available memory is unknown."""
+    budget = budget or _memory_limit
+    if budget:
+        return budget
+    available = available_memory()
+    return available // 2 if available else None
+
+
+def available_memory():
+    "Bytes of memory available for new processes, None if unknown."
+    import os
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def image_memory(filenames, factor=1):
+    """Estimated memory of decoding largest image in filenames. Image size is
+    read from the header of the largest file, falls back to file size. Only
+    the first 64 KiB are read from remote storage.
+
+    Parameters
+    ----------
+    filenames : list of strings
+        Images.
+    factor : number
+        Multiplied with decoded size, to include buffers of conversion and
+        encoding.
+
+    Returns
+    -------
+    int
+        Bytes.
+    """
+    from .storage import storage_for, LocalStorage
+    sizes = [(storage_for(f).size(f), f) for f in filenames]
+    sizes = [s for s in sizes if s[0]]
+    if not sizes:
+        return 0
+    size, filename = max(sizes)
+    try:
+        from PIL import Image
+        if type(storage_for(filename)) is LocalStorage:
+            img = Image.open(filename)
+        else:
+            from io import BytesIO
+            img = Image.open(BytesIO(
+                storage_for(filename).read(filename, 0, 1 << 16)))
+        width, height = img.size
+        bits = _mode_bits.get(img.mode, 32)
+        size = max(size, width * height * bits // 8)
+    except (IOError, OSError):
+        pass
+    return int(size * factor)
+
+
+def cached_columns(cache_file, paths, fn, columns):
+    """Table with one row per path, cached in a columnar ``.npz`` file.
+
+    Rows are only computed for paths which are new or have been modified since
+    the cache was written. Rows are computed with ``apply_async(fn, ...)``.
+
+    Parameters
+    ----------
+    cache_file : string
+        Where to store cache, read and written through its storage, see
+        :mod:`matrixscreener.storage`. Not written if None or if folder is
+        not writable.
+    paths : list of strings
+        Files to get rows for. Modification times are read from their
+        storage.
+    fn : function
+        Called as ``fn(paths=[...])``, returns a list of dicts with one row
+        per path. Must be picklable.
+    columns : list of tuples
+        (name, dtype) for every column, passed to ``numpy.array``. Columns
+        ``path`` and ``mtime`` are added.
+
+    Returns
+    -------
+    collections.OrderedDict
+        Column name -> numpy array, rows in same order as paths.
+    """
+    from collections import OrderedDict
+    from io import BytesIO
+    import numpy as np
+    from .storage import storage_for
+
+    mtimes = []
+    for path in paths:
+        info = storage_for(path).info(path)
+        if info is None:
+            raise IOError('no such file: {}'.format(path))
+        mtimes.append(info[1])
+    cached = {}
+    old = None
+    cache = storage_for(cache_file) if cache_file else None
+    if cache and cache.exists(cache_file):
+        try:
+            with np.load(BytesIO(cache.read(cache_file))) as data:
+                old = OrderedDict((k, data[k]) for k in data.files)
+            if all(name in old for name, _ in columns):
+                for i, path in enumerate(old['path']):
+                    cached[str(path)] = i
+        except (IOError, ValueError, KeyError):
+            old = None
+
+    todo = [p for p, m in zip(paths, mtimes)
+            if p not in cached or old['mtime'][cached[p]] != m]
+    rows = {}
+    if todo:
+        if len(todo) == 1:
+            new_rows = fn(paths=todo)
+        else:
+            new_rows = apply_async(fn, paths=(todo, True))
+        rows = dict(zip(todo, new_rows))
+
+    table = OrderedDict()
+    table['path'] = np.array(paths, dtype=str)
+    table['mtime'] = np.array(mtimes, dtype=float)
+    for name, dtype in columns:
+        values = []
+        for path in paths:
+            if path in rows:
+                values.append(rows[path][name])
+            else:
+                values.append(old[name][cached[path]])
+        table[name] = np.array(values, dtype=dtype)
+
+    if todo and cache:
+        try:
+            data = BytesIO()
+            np.savez_compressed(data, **table)
+            cache.write(cache_file, data.getvalue())
+        except (IOError, OSError):
+            pass
+    return table
+
+
+class SharedArray(object):
+    """Picklable reference to a NumPy array in shared memory, created in a
+    worker by :func:`share` and attached in the parent by :func:`attached`,
+    such that pixel data is not pickled when returned from a pool.
+
+    Arrays which are not in shared memory are carried in ``data`` and
+    pickled, such that results are handled the same way.
+
+    Blocks which are never attached or released are freed when the process
+    which started the pool exits.
+
+    Attributes
+    ----------
+    name : string
+        Name of shared memory block, None if array is in data.
+    shape : tuple
+    dtype : string
+    data : numpy.ndarray
+        Array if it is not in shared memory.
+    """
+
+    def __init__(self, name, shape, dtype, data=None):
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = dtype
+        self.data = data
+        self._shm = None
+
+    def __getstate__(self):
+        return {'name': self.name, 'shape': self.shape, 'dtype': self.dtype,
+                'data': self.data}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __repr__(self):
+        return 'SharedArray({!r}, shape={}, dtype={})'.format(
+            self.name, self.shape, self.dtype)
+
+    def attach(self):
+        """Zero-copy view of array. The block is unlinked when attached, and
+        freed by :meth:`release` or when the process exits.
+
+        Returns
+        -------
+        numpy.ndarray
+        """
+        import numpy as np
+        if self.data is not None:
+            return self.data
+        from multiprocessing.shared_memory import SharedMemory
+        if self._shm is None:
+            self._shm = SharedMemory(self.name)
+            # name is not needed any more, memory is freed when closed
+            self._shm.unlink()
+        return np.ndarray(self.shape, dtype=self.dtype, buffer=self._shm.buf)
+
+    def release(self):
+        """Free shared memory. Views from :meth:`attach` must not be used
+        afterwards."""
+        if self.name is None:
+            self.data = None
+            return
+        from multiprocessing.shared_memory import SharedMemory
+        if self._shm is None:
+            # never attached, unlink by name
+            try:
+                self._shm = SharedMemory(self.name)
+                self._shm.unlink()
+            except (IOError, OSError):
+                return
+        try:
+            self._shm.close()
+        except BufferError:
+            # views are still in use, memory is freed when they are gone
+            debug('views of {} still in use'.format(self.name))
+        self._shm = None
+
+
+def share(array, min_bytes=1024**2):
+    """Copy array to shared memory in a worker, such that returning it to
+    the parent does not pickle the data. See :func:`attached`.
+
+    Arrays below min_bytes, or on Python without
+    ``multiprocessing.shared_memory``, are carried in the returned
+    :class:`SharedArray` and pickled.
+
+    Parameters
+    ----------
+    array : numpy.ndarray
+        Array to share.
+    min_bytes : int
+        Smaller arrays are pickled.
+
+    Returns
+    -------
+    SharedArray
+    """
+    import uuid
+    import numpy as np
+    try:
+        from multiprocessing.shared_memory import SharedMemory
+    except ImportError:
+        # python < 3.8
+        SharedMemory = None
+    if SharedMemory is None or array.nbytes < min_bytes:
+        return SharedArray(None, array.shape, array.dtype.str, array)
+    # named by pool, such that blocks of terminated workers can be freed
+    name = '{}_{}'.format(_shm_prefix, uuid.uuid4().hex[:12]) \
+        if _shm_prefix else None
+    shm = SharedMemory(name, create=True, size=array.nbytes)
+    view = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+    view[...] = array
+    del view
+    shared = SharedArray(shm.name, array.shape, array.dtype.str)
+    shm.close()
+    return shared
+
+
+class attached(object):
+    """Context manager which attaches :class:`SharedArray` in results as
+    NumPy arrays and frees them on exit. Other items are kept as is.
+
+    Example
+    -------
+    >>> results = apply_async(fn_returning_shared_arrays, ...)
+    >>> with attached(results) as arrays:
+    ...     total = sum(array.sum() for array in arrays)
+    """
+
+    def __init__(self, results):
+        self.results = list(results)
+
+    def __enter__(self):
+        arrays = []
+        try:
+            for result in self.results:
+                if isinstance(result, SharedArray):
+                    result = result.attach()
+                arrays.append(result)
+        except Exception:
+            self.release()
+            raise
+        return arrays
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def release(self):
+        "Free shared memory of all results."
+        for result in self.results:
+            if isinstance(result, SharedArray):
+                result.release()
+
+
+def _shared(result):
+    "SharedArrays in result of a chunk, which is a SharedArray or a list."
+    if isinstance(result, SharedArray):
+        return [result]
+    if isinstance(result, (list, tuple)):
+        return [r for r in result if isinstance(r, SharedArray)]
+    return []
+
+
+def _release(results):
+    "Free shared arrays in results."
+    for result in results:
+        for shared in _shared(result):
+            shared.release()
+
+
+def _unlink_shared(prefix, keep=()):
+    """Unlink shared memory blocks whose name starts with prefix, except
+    names in keep. Blocks are found in ``/dev/shm``, on other systems they
+    are freed by the resource tracker when the process exits."""
+    import os
+    folder = '/dev/shm'
+    if not os.path.isdir(folder):
+        return
+    for name in os.listdir(folder):
+        if name.startswith(prefix) and name not in keep:
+            debug('freeing shared memory {}'.format(name))
+            SharedArray(name, (), '|u1').release()
@@ -18,5 +18,9 @@ setup(name='matrixscreener',
       license='MIT',
       url='https://github.com/arve0/matrixscreener',
       packages=['matrixscreener'],
-      install_requires=['pydebug', 'Pillow', 'fijibin'],
+      install_requires=['pydebug', 'Pillow', 'fijibin', 'numpy',
+                        'futures; python_version < "3.2"'],
+      entry_points={
+          'console_scripts': ['matrixscreener=matrixscreener.cli:main'],
+      },
       long_description=long_description)
@@ -10,3 +10,13 @@ def test_module_has_attr():
     import matrixscreener
     assert hasattr(matrixscreener, 'cam')
     assert hasattr(matrixscreener, 'experiment')
+
+def test_lazy_import():
+    "import matrixscreener.cam should not load Pillow, Fiji or multiprocessing"
+    import subprocess, sys
+    for module in ('matrixscreener.cam', 'matrixscreener.experiment'):
+        code = ('import sys, ' + module + ';'
+                'print([m for m in ("PIL", "fijibin", "multiprocessing")'
+                '       if m in sys.modules])')
+        out = subprocess.check_output([sys.executable, '-c', code])
+        assert out.strip() == b'[]'
@@ -1,4 +1,7 @@
 """Test cam module."""
+import socket
+from time import sleep
+
 import pytest
 
 from matrixscreener.cam import *
@@ -25,6 +28,38 @@ class EchoSocket(object):
     def fileno(self):
         return 0
 
+    def close(self):
+        pass
+
+
+class RefusingSocket(EchoSocket):
+    """Echo socket which refuses the first connection attempt."""
+
+    attempts = 0
+
+    def connect(self, where):
+        RefusingSocket.attempts += 1
+        if RefusingSocket.attempts == 1:
+            raise socket.error('connection refused')
+
+class DroppingSocket(EchoSocket):
+    """Echo socket which is closed by remote end after the first command was
+    sent, or which fails sending the first command if ``fail_send``."""
+
+    sends = 0
+    fail_send = False
+
+    def send(self, msg):
+        DroppingSocket.sends += 1
+        if DroppingSocket.sends == 1 and self.fail_send:
+            raise socket.error('broken pipe')
+        return EchoSocket.send(self, msg)
+
+    def recv(self, buffer_size):
+        if DroppingSocket.sends == 1:
+            return b''
+        return EchoSocket.recv(self, buffer_size)
+
 # TEST
 # key (here cli) overrided if defined several times
 # prefix added
@@ -76,3 +111,225 @@ def test_commands(monkeypatch):
     should_be = tuples_as_dict(cmd)
 
     assert information == should_be
+
+
+def test_pool(monkeypatch):
+    """CAMPool should send commands to every address."""
+    monkeypatch.setattr("socket.socket", EchoSocket)
+    monkeypatch.setattr(CAM, "flush", lambda self: None)
+
+    addresses = [('10.0.0.1', 8895), ('10.0.0.2', 8895)]
+    cmd = [('cmd', 'getinfo'), ('dev', 'stage')]
+    with CAMPool(addresses) as pool:
+        responses = pool.broadcast(cmd)
+
+    should_be = tuples_as_dict([('cli', 'python-matrixscreener'),
+                                ('app', 'matrix')] + cmd)
+    assert list(responses.keys()) == addresses
+    for response in responses.values():
+        assert response[0] == should_be
+
+
+def test_pool_reconnect(monkeypatch):
+    """CAMPool should reconnect with backoff when connection is refused."""
+    monkeypatch.setattr("socket.socket", RefusingSocket)
+    monkeypatch.setattr(CAM, "flush", lambda self: None)
+
+    with CAMPool([('127.0.0.1', 8895)], backoff=0.01) as pool:
+        response = pool.send(('127.0.0.1', 8895), [('cmd', 'startscan')])
+        status = pool.status()[('127.0.0.1', 8895)]
+
+    assert response[0]['cmd'] == 'startscan'
+    assert RefusingSocket.attempts == 2
+    assert status['connected']
+
+
+def test_stats(monkeypatch, tmpdir):
+    """Commands should be counted in stats and written to trace."""
+    monkeypatch.setattr("socket.socket", EchoSocket)
+    monkeypatch.setattr(CAM, "flush", lambda self: None)
+
+    cam = CAM()
+    trace = tmpdir.join('trace.jsonl')
+    cam.trace(trace.strpath)
+    cam.start_scan()
+    cam.get_information()
+    cam.get_information()
+    cam.trace(None)
+
+    stats = cam.stats()
+    assert stats['commands']['getinfo']['count'] == 2
+    assert stats['commands']['startscan']['count'] == 1
+    assert stats['bytes_sent'] == stats['bytes_received'] > 0
+    assert stats['timeouts'] == 0
+
+    prometheus = cam.stats('prometheus')
+    assert ('matrixscreener_cam_command_seconds_count'
+            '{host="127.0.0.1",port="8895",cmd="getinfo"} 2') in prometheus
+
+    lines = trace.readlines()
+    assert len(lines) == 3
+    assert '"cmd": "startscan"' in lines[0]
+
+
+def test_information_cache(monkeypatch):
+    """getinfo should be typed and cached until other commands are sent."""
+    monkeypatch.setattr("socket.socket", EchoSocket)
+    monkeypatch.setattr(CAM, "flush", lambda self: None)
+
+    cam = CAM()
+    info = cam.get_information('stage')
+    assert isinstance(info, StageInformation)
+    assert info.dev == 'stage'
+    assert info.position == (None, None)
+
+    # cached
+    assert cam.get_information('stage') is info
+    assert cam.stats()['commands']['getinfo']['count'] == 1
+
+    # state changing command clears cache
+    cam.enable_all()
+    assert cam.get_information('stage') is not info
+    assert cam.stats()['commands']['getinfo']['count'] == 2
+
+    # scanstatus never cached
+    cam.get_information('scanstatus')
+    cam.get_information('scanstatus')
+    assert cam.stats()['commands']['getinfo']['count'] == 4
+
+
+def test_parse_value():
+    """Numeric values should be parsed."""
+    assert parse_value('12') == 12
+    assert parse_value('-0.5E1') == -5.0
+    assert parse_value('c:\\file') == 'c:\\file'
+
+
+def test_send_many(monkeypatch):
+    """Several commands should be sent in one message."""
+    monkeypatch.setattr("socket.socket", EchoSocket)
+    monkeypatch.setattr(CAM, "flush", lambda self: None)
+
+    cam = CAM()
+    cam.buffer_size = 4096
+    response = cam.send_many([[('cmd', 'deletelist')],
+                              cam_list_add('job2', fieldx=2, dxpos=10)])
+    assert len(response) == 2
+    assert response[0] == tuples_as_dict(cam.prefix + [('cmd', 'deletelist')])
+    assert response[1]['fieldx'] == '2'
+    assert response[1]['dxpos'] == '10'
+    assert cam.stats()['commands']['add']['count'] == 1
+
+
+def test_timeout(monkeypatch):
+    """Only commands without response before timeout should be timeouts."""
+    monkeypatch.setattr("socket.socket", EchoSocket)
+    monkeypatch.setattr(CAM, "flush", lambda self: None)
+
+    cam = CAM()
+    cam.start_scan()
+    assert not cam.timed_out
+
+    cam.timeout = 0.05
+    monkeypatch.setattr(CAM, "_check_socket", lambda self: [])
+    assert cam.start_scan() == []
+    assert cam.timed_out
+    assert cam.stats()['timeouts'] == 1
+
+    # closed connection is not a timeout
+    cam.close()
+    assert cam.receive() is None
+    assert not cam.timed_out
+
+
+def test_pool_health_timeout(monkeypatch):
+    """CAMPool should reconnect when health check times out."""
+    monkeypatch.setattr("socket.socket", EchoSocket)
+    monkeypatch.setattr(CAM, "flush", lambda self: None)
+    connect = CAM.connect
+    def short_timeout(self):
+        self.timeout = 0.01
+        connect(self)
+    monkeypatch.setattr(CAM, "connect", short_timeout)
+    monkeypatch.setattr(CAM, "_check_socket", lambda self: [])
+
+    address = ('127.0.0.1', 8895)
+    with CAMPool([address], health_interval=0.05) as pool:
+        pool.send(address, [('cmd', 'startscan')])
+        sleep(0.3)
+        status = pool.status()[address]
+
+    assert status['reconnects'] > 0
+
+
+@pytest.mark.parametrize('replay', [False, True])
+def test_pool_replay(monkeypatch, replay):
+    """Commands sent before connection was lost should only be sent again
+    when replay is given."""
+    monkeypatch.setattr("socket.socket", DroppingSocket)
+    monkeypatch.setattr(DroppingSocket, "sends", 0)
+    monkeypatch.setattr(CAM, "flush", lambda self: None)
+
+    address = ('127.0.0.1', 8895)
+    with CAMPool([address], backoff=0.01) as pool:
+        future = pool.submit(address, [('cmd', 'getinfo')], replay=replay)
+        if replay:
+            assert future.result()[0]['cmd'] == 'getinfo'
+        else:
+            with pytest.raises(socket.error):
+                future.result()
+
+    assert DroppingSocket.sends == (2 if replay else 1)
+
+
+def test_pool_send_failed(monkeypatch):
+    """Commands not sent before connection was lost should be retried."""
+    monkeypatch.setattr("socket.socket", DroppingSocket)
+    monkeypatch.setattr(DroppingSocket, "sends", 0)
+    monkeypatch.setattr(DroppingSocket, "fail_send", True)
+    monkeypatch.setattr(CAM, "flush", lambda self: None)
+
+    address = ('127.0.0.1', 8895)
+    with CAMPool([address], backoff=0.01) as pool:
+        response = pool.send(address, [('cmd', 'startscan')])
+
+    assert response[0]['cmd'] == 'startscan'
+    assert DroppingSocket.sends == 2
+
+
+class IdleSocket(EchoSocket):
+    """Echo socket reporting an idle scan status."""
+
+    def send(self, msg):
+        if b'scanstatus' in msg:
+            msg += b' /status:idle'
+        return EchoSocket.send(self, msg)
+
+
+def test_scan_finished(monkeypatch):
+    """getinfo should be cached again when scan has finished by itself."""
+    monkeypatch.setattr("socket.socket", IdleSocket)
+    monkeypatch.setattr(CAM, "flush", lambda self: None)
+
+    def count():
+        return cam.stats()['commands']['getinfo']['count']
+
+    cam = CAM()
+    cam.start_scan()
+    cam.get_information('stage')
+    cam.get_information('stage')
+    assert count() == 2
+
+    # scan finished message
+    cam.socket.msg = b'/inf:scanfinished'
+    assert cam.receive()[0]['inf'] == 'scanfinished'
+    cam.get_information('stage')
+    cam.get_information('stage')
+    assert count() == 3
+
+    # scan status reports idle
+    cam.start_scan()
+    assert cam.get_information('scanstatus').status == 'idle'
+    cam.get_information('stage')
+    cam.get_information('stage')
+    assert count() == 5
@@ -0,0 +1,82 @@
+import os
+import pytest
+from py import path
+
+
+@pytest.fixture
+def experiment(tmpdir):
+    "'experiment--test' in tmpdir. Returns Experiment object."
+    from matrixscreener.experiment import Experiment
+    e = path.local(__file__).dirpath().join('experiment--test')
+    e.copy(tmpdir.mkdir('experiment'))
+
+    return Experiment(tmpdir.join('experiment').strpath)
+
+
+def test_export_and_read(experiment, tmpdir):
+    "Slices of chunked array should equal images."
+    import numpy as np
+    from PIL import Image
+
+    store = tmpdir.join('store').strpath
+    array = experiment.to_chunked(store, chunks=(300, 300))
+    assert array.shape == (1, 2, 1, 1, 2, 1024, 1024)
+    assert array.attrs['fields'] == ['X00--Y00', 'X00--Y01']
+
+    image = experiment.images[-1]  # X00--Y01, C01
+    data = np.asarray(Image.open(image))
+    assert (array[0, 1, 0, 0, 1] == data).all()
+    assert (array[0, 1, 0, 0, 1, 250:700:3, 290:310] ==
+            data[250:700:3, 290:310]).all()
+    assert array[0, :, 0, 0, :, 0, 0].shape == (2, 2)
+
+
+def test_append(experiment, tmpdir):
+    "Exporting again should only write new images and grow array."
+    import shutil
+    from matrixscreener.chunked import export_blocking
+
+    store = tmpdir.join('store').strpath
+    array = experiment.to_chunked(store)
+    jobs = [(experiment.images[0], (0, 0, 0, 0, 0))]
+    assert export_blocking(jobs, store, array.chunks) == []
+
+    # new time point
+    image = experiment.images[0]
+    shutil.copy(image, image.replace('--T00', '--T01'))
+    array = experiment.to_chunked(store)
+    assert array.shape[2] == 2
+    assert (array[0, 0, 1, 0, 0] == array[0, 0, 0, 0, 0]).all()
+    assert not array[0, 1, 1].any()
+
+
+def test_dtype_and_shape(experiment, tmpdir, monkeypatch):
+    "Images should be cast to dtype of array, and other shapes refused."
+    import numpy as np
+    from matrixscreener import flatfield
+    from matrixscreener.chunked import export_blocking
+
+    store = tmpdir.join('store').strpath
+    array = experiment.to_chunked(store)
+    expected = array[0, 0, 0, 0, 0]
+    image = experiment.images[0]
+    os.utime(image, None)  # newer than chunks
+    read = flatfield.read
+
+    # 16 bit PNG decoded as mode I
+    monkeypatch.setattr(flatfield, 'read', lambda image, flatfield=None:
+                        read(image).astype(np.int32))
+    jobs = [(image, (0, 0, 0, 0, 0))]
+    assert export_blocking(jobs, store, array.chunks) == [image]
+    assert (array[0, 0, 0, 0, 0] == expected).all()
+
+    os.utime(image, None)
+    monkeypatch.setattr(flatfield, 'read', lambda image, flatfield=None:
+                        read(image).astype(np.int32) + 2 ** 20)
+    with pytest.raises(ValueError):
+        export_blocking(jobs, store, array.chunks)
+
+    monkeypatch.setattr(flatfield, 'read', lambda image, flatfield=None:
+                        read(image)[:512])
+    with pytest.raises(ValueError):
+        export_blocking(jobs, store, array.chunks)
@@ -0,0 +1,78 @@
+import json
+import pytest
+from py import path
+
+
+@pytest.fixture
+def experiment(tmpdir):
+    "'experiment--test' in tmpdir. Returns Experiment object."
+    from matrixscreener.experiment import Experiment
+    e = path.local(__file__).dirpath().join('experiment--test')
+    e.copy(tmpdir.mkdir('experiment'))
+
+    return Experiment(tmpdir.join('experiment').strpath)
+
+
+def test_index(experiment, capsys):
+    "index should list images with attributes."
+    from matrixscreener.cli import main
+
+    assert main(['index', experiment.path]) == 0
+    out, err = capsys.readouterr()
+
+    lines = [json.loads(l) for l in out.splitlines()]
+    assert [l['path'] for l in lines] == experiment.images
+    assert lines[0]['C'] == '00'
+    assert json.loads(err.splitlines()[-1])['event'] == 'done'
+
+
+def test_project(experiment, tmpdir, capsys):
+    "project should write one projection per field and channel."
+    from matrixscreener.cli import main
+    from PIL import Image
+    import numpy as np
+
+    folder = tmpdir.mkdir('projected').strpath
+    assert main(['project', experiment.path, '--folder', folder,
+                 '--workers', '2', '--chunk-size', '1',
+                 '--memory-limit', '1G']) == 0
+    _, err = capsys.readouterr()
+
+    files = tmpdir.join('projected').listdir(sort=True)
+    assert len(files) == 4
+    # one z-plane, projection equals image
+    orig = np.array(Image.open(experiment.images[0]))
+    assert np.all(np.array(Image.open(files[0].strpath)) == orig)
+
+    progress = [json.loads(l) for l in err.splitlines()]
+    assert progress[0]['workers'] == 2
+    assert progress[-1]['done'] == 4
+
+
+def test_parse_size():
+    "Sizes with suffix should be parsed to bytes."
+    from matrixscreener.cli import parse_size
+    assert parse_size('512') == 512
+    assert parse_size('2k') == 2048
+    assert parse_size('1.5G') == 1610612736
+
+
+def test_packed(experiment, monkeypatch):
+    "Commands should share memory budget and not write into packed chambers."
+    from matrixscreener import utils
+    from matrixscreener.cli import main
+
+    budgets = []
+    iter_budgeted = utils.iter_budgeted
+    def recording(*args, **kwargs):
+        budgets.append(utils.memory_budget())
+        return iter_budgeted(*args, **kwargs)
+    monkeypatch.setattr(utils, 'iter_budgeted', recording)
+
+    assert main(['pack', experiment.path, '--memory-limit', '1G']) == 0
+    assert budgets == [1024**3]
+    assert utils._memory_limit is None
+    with pytest.raises(ValueError):
+        main(['compress', experiment.path])
+    with pytest.raises(ValueError):
+        main(['decompress', experiment.path, '--delete-png'])
@@ -0,0 +1,148 @@
+import time
+import pytest
+from py import path
+
+from matrixscreener import distributed
+
+
+@pytest.fixture
+def experiment(tmpdir):
+    "'experiment--test' in tmpdir. Returns Experiment object."
+    from matrixscreener.experiment import Experiment
+    e = path.local(__file__).dirpath().join('experiment--test')
+    e.copy(tmpdir.mkdir('experiment'))
+
+    return Experiment(tmpdir.join('experiment').strpath)
+
+
+def list_well(well, fail=False):
+    "Operation for tests."
+    if fail:
+        raise IOError('failing')
+    return [well]
+
+
+@pytest.fixture
+def operation(monkeypatch):
+    monkeypatch.setitem(distributed.OPERATIONS, 'list', list_well)
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_file_broker(tmpdir, experiment, operation, workers):
+    "Units should be done once and results stored."
+    broker = distributed.FileBroker(tmpdir.join('queue').strpath)
+    units = distributed.submit(broker, experiment, 'list')
+    # submitting again does not add units
+    distributed.submit(broker, experiment, 'list')
+
+    status = distributed.work(broker, workers=workers)
+
+    assert status == {'queued': 0, 'claimed': 0, 'done': len(units),
+                      'failed': 0}
+    assert list(broker.results().values()) == [[w] for w in experiment.wells]
+
+
+def test_retries(tmpdir, experiment, operation):
+    "Failing units should be retried and then failed."
+    broker = distributed.FileBroker(tmpdir.join('queue').strpath, retries=2)
+    distributed.submit(broker, experiment, 'list', fail=True)
+
+    status = distributed.work(broker)
+
+    assert status['failed'] == len(experiment.wells)
+    assert len(tmpdir.join('queue', 'errors').listdir()) == 3
+
+
+def test_lease(tmpdir, experiment, operation):
+    "Expired leases should be taken over by other workers."
+    folder = tmpdir.join('queue').strpath
+    broker = distributed.FileBroker(folder, lease=0.05)
+    distributed.submit(broker, experiment, 'list')
+
+    unit = broker.claim()
+    assert distributed.FileBroker(folder, lease=0.05).claim() is None
+    time.sleep(0.1)
+    assert distributed.FileBroker(folder, lease=0.05).claim() == unit
+
+
+def test_lease_claimed_again(tmpdir, experiment, operation, monkeypatch):
+    "A lock claimed again after it expired should not be taken over."
+    import os
+    folder = tmpdir.join('queue').strpath
+    broker = distributed.FileBroker(folder, lease=0.05)
+    distributed.submit(broker, experiment, 'list')
+    unit = broker.claim()
+    lock = tmpdir.join('queue', 'claims', unit['id'] + '.lock')
+    time.sleep(0.1)
+
+    rename = os.rename
+    def released_and_claimed(src, dst):
+        # other worker takes over between check and rename
+        if src == lock.strpath:
+            lock.remove()
+            lock.write('other')
+        rename(src, dst)
+    monkeypatch.setattr(os, 'rename', released_and_claimed)
+
+    assert distributed.FileBroker(folder, lease=0.05).claim() is None
+    assert lock.read() == 'other'
+    assert len(tmpdir.join('queue', 'claims').listdir()) == 1
+
+
+def test_lease_lost(tmpdir, experiment, operation):
+    "Worker which lost its lease should not renew, release or fail unit."
+    folder = tmpdir.join('queue').strpath
+    old = distributed.FileBroker(folder, lease=0.05)
+    distributed.submit(old, experiment, 'list')
+    unit = old.claim()
+    assert old.renew(unit)
+    time.sleep(0.1)
+    new = distributed.FileBroker(folder, lease=0.05)
+    assert new.claim() == unit
+    lock = tmpdir.join('queue', 'claims', unit['id'] + '.lock')
+
+    assert not old.renew(unit)
+    old.fail(unit, 'failing')
+    assert tmpdir.join('queue', 'errors').listdir() == []
+    old.complete(unit, ['result'])
+    assert lock.read() == new.worker
+    assert old.results() == {unit['id']: ['result']}
+
+    new.complete(unit, ['result'])
+    assert not lock.check()
+
+
+def test_stitch(tmpdir, experiment, monkeypatch):
+    "Stitch units should share state with Experiment.iter_stitch."
+    import json
+    import matrixscreener.experiment as ms_experiment
+    calls = tmpdir.join('calls')
+
+    def stitch_well(well, folder, positions, flatfield):
+        calls.write('x', mode='a')
+        output = path.local(folder).join('stitched--U00--V00--C00--Z00.png')
+        output.write('')
+        return [output.strpath]
+    monkeypatch.setattr(ms_experiment, 'stitch_well', stitch_well)
+
+    broker = distributed.LocalBroker()
+    units = distributed.submit(broker, experiment, 'stitch')
+    assert distributed.work(broker)['done'] == 1
+    state = json.loads(tmpdir.join('experiment', 'AdditionalData',
+                                   'stitch.json').read())
+    assert state['wells'][experiment.wells[0]]['status'] == 'done'
+
+    # done by unit, resumed by experiment
+    results = list(experiment.iter_stitch())
+    assert results[0]['resumed']
+    assert distributed.run_unit(units[0]) == results[0]['files']
+    assert len(calls.read()) == 1
+
+
+def test_local_broker(experiment, operation):
+    "LocalBroker should work with threads."
+    broker = distributed.LocalBroker()
+    distributed.submit(broker, experiment, 'list')
+    status = distributed.work(broker, workers=2)
+
+    assert status['done'] == len(experiment.wells)
@@ -120,3 +120,174 @@ def test_16bit(ometif16bit):
     png_data = np.array(Image.open(png))
 
     assert np.all(tif_data == png_data)
+
+
+@pytest.mark.parametrize('prefetch', [0, 1, 3])
+def test_prefetch(tmpdir, ometif16bit, prefetch):
+    "Compress should give same result with and without prefetching."
+    from matrixscreener.experiment import compress_blocking
+    from PIL import Image
+    import numpy as np
+
+    tifs = []
+    for i in range(5):
+        tif = tmpdir.join('image--C{:02d}.ome.tif'.format(i))
+        ometif16bit.copy(tif)
+        tifs.append(tif.strpath)
+
+    pngs = compress_blocking(tifs, prefetch=prefetch)
+
+    assert pngs == [t[:-8] + '.png' for t in tifs]
+    for tif, png in zip(tifs, pngs):
+        assert np.all(np.array(Image.open(tif)) == np.array(Image.open(png)))
+
+
+def test_prefetch_error(tmpdir, ometif16bit, monkeypatch):
+    "Reader and writer threads should be shut down when compress fails."
+    import threading
+    from matrixscreener import experiment as ms_experiment
+
+    tifs = []
+    for i in range(5):
+        tif = tmpdir.join('image--C{:02d}.ome.tif'.format(i))
+        ometif16bit.copy(tif)
+        tifs.append(tif.strpath)
+    def fail(data, dedup=None):
+        raise ValueError('encoding failed')
+    monkeypatch.setattr(ms_experiment, '_encode', fail)
+    threads = threading.active_count()
+
+    with pytest.raises(ValueError):
+        ms_experiment.compress_blocking(tifs, prefetch=2)
+    assert threading.active_count() == threads
+    assert tmpdir.listdir(lambda p: p.ext == '.png') == []
+
+
+def test_groupby(experiment):
+    "Images should be grouped by attributes."
+    wells = list(experiment.groupby('u', 'v'))
+    assert wells == [((0, 0), experiment.images)]
+
+    channels = list(experiment.groupby('C'))
+    assert [k for k, _ in channels] == [('00',), ('01',)]
+    assert all(len(images) == 2 for _, images in channels)
+    assert sorted(i for _, g in channels for i in g) == experiment.images
+
+    fields = list(experiment.groupby('X', 'Y'))
+    assert [k for k, _ in fields] == [('00', '00'), ('00', '01')]
+
+
+def test_iter_fields_stacks(experiment):
+    "Fields and stacks should be iterated one at a time."
+    fields = list(experiment.iter_fields())
+    assert [f for f, _ in fields] == experiment.fields
+    assert sum(len(images) for _, images in fields) == 4
+
+    stacks = list(experiment.iter_stacks())
+    assert len(stacks) == 4
+    assert stacks[0][0] == ('00', '00', '00', '00', '00', '00')
+
+
+def test_previews(tmpdir, experiment):
+    "It should create field, well and plate previews, and reuse them."
+    import os
+    from PIL import Image
+    folder = tmpdir.join('previews').strpath
+    files = experiment.previews(scale=0.25, folder=folder)
+
+    # 2 fields and 1 well for 2 channels, plate for 2 channels
+    assert len(files) == 8
+    field = Image.open(files[0])
+    assert field.size == (256, 256)
+    well = Image.open(os.path.join(folder, 'preview--U00--V00--T00--C00.png'))
+    assert well.size == (256, 512)
+
+    mtimes = [os.path.getmtime(f) for f in files]
+    assert experiment.previews(scale=0.25, folder=folder) == files
+    assert [os.path.getmtime(f) for f in files] == mtimes
+
+
+def test_dedup(tmpdir, ometif16bit):
+    "Identical images should be stored once and decompress to originals."
+    import os
+    from matrixscreener.experiment import (compress_blocking, decompress,
+                                           dedup_stats)
+    from PIL import Image
+    import numpy as np
+
+    copy = tmpdir.join('copy--T01.ome.tif')
+    ometif16bit.copy(copy)
+    store = tmpdir.join('dedup').strpath
+
+    pngs = compress_blocking([ometif16bit.strpath, copy.strpath],
+                             dedup=store)
+    assert len(pngs) == 2
+    assert os.path.samefile(pngs[0], pngs[1])
+    assert len(os.listdir(store)) == 1
+
+    stats = dedup_stats(pngs)
+    assert stats['files'] == 2
+    assert stats['unique'] == 1
+    assert stats['ratio'] == 2
+
+    orig = np.array(Image.open(copy.strpath))
+    copy.remove()
+    tif, = decompress([pngs[1]])
+    assert (np.array(Image.open(tif)) == orig).all()
+
+
+def test_verify(tmpdir, ometif16bit):
+    "It should compare compressed images with source or stored checksum."
+    from matrixscreener.experiment import compress_blocking, verify
+    from PIL import Image
+    import numpy as np
+
+    png, = compress_blocking([ometif16bit.strpath])
+    assert verify([png]) == []
+
+    # checksum when source is gone
+    ometif16bit.remove()
+    assert verify([png]) == []
+
+    data = np.array(Image.open(png)).astype(np.int32)
+    data[0, 0] += 1
+    Image.fromarray(data).save(png)
+    errors = verify([png])
+    assert errors == [{'image': png, 'error': 'pixels differ from checksum'}]
+
+
+def test_stitch_resume(tmpdir, experiment, monkeypatch):
+    "Failing wells should be retried alone, and done wells not stitched again."
+    import matrixscreener.experiment as ms_experiment
+    calls = tmpdir.join('calls')
+
+    def stitch_well(well, folder, positions, flatfield):
+        # count calls in file, wells are stitched in workers
+        calls.write('x', mode='a')
+        if len(calls.read()) == 1:
+            raise IOError('fiji crashed')
+        output = path.local(folder).join('stitched--U00--V00--C00--Z00.png')
+        output.write('')
+        return [output.strpath]
+
+    monkeypatch.setattr(ms_experiment, 'stitch_well', stitch_well)
+    folder = tmpdir.mkdir('stitched').strpath
+
+    results = list(experiment.iter_stitch(folder))
+    assert len(results) == 1
+    assert results[0]['error'] is None
+    assert results[0]['attempts'] == 2
+    assert len(calls.read()) == 2
+
+    results = list(experiment.iter_stitch(folder))
+    assert results[0]['resumed']
+    assert len(calls.read()) == 2
+    assert experiment.stitch(folder) == results[0]['files']
+
+    # failing well is raised after all wells are done
+    calls.write('')
+    with pytest.raises(ms_experiment.StitchError) as e:
+        experiment.stitch(folder, retries=0, resume=False)
+    assert list(e.value.errors) == experiment.wells
+    assert 'fiji crashed' in e.value.errors[experiment.wells[0]]
+    assert e.value.files == []
@@ -0,0 +1,85 @@
+import pytest
+from collections import OrderedDict
+from py import path
+
+
+@pytest.fixture
+def experiment(tmpdir):
+    "'experiment--test' in tmpdir. Returns Experiment object."
+    from matrixscreener.experiment import Experiment
+    e = path.local(__file__).dirpath().join('experiment--test')
+    e.copy(tmpdir.mkdir('experiment'))
+
+    return Experiment(tmpdir.join('experiment').strpath)
+
+
+class FakeCAM(object):
+    "Records commands."
+    def __init__(self):
+        self.sent = []
+
+    def delete_list(self):
+        self.sent.append('deletelist')
+
+    def send_many(self, commands):
+        self.sent.append(commands)
+
+    def start_cam_scan(self):
+        self.sent.append('startcamscan')
+
+
+def two_objects(images):
+    "Analysis finding two objects in every field."
+    assert len(images) == 2
+    return [(10, -20), {'dxpos': 5, 'dypos': 5, 'job': 'job3'}]
+
+
+def test_feedback(experiment):
+    "Objects found in fields should be added to CAM list in batches."
+    from matrixscreener.feedback import Feedback
+
+    cam = FakeCAM()
+    feedback = Feedback(experiment, two_objects, cam, job='job2',
+                        workers=1, batch_size=3)
+    for image in experiment.images:
+        relpath = image[len(experiment.path) + 1:].replace('/', '\\')
+        feedback.feed(OrderedDict([('relpath', relpath)]))
+
+    # second field is still being scanned
+    assert list(feedback._futures) == experiment.fields[:1]
+
+    report = feedback.finish()
+    assert cam.sent[0] == 'deletelist'
+    assert cam.sent[-1] == 'startcamscan'
+    batches = cam.sent[1:-1]
+    assert all(len(batch) <= 3 for batch in batches)
+    jobs = [dict(command) for batch in batches for command in batch]
+
+    first = jobs[0]
+    assert (first['exp'], first['wellx'], first['fieldy']) == ('job2', '1', '1')
+    assert (first['dxpos'], first['dypos']) == ('10', '-20')
+    assert jobs[1]['exp'] == 'job3'
+    assert jobs[2]['fieldy'] == '2'
+
+    assert report['fields'] == 2
+    assert report['jobs'] == 4
+    assert report['latency']['max'] >= report['latency']['mean'] > 0
+
+
+def test_send_analyzed(experiment):
+    "Jobs should be sent when their field is analyzed, not when batch is full."
+    from matrixscreener.feedback import Feedback
+
+    cam = FakeCAM()
+    feedback = Feedback(experiment, two_objects, cam, workers=1)
+    for image in experiment.images[:3]:
+        relpath = image[len(experiment.path) + 1:].replace('/', '\\')
+        feedback.feed(OrderedDict([('relpath', relpath)]))
+    # first field complete, wait for analysis
+    future, _ = feedback._futures[experiment.fields[0]]
+    future.result()
+    feedback.collect()
+
+    assert cam.sent == ['deletelist', cam.sent[1]]
+    assert len(cam.sent[1]) == 2
+    feedback.finish(start=False)
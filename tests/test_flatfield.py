@@ -0,0 +1,77 @@
+import pytest
+from py import path
+
+
+@pytest.fixture
+def experiment(tmpdir):
+    "'experiment--test' in tmpdir. Returns Experiment object."
+    from matrixscreener.experiment import Experiment
+    e = path.local(__file__).dirpath().join('experiment--test')
+    e.copy(tmpdir.mkdir('experiment'))
+
+    return Experiment(tmpdir.join('experiment').strpath)
+
+
+def test_profiles(experiment):
+    "Profiles should be estimated per channel, cached and have mean 1."
+    import os
+    import numpy as np
+    from matrixscreener.flatfield import profiles, load
+
+    result = profiles(experiment.path, experiment.images)
+    assert sorted(result) == ['00', '01']
+    profile = load(result['00'])
+    assert profile.shape == (1024, 1024)
+    assert profile.mean() == pytest.approx(1, abs=0.05)
+
+    mtime = os.path.getmtime(result['00'])
+    profiles(experiment.path, experiment.images)
+    assert os.path.getmtime(result['00']) == mtime
+
+
+def test_correct():
+    "Correction should divide with profile and keep dtype."
+    import numpy as np
+    from matrixscreener.flatfield import correct
+
+    data = np.array([[100, 200], [250, 10]], dtype=np.uint8)
+    profile = np.array([[0.5, 1], [0.5, 2]], dtype=np.float32)
+    result = correct(data, profile)
+    assert result.dtype == np.uint8
+    assert result.tolist() == [[200, 200], [255, 5]]
+
+
+def test_fuse(experiment, tmpdir):
+    "Tiles should be fused at positions with flat-field correction."
+    from PIL import Image
+    from matrixscreener.metadata import registered_positions
+
+    files = experiment.stitch(tmpdir.mkdir('fused').strpath,
+                              positions='registered', flatfield=True)
+    assert len(files) == 2
+    fused = Image.open(files[0])
+    positions = registered_positions(experiment.wells[0])
+    x, y = positions[(0, 1)]
+    assert fused.size == (1024 + int(round(x)), 1024 + int(round(y)))
+
+
+def test_profiles_sample(experiment):
+    "Profiles should use one file per image and follow changes of sample."
+    import os, json, shutil
+    from matrixscreener.flatfield import profiles
+
+    tif = experiment.images[0]
+    png = tif.rsplit('.ome.tif', 1)[0] + '.png'
+    shutil.copy(tif, png)
+    images = experiment.images + [png]
+
+    result = profiles(experiment.path, images)
+    with open(result['00'].replace('.npy', '.json')) as f:
+        names = [name for name, size, mtime in json.load(f)]
+    assert not any(name.endswith('.png') for name in names)
+    assert os.path.basename(tif) in [os.path.basename(n) for n in names]
+
+    mtime = os.path.getmtime(result['00'])
+    os.utime(tif, (mtime + 10, mtime + 10))
+    profiles(experiment.path, images)
+    assert os.path.getmtime(result['00']) != mtime
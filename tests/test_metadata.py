@@ -0,0 +1,100 @@
+import os
+import pytest
+from py import path
+
+
+@pytest.fixture
+def experiment(tmpdir):
+    "'experiment--test' in tmpdir. Returns Experiment object."
+    from matrixscreener.experiment import Experiment
+    e = path.local(__file__).dirpath().join('experiment--test')
+    e.copy(tmpdir.mkdir('experiment'))
+
+    return Experiment(tmpdir.join('experiment').strpath)
+
+
+def test_parse(experiment):
+    "It should read pixel size and stage position of first plane."
+    from matrixscreener.metadata import metadata_files, parse
+
+    files = metadata_files(experiment.path)
+    assert len(files) == 2
+    row = parse(files[0])
+
+    assert (row['U'], row['V'], row['X'], row['Y'], row['T']) == (0, 0, 0, 0, 0)
+    assert row['image'].endswith('--X00--Y00--T00--Z00--C00.ome.tif')
+    assert row['size_x'] == 1024
+    assert row['pixel_type'] == 'uint8'
+    assert row['physical_size_x'] == pytest.approx(0.2405, abs=1e-4)
+    assert row['stage_x'] == pytest.approx(0.0427021, abs=1e-6)
+
+
+def test_table_cache(experiment):
+    "Table should be cached and only modified files parsed again."
+    import matrixscreener.metadata as metadata
+
+    table = experiment.metadata
+    assert list(table['Y']) == [0, 1]
+    cache = os.path.join(experiment.path, 'AdditionalData', 'metadata.npz')
+    assert os.path.isfile(cache)
+
+    parsed = []
+    def parse_blocking(paths):
+        parsed.extend(paths)
+        return [metadata.parse(p) for p in paths]
+
+    table = metadata.cached_columns(cache, list(table['path']),
+                                    parse_blocking, metadata.COLUMNS)
+    assert parsed == []
+    assert list(table['Y']) == [0, 1]
+
+
+def test_tile_positions(experiment):
+    "Stage positions should be converted to pixels relative to first field."
+    from matrixscreener.metadata import tile_positions
+
+    positions = tile_positions(experiment.metadata, 0, 0)
+    assert positions[(0, 0)] == (0.0, 0.0)
+    x, y = positions[(0, 1)]
+    # registered offset in TileConfiguration.registered.txt is ~936 px
+    assert 900 < y < 1000
+
+
+def test_stitch_macro_positions(experiment):
+    "Stitch macro should fuse from TileConfiguration written to well."
+    from matrixscreener.experiment import stitch_macro
+    from matrixscreener.metadata import read_tile_configuration
+
+    well = experiment.wells[0]
+    files, macros = stitch_macro(well, positions={(0, 0): (0, 0),
+                                                  (0, 1): (1, 930)})
+    assert len(macros) == 2
+    assert 'Positions from file' in macros[0]
+    layout = os.path.join(well, 'TileConfiguration.positions--Z00--C00.txt')
+    tiles = read_tile_configuration(layout)
+    assert tiles[1][0].startswith('field--X00--Y01/image--')
+    assert tiles[1][1] == (1.0, 930.0)
+
+
+def test_registered_positions(experiment):
+    "Registered positions should be reused for all planes in well."
+    from matrixscreener.experiment import stitch_macro
+    from matrixscreener.metadata import registered_positions
+
+    well = experiment.wells[0]
+    positions = registered_positions(well)
+    assert positions[(0, 1)] == (3.2326183, 936.7469)
+
+    files, macros = stitch_macro(well, positions='registered')
+    assert len(macros) == 2
+    assert all('Positions from file' in macro for macro in macros)
+    assert 'compute_overlap' not in ' '.join(macros)
+
+
+def test_register_macro(experiment):
+    "Registration should run once on first plane of well."
+    from matrixscreener.experiment import register_macro
+
+    output, macro = register_macro(experiment.wells[0])
+    assert output.endswith('stitched--U00--V00--C00--Z00.png')
+    assert 'compute_overlap' in macro
@@ -0,0 +1,137 @@
+import os
+import pytest
+from py import path
+
+
+@pytest.fixture
+def experiment(tmpdir):
+    "'experiment--test' in tmpdir. Returns Experiment object."
+    from matrixscreener.experiment import Experiment
+    e = path.local(__file__).dirpath().join('experiment--test')
+    e.copy(tmpdir.mkdir('experiment'))
+
+    return Experiment(tmpdir.join('experiment').strpath)
+
+
+def test_pack(experiment):
+    "Packed experiment should list and read images as before packing."
+    from matrixscreener.experiment import Experiment
+    from matrixscreener.packed import PackedStorage
+
+    images = experiment.images
+    with open(images[1], 'rb') as f:
+        data = f.read()
+
+    archives = experiment.pack(delete=True)
+    assert [os.path.basename(a) for a in archives] == ['chamber--U00--V00.zip']
+    assert not os.path.isdir(experiment.wells[0])
+
+    packed = Experiment(experiment.path)
+    assert isinstance(packed.storage, PackedStorage)
+    assert packed.images == images
+    assert len(packed.fields) == 2
+    assert packed.storage.read(images[1]) == data
+    assert packed.storage.read(images[1], 2, 10) == data[2:10]
+
+
+def test_archive(experiment):
+    "Archive should give single images by attribute."
+    from matrixscreener.packed import Archive, pack_blocking
+
+    archive = Archive(pack_blocking(experiment.wells)[0])
+    assert len(archive.find(X=0)) == 4
+    assert archive.find(Y=1, C=1) == [
+        'field--X00--Y01/image--L00--S00--U00--V00--J20--E00--O00--X00--Y01'
+        '--T00--Z00--C01.ome.tif']
+    assert archive.image(Y=1, C=1).size == (1024, 1024)
+    with pytest.raises(ValueError):
+        archive.image(Y=1)
+
+
+def test_packed_readers(experiment, tmpdir):
+    "Projections, grouping and metadata should read from archives."
+    from matrixscreener.experiment import Experiment
+
+    images = experiment.images
+    metadata = experiment.metadata
+    experiment.pack(delete=True)
+    os.remove(os.path.join(experiment.path, 'AdditionalData', 'metadata.npz'))
+
+    packed = Experiment(experiment.path)
+    groups = list(packed.groupby('U', 'V'))
+    assert [key for key, _ in groups] == [('00', '00')]
+    assert groups[0][1] == images
+    assert [len(i) for _, i in packed.iter_fields()] == [2, 2]
+
+    table = packed.metadata
+    assert list(table['path']) == list(metadata['path'])
+    assert (table['stage_x'] == metadata['stage_x']).all()
+
+    projected = packed.project()
+    assert len(projected) == 4
+    assert all(os.path.isfile(p) for p in projected)
+    assert len(packed.previews(scale=0.25)) == 4 + 2 + 2
+
+    with pytest.raises(ValueError):
+        packed.compress()
+
+
+def test_pack_again(experiment):
+    "Packing again should keep files in archive and add new files."
+    import shutil
+    from matrixscreener.packed import Archive, pack_blocking
+
+    well = experiment.wells[0]
+    names = Archive(pack_blocking([well], delete=True)[0]).names
+
+    # new image with old mtime, as copied with cp -p
+    field = os.path.join(well, 'field--X09--Y09')
+    os.makedirs(field)
+    image = os.path.join(field, 'image--X09--Y09--C00.png')
+    with open(image, 'wb') as f:
+        f.write(b'new image')
+    old = os.path.getmtime(well + '.zip') - 3600
+    os.utime(image, (old, old))
+
+    archive = Archive(pack_blocking([well], delete=True)[0])
+    assert not os.path.isdir(well)
+    assert archive.names == sorted(names + [
+        'field--X09--Y09/image--X09--Y09--C00.png'])
+    assert archive.read('field--X09--Y09/image--X09--Y09--C00.png') == \
+        b'new image'
+
+
+def test_pack_verify(experiment, monkeypatch):
+    "Chamber folder should not be deleted if files are not in archive."
+    from matrixscreener import packed
+
+    well = experiment.wells[0]
+    packed.pack_blocking([well])
+    # archive lost a file after it was written
+    monkeypatch.setattr(packed, '_changed',
+                        lambda path, info, mtime=None, crcs=None:
+                        path.endswith('C01.ome.tif'))
+    with pytest.raises(IOError):
+        packed.pack_blocking([well], delete=True)
+    assert os.path.isdir(well)
+
+
+def test_spawned_workers(experiment, monkeypatch):
+    "Workers which are not forked should read from archives through mounts."
+    import multiprocessing
+    from matrixscreener import utils, storage
+    from matrixscreener.experiment import Experiment
+    from matrixscreener.qc import measure_blocking
+
+    images = experiment.images
+    expected = measure_blocking(images)
+    experiment.pack(delete=True)
+    monkeypatch.setattr(multiprocessing, 'Pool',
+                        multiprocessing.get_context('spawn').Pool)
+    monkeypatch.setattr(utils, '_pools', 2)
+
+    with Experiment(experiment.path) as packed:
+        rows = utils.apply_async(measure_blocking,
+                                 paths=(packed.images, True))
+        assert rows == expected
+    assert storage._mounted(packed.path) is None
@@ -0,0 +1,60 @@
+import pytest
+from collections import OrderedDict
+from py import path
+
+
+@pytest.fixture
+def experiment(tmpdir):
+    "'experiment--test' in tmpdir. Returns Experiment object."
+    from matrixscreener.experiment import Experiment
+    e = path.local(__file__).dirpath().join('experiment--test')
+    e.copy(tmpdir.mkdir('experiment'))
+
+    return Experiment(tmpdir.join('experiment').strpath)
+
+
+def test_feed(experiment):
+    "CAM messages should schedule wells when scan moves on or finishes."
+    from matrixscreener.pipeline import Pipeline
+
+    pipeline = Pipeline(experiment, compress=False, stitch=False, workers=1)
+    for image in experiment.images:
+        relpath = image[len(experiment.path) + 1:].replace('/', '\\')
+        pipeline.feed(OrderedDict([('relpath', relpath)]))
+
+    # well is still being scanned
+    assert len(pipeline.results) == 0
+
+    pipeline.feed(OrderedDict([('inf', 'scanfinished')]))
+    assert list(pipeline.results.keys()) == experiment.wells
+
+    results = pipeline.finish()
+    assert results[experiment.wells[0]] == {'compressed': [], 'projected': [],
+                                            'stitched': []}
+
+
+def test_poll(experiment):
+    "Polling experiment folder should find wells."
+    from matrixscreener.pipeline import Pipeline
+
+    pipeline = Pipeline(experiment, compress=False, stitch=False, workers=1)
+    results = pipeline.watch(interval=0, until=lambda: True)
+
+    assert list(results.keys()) == experiment.wells
+
+
+def test_project_packed(experiment, tmpdir):
+    "Polling packed experiment should find and project wells."
+    from matrixscreener.experiment import Experiment
+    from matrixscreener.pipeline import Pipeline
+
+    experiment.pack(delete=True)
+    folder = tmpdir.mkdir('projected').strpath
+    pipeline = Pipeline(Experiment(experiment.path), compress=False,
+                        stitch=False, folder=folder, project=True, workers=1)
+    results = pipeline.watch(interval=0, until=lambda: True)
+
+    projected = results[experiment.wells[0]]['projected']
+    assert len(projected) == 4
+    assert projected == [p.strpath for p in tmpdir.join('projected').listdir(
+        sort=True)]
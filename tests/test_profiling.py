@@ -0,0 +1,47 @@
+import json
+
+
+def work(chunk):
+    "Record a stage in worker."
+    from matrixscreener.profiling import stage
+    for item in chunk:
+        with stage('work', nbytes=item):
+            pass
+    return chunk
+
+
+def test_profile_workers(tmpdir):
+    "Stages in workers should be aggregated in summary and trace."
+    from matrixscreener import profiling
+    from matrixscreener.utils import apply_budgeted
+
+    folder = profiling.enable(tmpdir.join('events').strpath)
+    try:
+        with profiling.stage('main'):
+            apply_budgeted(work, [1, 2, 3, 4], lambda chunk: 0, workers=2,
+                           chunk_size=1)
+        events = profiling.events()
+        trace = tmpdir.join('trace.json').strpath
+        profiling.chrome_trace(trace)
+    finally:
+        profiling.disable()
+
+    names = [e['name'] for e in events]
+    assert names.count('work') == 4
+    assert 'main' in names and 'pool' in names
+    assert sum(e['bytes'] for e in events if e['name'] == 'work') == 10
+    assert len(set(e['pid'] for e in events)) > 1
+
+    with open(trace) as f:
+        assert len(json.load(f)['traceEvents']) == len(events)
+    summary = profiling.summary(folder).splitlines()
+    assert summary[0].startswith('stage')
+    assert len(summary) == 4
+
+
+def test_disabled():
+    "Stages should not be recorded unless enabled."
+    from matrixscreener import profiling
+    with profiling.stage('nothing') as s:
+        s.bytes = 1
+    assert profiling.events() == []
@@ -0,0 +1,96 @@
+import os
+import pytest
+from py import path
+
+
+@pytest.fixture
+def experiment(tmpdir):
+    "'experiment--test' in tmpdir. Returns Experiment object."
+    from matrixscreener.experiment import Experiment
+    e = path.local(__file__).dirpath().join('experiment--test')
+    e.copy(tmpdir.mkdir('experiment'))
+
+    return Experiment(tmpdir.join('experiment').strpath)
+
+
+def test_measure():
+    "Statistics from histogram should equal those of numpy."
+    import numpy as np
+    from matrixscreener.qc import measure
+
+    data = (np.random.RandomState(0).rand(64, 80) * 4000).astype(np.uint16)
+    data[0, :8] = 65535
+    stats = measure(data)
+    assert stats['mean'] == pytest.approx(data.mean())
+    assert stats['std'] == pytest.approx(data.std())
+    assert stats['p50'] == np.sort(data.ravel())[data.size // 2 - 1]
+    assert stats['max'] == 65535
+    assert stats['saturated'] == pytest.approx(8 / data.size)
+    assert measure(np.ones((10, 10), dtype=np.uint8))['focus'] == 0
+
+    # saturation from bit depth, also when decoded to other dtype
+    assert measure(data.astype(np.int32), 65535)['saturated'] == \
+        stats['saturated']
+    assert measure(data.astype(np.float32), 65535)['saturated'] == \
+        stats['saturated']
+    dim = np.full((10, 10), 7, dtype=np.uint16)
+    assert measure(dim)['saturated'] == 0
+    assert measure(dim.astype(np.float32), 65535)['saturated'] == 0
+    assert np.isnan(measure(dim.astype(np.float32))['saturated'])
+
+
+def test_saturation_level(tmpdir):
+    "16 bit PNGs should saturate at 65535, whatever dtype they decode to."
+    import numpy as np
+    from PIL import Image
+    from matrixscreener.qc import saturation_level
+
+    png = tmpdir.join('16bit.png').strpath
+    Image.fromarray(np.zeros((4, 4), dtype=np.uint16)).save(png)
+    image = Image.open(png)
+    assert saturation_level(image, np.asarray(image)) == 65535
+    pixels = np.asarray(image).astype(np.int32)
+    assert saturation_level(image, pixels) == 65535
+
+
+def test_table(experiment):
+    "Table should be keyed by attributes and measure only new images."
+    import numpy as np
+    import matrixscreener.qc as qc
+
+    table = experiment.qc()
+    assert list(table['Y']) == [0, 0, 1, 1]
+    assert list(table['C']) == [0, 1, 0, 1]
+    assert (table['p99'] >= table['p50']).all()
+    assert (table['focus'] > 0).all()
+    cache = os.path.join(experiment.path, 'AdditionalData', 'qc.npz')
+    assert os.path.isfile(cache)
+
+    measured = []
+    def measure_blocking(paths):
+        measured.extend(paths)
+        return qc.measure_blocking(paths)
+
+    path.local(table['path'][0]).setmtime(table['mtime'][0] + 10)
+    again = qc.cached_columns(cache, list(table['path']), measure_blocking,
+                              qc.COLUMNS)
+    assert measured == [table['path'][0]]
+    assert np.allclose(again['mean'], table['mean'])
+
+    wells = qc.summary(table)
+    assert list(wells['images']) == [4]
+    assert wells['mean'][0] == pytest.approx(table['mean'].mean())
+
+
+def test_packed(experiment):
+    "Packed experiments should be measured from their archives."
+    import numpy as np
+    from matrixscreener.experiment import Experiment
+
+    table = experiment.qc(cache=False)
+    experiment.pack(delete=True)
+    packed = Experiment(experiment.path).qc()
+    assert list(packed['path']) == list(table['path'])
+    assert np.allclose(packed['mean'], table['mean'])
+    assert os.path.isfile(os.path.join(experiment.path, 'AdditionalData',
+                                       'qc.npz'))
@@ -0,0 +1,120 @@
+import pytest
+from py import path
+
+
+@pytest.fixture
+def memory():
+    "Storage backend for 'mem://' with files of 'experiment--test'."
+    from matrixscreener import storage
+
+    class MemoryStorage(storage.Storage):
+        "Files in a dict, counting listings."
+        def __init__(self):
+            self.files = {}
+            self.listings = 0
+
+        def find(self, prefix):
+            self.listings += 1
+            return sorted(p for p in self.files if p.startswith(prefix + '/'))
+
+        def info(self, path):
+            if path not in self.files:
+                return None
+            return len(self.files[path]), 0.0
+
+        def read(self, path, start=None, end=None):
+            if path not in self.files:
+                raise IOError('no such file: ' + path)
+            return self.files[path][start:end]
+
+        def write(self, path, data):
+            self.files[path] = bytes(data)
+
+        def remove(self, path):
+            del self.files[path]
+
+    backend = MemoryStorage()
+    root = path.local(__file__).dirpath().join('experiment--test')
+    for f in root.visit(lambda p: p.check(file=1)):
+        backend.files['mem://experiment/' + f.relto(root)] = f.read('rb')
+    storage.register('mem', lambda protocol: backend)
+    yield backend
+    storage._backends.pop('mem')
+    storage._instances.pop('mem', None)
+
+
+def test_list(memory):
+    "Experiment should list remote images in one listing."
+    from matrixscreener.experiment import Experiment
+
+    e = Experiment('mem://experiment/')
+    assert e.path == 'mem://experiment'
+    assert e.storage is memory
+    assert e.wells == ['mem://experiment/slide--S00/chamber--U00--V00']
+    assert len(e.fields) == 2
+
+    memory.listings = 0
+    images = e.images
+    assert memory.listings == 1
+    assert len(images) == 4
+    assert all(i.startswith('mem://experiment/slide--S00/chamber--U00--V00/'
+                            'field--X00--Y0') for i in images)
+
+
+def test_decompress(memory):
+    "Decompress should read and write through storage backend."
+    import json
+    from io import BytesIO
+    import numpy as np
+    from PIL import Image
+    from matrixscreener.experiment import decompress
+
+    png = BytesIO()
+    data = np.arange(64, dtype=np.uint8).reshape(8, 8)
+    Image.fromarray(data).save(png, format='PNG')
+    memory.write('mem://experiment/image--C00.png', png.getvalue())
+    memory.write('mem://experiment/image--C00.json', json.dumps({}).encode())
+
+    result = decompress(['mem://experiment/image--C00.png'], delete_png=True)
+    assert result == ['mem://experiment/image--C00.ome.tif']
+    assert 'mem://experiment/image--C00.png' not in memory.files
+    img = Image.open(BytesIO(memory.files[result[0]]))
+    assert (np.asarray(img) == data).all()
+
+
+def test_local_range(tmpdir):
+    "Local storage should read byte ranges."
+    from matrixscreener.storage import storage_for, LocalStorage
+
+    f = tmpdir.join('data.bin')
+    f.write_binary(b'0123456789')
+    storage = storage_for(f.strpath)
+    assert isinstance(storage, LocalStorage)
+    assert storage.read(f.strpath, 2, 5) == b'234'
+    assert storage.read_many([f.strpath, f.strpath]) == [b'0123456789'] * 2
+    assert storage.find(tmpdir.strpath) == [f.strpath]
+
+    storage.write(f.strpath, b'new')
+    assert f.read_binary() == b'new'
+    assert tmpdir.listdir() == [f]
+
+
+def test_experiment(memory, tmpdir):
+    "Grouping, metadata and projections should read through storage backend."
+    from matrixscreener.experiment import Experiment
+
+    e = Experiment('mem://experiment')
+    groups = list(e.groupby('U', 'V'))
+    assert [key for key, _ in groups] == [('00', '00')]
+    assert groups[0][1] == e.images
+    assert [len(images) for _, images in e.iter_fields()] == [2, 2]
+
+    table = e.metadata
+    assert list(table['X']) == [0, 0]
+    assert list(table['Y']) == [0, 1]
+    assert (table['size_x'] == 1024).all()
+    assert 'mem://experiment/AdditionalData/metadata.npz' in memory.files
+
+    projected = e.project(tmpdir.strpath)
+    assert len(projected) == 4
+    assert projected == tmpdir.listdir(sort=True)
@@ -0,0 +1,113 @@
+import time
+
+
+def intervals(chunk):
+    "Sleep a little, returns (start, end) for every item."
+    start = time.time()
+    time.sleep(0.1)
+    return [(start, time.time()) for _ in chunk]
+
+
+def test_apply_budgeted_order():
+    "Results should be merged in order of items."
+    from matrixscreener.utils import apply_budgeted
+
+    result = apply_budgeted(sorted, list(range(10)), lambda chunk: 1,
+                            workers=3, chunk_size=2)
+    assert result == list(range(10))
+
+
+def test_apply_budgeted_budget():
+    "Chunks should not run at once when they do not fit in budget."
+    from matrixscreener.utils import apply_budgeted
+
+    result = apply_budgeted(intervals, list(range(3)), lambda chunk: 60,
+                            budget=100, workers=3, chunk_size=1)
+    result = sorted(result)
+    for (_, end), (start, _) in zip(result, result[1:]):
+        assert end <= start
+
+    result = apply_budgeted(intervals, list(range(3)), lambda chunk: 30,
+                            budget=100, workers=3, chunk_size=1)
+    starts = [start for start, _ in result]
+    assert max(starts) - min(starts) < 0.1
+
+
+def test_image_memory():
+    "Memory should be estimated from image size in header."
+    from py import path
+    from matrixscreener.utils import image_memory
+
+    image = path.local(__file__).dirpath().join('images', '16bit.ome.tif')
+    memory = image_memory([image.strpath])
+    assert memory >= image.size()
+    assert image_memory([image.strpath], 3) == 3 * memory
+
+
+def shared_ones(chunk):
+    "Arrays in shared memory."
+    import numpy as np
+    from matrixscreener.utils import share
+    return [share(np.full((512, 1024), i, dtype=np.uint16))
+            for i in chunk]
+
+
+def test_shared_results():
+    "Arrays should be returned through shared memory and freed on exit."
+    import pytest
+    pytest.importorskip('multiprocessing.shared_memory')
+    from multiprocessing.shared_memory import SharedMemory
+    from matrixscreener.utils import apply_budgeted, attached, SharedArray
+
+    results = apply_budgeted(shared_ones, [1, 2, 3], lambda chunk: 0,
+                             workers=2, chunk_size=1)
+    assert all(isinstance(r, SharedArray) for r in results)
+
+    with attached(results) as arrays:
+        assert [int(a[0, 0]) for a in arrays] == [1, 2, 3]
+        assert arrays[0].shape == (512, 1024)
+
+    for r in results:
+        with pytest.raises(FileNotFoundError):
+            SharedMemory(r.name)
+
+
+def shared_or_fail(chunk):
+    "Shared array, or error for negative items."
+    import numpy as np
+    from matrixscreener.utils import share
+    if chunk[0] < 0:
+        raise ValueError('failing chunk')
+    return share(np.full((512, 1024), chunk[0], dtype=np.uint16))
+
+
+def test_shared_error(monkeypatch):
+    "Shared arrays should be freed when another chunk fails."
+    import os
+    import pytest
+    pytest.importorskip('multiprocessing.shared_memory')
+    from matrixscreener import utils
+    monkeypatch.setattr(utils, '_pools', 2)
+
+    if not os.path.isdir('/dev/shm'):
+        pytest.skip('no /dev/shm')
+    before = set(os.listdir('/dev/shm'))
+    with pytest.raises(ValueError):
+        utils.apply_budgeted(shared_or_fail, [1, 2, -1, 3], lambda c: 0,
+                             workers=2, chunk_size=1)
+    with pytest.raises(ValueError):
+        utils.apply_async(shared_or_fail, chunk=([1, -1], True))
+    assert set(os.listdir('/dev/shm')) - before == set()
+
+
+def test_share_small(monkeypatch):
+    "Small arrays should be pickled as one result."
+    import numpy as np
+    from matrixscreener import utils
+    from matrixscreener.utils import apply_async, attached, share
+    monkeypatch.setattr(utils, '_pools', 1)
+
+    results = apply_async(share, array=(np.ones((3, 4)), False))
+    assert len(results) == 1
+    with attached(results) as arrays:
+        assert arrays[0].shape == (3, 4)